@@ -2,12 +2,14 @@ from mesa import Agent
 import random
 import csv
 import numpy as np
-import statistics
 import pickle
-from scipy.spatial import distance as dst
 import copy
 from pdpython_model import sarsa
 from pdpython_model import sarsa_moody
+from pdpython_model import history
+from pdpython_model import encoding
+from pdpython_model import knn
+from pdpython_model import telemetry
 import math
 
 """Note on Strategies:
@@ -92,9 +94,9 @@ class PDAgent(Agent):
 
         # ------------------------ LOCAL MEMORY --------------------------
         self.partner_IDs = []
-        self.partner_moves = {}
         self.ppD_partner = 0
-        self.per_partner_payoffs = {}  # this should be list of all prev payoffs from my partner, only used fr averaging
+        # my payoffs from each partner, only used for averaging - over the whole game or recent rounds, see history.py
+        self.per_partner_payoffs = history.PartnerHistory(self.model.history_retention, self.model.history_length)
         self.partner_latest_move = {}  # this is a popped list
         #self.my_latest_move = {} # this is a popped list
         self.partner_scores = {}
@@ -136,6 +138,7 @@ class PDAgent(Agent):
 
         # Per Partner Q Tables
         self.qtable = []
+        self.pending_payoffs = None  # this round's payoffs, held until finish_round
 
         # ----------------------- MOODY SARSA GLOBALS ---------------------------
         self.mood = self.model.moody_startmood  # A value between 0 and 100
@@ -175,6 +178,7 @@ class PDAgent(Agent):
         self.number_of_d = 0
         self.mutual_c_outcome = 0
         self.n_partners = 0
+        self.partners = None  # partner agents in N, E, S, W order, filled in once by the model at spawn
 
         self.default_attempt = 0
         self.attempts_taken = 0
@@ -184,27 +188,38 @@ class PDAgent(Agent):
         self.ppD_partner = {}
         self.rounds_left = self.model.rounds - self.stepCount
 
-    def get_IDs(self):
+    def find_partners(self):
+        """ Looks up the agents in the N, E, S, W cells around us. Agents never move, so the model only needs to
+            do this once for everyone after spawning - see index_partners() in the model. """
+        partners = []
         x, y = self.pos
         neighbouring_cells = [(x, y + 1), (x + 1, y), (x, y - 1), (x - 1, y)]  # N, E, S, W
 
-        # First, get the neighbours
         for i in neighbouring_cells:
             bound_checker = self.model.grid.out_of_bounds(i)
             if not bound_checker:
                 this_cell = self.model.grid.get_cell_list_contents([i])
-                # print("This cell", this_cell)
 
                 if len(this_cell) > 0:
                     partner = [obj for obj in this_cell
                                if isinstance(obj, PDAgent)][0]
+                    partners.append(partner)
+        return partners
+
+    def get_partners(self):
+        if self.partners is None:
+            self.partners = self.find_partners()
+            self.n_partners = len(self.partners)
+        return self.partners
 
-                    partner_ID = partner.ID
+    def get_IDs(self):
+        for partner in self.get_partners():
+            partner_ID = partner.ID
 
-                    if partner_ID not in self.partner_IDs:
-                        self.partner_IDs.append(partner_ID)
+            if partner_ID not in self.partner_IDs:
+                self.partner_IDs.append(partner_ID)
 
-                    # self.ppD_partner[partner_ID] = 0.5
+            # self.ppD_partner[partner_ID] = 0.5
 
     def set_defaults(self, ids):
         # open the ppD pickle
@@ -430,39 +445,27 @@ class PDAgent(Agent):
         """ Iterative move selection uses the pick_move function PER PARTNER, then stores this in a dictionary
         keyed by the partner it picked that move for. We can then cycle through these for iter. score incrementing"""
         versus_moves = {}
-        x, y = self.pos
-        neighbouring_cells = [(x, y + 1), (x + 1, y), (x, y - 1), (x - 1, y)]  # N, E, S, W
-
-        # First, get the neighbours
-        for i in neighbouring_cells:
-            bound_checker = self.model.grid.out_of_bounds(i)
-            if not bound_checker:
-                this_cell = self.model.grid.get_cell_list_contents([i])
-                # print("This cell", this_cell)
-
-                if len(this_cell) > 0:
-                    partner = [obj for obj in this_cell
-                               if isinstance(obj, PDAgent)][0]
-
-                    partner_ID = partner.ID
-                    partner_mood = sarsa_moody.getMoodType(partner.mood)
-                    partner_move = 0
-                    if partner.itermove_result.get(self.ID) is None:
-                        partner_move = 0
-                    else:
-                        partner_move = partner.itermove_result[self.ID]
+        for partner in self.get_partners():
+            partner_ID = partner.ID
+            partner_mood = sarsa_moody.getMoodType(partner.mood)
+            partner_move = 0
+            if partner.itermove_result.get(self.ID) is None:
+                partner_move = 0
+            else:
+                partner_move = partner.itermove_result[self.ID]
 
-                    if self.partner_states.get(partner_ID) is None:
-                        self.partner_states[partner_ID] = sarsa_moody.observe_state(partner_move, partner_ID, partner_mood,
-                                                                                                       self.statemode)
+            if self.partner_states.get(partner_ID) is None:
+                self.partner_states[partner_ID] = sarsa_moody.observe_state(partner_move, partner_ID, partner_mood,
+                                                                                               self.statemode,
+                                                                                               self.model.number_of_agents)
 
-                    # pick a move
-                    if strategy is not "MOODYLEARN":
-                        move = self.pick_move(strategy, payoffs, partner_ID, self.working_memory)
-                    else:
-                        move = self.pick_move(strategy, payoffs, partner_ID, self.partner_states)
-                    # add that move, with partner ID, to the versus choice dictionary
-                    versus_moves[partner_ID] = move
+            # pick a move
+            if strategy is not "MOODYLEARN":
+                move = self.pick_move(strategy, payoffs, partner_ID, self.working_memory)
+            else:
+                move = self.pick_move(strategy, payoffs, partner_ID, self.partner_states)
+            # add that move, with partner ID, to the versus choice dictionary
+            versus_moves[partner_ID] = move
         # print("agent", self.ID,"versus moves:", versus_moves)
         return versus_moves
 
@@ -470,26 +473,13 @@ class PDAgent(Agent):
         """ Iterative move selection uses the pick_move function PER PARTNER, then stores this in a dictionary
         keyed by the partner it picked that move for. We can then cycle through these for iter. score incrementing"""
         versus_moves = {}
-        x, y = self.pos
-        neighbouring_cells = [(x, y + 1), (x + 1, y), (x, y - 1), (x - 1, y)]  # N, E, S, W
-
-        # First, get the neighbours
-        for i in neighbouring_cells:
-            bound_checker = self.model.grid.out_of_bounds(i)
-            if not bound_checker:
-                this_cell = self.model.grid.get_cell_list_contents([i])
-                # print("This cell", this_cell)
-
-                if len(this_cell) > 0:
-                    partner = [obj for obj in this_cell
-                               if isinstance(obj, PDAgent)][0]
+        for partner in self.get_partners():
+            partner_ID = partner.ID
 
-                    partner_ID = partner.ID
-
-                    # pick a move
-                    move = self.pick_move(strategy, payoffs, partner_ID, nextstates)
-                    # add that move, with partner ID, to the versus choice dictionary
-                    versus_moves[partner_ID] = move
+            # pick a move
+            move = self.pick_move(strategy, payoffs, partner_ID, nextstates)
+            # add that move, with partner ID, to the versus choice dictionary
+            versus_moves[partner_ID] = move
         # print("agent", self.ID,"versus moves:", versus_moves)
         return versus_moves
 
@@ -706,22 +696,9 @@ class PDAgent(Agent):
             """ Use the epsilon-greedy algorithm to select a move to play. """
             if not learning_state:
                 for j in self.partner_IDs:
-                    blank_list = []
-                    if self.model.memoryPaired:
-                        # need to now vary the length of this depending on msize
-
-                        for n in range(self.delta):
-                            blank_list.append((0, 0))
-                    elif not self.model.memoryPaired:
-                        for n in range(self.delta):
-                            blank_list.append(0)
+                    learning_state[j] = encoding.blank_window(self.delta, self.model.memoryPaired)
 
-                    learning_state[j] = blank_list
-
-            if self.delta > 1:
-                egreedy = sarsa.egreedy_action(self.epsilon, self.qtable, tuple(learning_state[id]), self.model.memoryPaired)
-            else:
-                egreedy = sarsa.egreedy_action(self.epsilon, self.qtable, learning_state[id], self.model.memoryPaired)
+            egreedy = sarsa.egreedy_action(self.epsilon, self.qtable, learning_state[id])
             if egreedy == "C":
                 self.number_of_c += 1
             elif egreedy == "D":
@@ -732,14 +709,7 @@ class PDAgent(Agent):
             """ Use the epsilon-greedy algorithm to select a move to play. """
             if not learning_state:
                 for j in self.partner_IDs:
-                    blank_list = []
-                    if self.statemode == 'stateless':
-                        blank_list.append((0))
-                    if self.statemode == 'agentstate':
-                        blank_list.append(((0, 0)))
-                    if self.statemode == 'moodstate':
-                        blank_list.append(((0, 0, 0)))
-                    learning_state[j] = blank_list
+                    learning_state[j] = encoding.EMPTY  # the [0], [0, 0] or [0, 0, 0] starting state
 
             # elif learning_state[id]:
             #     learning_state[id] = sarsa_moody.observe_state(self.partner_latest_move[id], id, self.partner_moods[id],
@@ -828,7 +798,8 @@ class PDAgent(Agent):
     def change_update_value(self, partner_behaviour):
         """ Produce a [new update value] VALUE BY WHICH TO ALTER THE CURRENT UV given the current uv and the
         behaviour that partner has shown.
-        Partner behaviour should be a list of self.delta size, ordered by eldest behaviour observed to most recent.
+        Partner behaviour should be the packed code (see encoding.py) of a self.delta sized window, ordered by eldest
+        behaviour observed to most recent.
         current_uv should be a singular value """
         # let's start with a very simple lookup table version of behaviour comparison - probably only usable if
         # delta is fairly small, as we have to outline the specific behavioural patterns we are comparing
@@ -846,9 +817,6 @@ class PDAgent(Agent):
         # uv_modifier = 0
         theta = self.theta
 
-        numberC = partner_behaviour.count('C')
-        numberD = partner_behaviour.count('D')
-
         # # print("My partner did:", partner_behaviour)
         # if partner_behaviour == ['C', 'D', 'C']:  # Higher Value to Break Potential Cycles
         #     # print("I used behavioural rule 1, and I'm gonna return update value", theta * 3)
@@ -878,312 +846,243 @@ class PDAgent(Agent):
         #     # print("I used behavioural rule 4, and I'm gonna return update value", theta * 3)
         #     return theta * 6
 
-        """ Acquire our state, then compare it to the list of all possible states generated by the 
-            model. """
-
-        all_states = copy.deepcopy(self.model.memory_states)
-        state_values = copy.deepcopy(self.model.state_values)
-
-        index = 0
-
-        for i in all_states:
-            if i == partner_behaviour:
-                index = all_states.index(i)
-
-        state_value = state_values[index]
-
-        # TODO: This section is probably going to break to all hell when the new statemaker is used
-        # I don't think it did?
-
-        """" Now need to decide what the boundaries are for changing update value
-            based on this state value that is returned... """
+        """ Acquire our state, then look up what it's worth in the table the model built from the list of all
+            possible states (see statespace.UpdateValues). """
         # State values exist between values of 21 and -21, with a normal distribution of state values (i.e.
         # there are lower numbers of SUPER GOOD and SUPER BAD states, and where the numbers of C and D equal
         # out a bit there are more of those states). The value of middling states is zero and there is never more than
         # 16 of those states in those categories
-
-        bound_a = [-5, -4, -3, -2, -1, 0, 1, 2, 3, 4, 5]
-        bound_b = [-6, -7, -8, -9, 6, 7, 8, 9]
-        bound_c = [-10, -11, -12, 10, 11, 12]
-        bound_d = [-13, -14, -15, 13, 14, 15]
-        bound_e = [-16, -17, -18, 16, 17, 18]
-        bound_f = [-19, -20, -21, 19, 20, 21]
-
-        if state_value in bound_a:
-            return theta * 1
-        if state_value in bound_b:
-            return theta * 2
-        if state_value in bound_c:
-            return theta * 3
-        if state_value in bound_d:
-            return theta * 4
-        if state_value in bound_e:
-            return theta * 5
-        if state_value in bound_f:
-            return theta * 6
+        return theta * self.model.update_value_table[partner_behaviour]
 
     def check_partner(self):
         """ Check Partner looks at all the partner's current move selections and adds them to relevant memory spaces"""
-        x, y = self.pos
-        neighbouring_cells = [(x, y + 1), (x + 1, y), (x, y - 1), (x - 1, y)]  # N, E, S, W
-
-        # First, get the neighbours
-        for i in neighbouring_cells:
-            bound_checker = self.model.grid.out_of_bounds(i)
-            if not bound_checker:
-                this_cell = self.model.grid.get_cell_list_contents([i])
-                # print("This cell", this_cell)
-                if self.stepCount == 2:
-                    self.n_partners += 1
-
-                if len(this_cell) > 0:
-                    partner = [obj for obj in this_cell
-                               if isinstance(obj, PDAgent)][0]
+        for partner in self.get_partners():
+            partner_ID = partner.ID
+            partner_score = partner.score
+            partner_strategy = partner.strategy
+            partner_move = partner.itermove_result[self.ID]
+            partner_moves = partner.previous_moves
+            partner_mood = sarsa_moody.getMoodType(partner.mood)
+
+            my_move = self.itermove_result[partner_ID]
+
+            # Wanna add each neighbour's move, score etc. to the respective memory banks
+            if self.partner_latest_move.get(partner_ID) is None:
+                self.partner_latest_move[partner_ID] = partner_move
+            else:
+                self.partner_latest_move[partner_ID] = partner_move
+                # this is stupidly redundant but I don't have the current brain energy to fix it
 
-                    partner_ID = partner.ID
-                    partner_score = partner.score
-                    partner_strategy = partner.strategy
-                    partner_move = partner.itermove_result[self.ID]
-                    partner_moves = partner.previous_moves
-                    partner_mood = sarsa_moody.getMoodType(partner.mood)
+            if self.per_partner_utility.get(partner_ID) is None:
+                self.per_partner_utility[partner_ID] = 0
 
-                    my_move = self.itermove_result[partner_ID]
+            if partner_ID not in self.per_partner_payoffs:
+                self.per_partner_payoffs.open(partner_ID, 0)
 
-                    # Wanna add each neighbour's move, score etc. to the respective memory banks
-                    if self.partner_latest_move.get(partner_ID) is None:
-                        self.partner_latest_move[partner_ID] = partner_move
-                    else:
-                        self.partner_latest_move[partner_ID] = partner_move
-                        # this is stupidly redundant but I don't have the current brain energy to fix it
+            if self.pp_payoff.get(partner_ID) is None:
+                self.pp_payoff[partner_ID] = 0
 
-                    if self.per_partner_utility.get(partner_ID) is None:
-                        self.per_partner_utility[partner_ID] = 0
+            if self.per_partner_mcoops.get(partner_ID) is None:
+                self.per_partner_mcoops[partner_ID] = 0
 
-                    if self.per_partner_payoffs.get(partner_ID) is None:
-                        self.per_partner_payoffs[partner_ID] = [0]
+            if self.per_partner_tcoops.get(partner_ID) is None:
+                self.per_partner_tcoops[partner_ID] = 0
 
-                    if self.pp_payoff.get(partner_ID) is None:
-                        self.pp_payoff[partner_ID] = 0
+            if self.per_partner_mutc.get(partner_ID) is None:
+                self.per_partner_mutc[partner_ID] = 0
 
-                    if self.per_partner_mcoops.get(partner_ID) is None:
-                        self.per_partner_mcoops[partner_ID] = 0
+            if self.indivAvPayoff.get(partner_ID) is None:
+                self.indivAvPayoff[partner_ID] = 0
 
-                    if self.per_partner_tcoops.get(partner_ID) is None:
-                        self.per_partner_tcoops[partner_ID] = 0
+            if self.partner_moods.get(partner_ID) is None:
+                self.partner_moods[partner_ID] = "NEUTRAL"
 
-                    if self.per_partner_mutc.get(partner_ID) is None:
-                        self.per_partner_mutc[partner_ID] = 0
+            if self.per_partner_strategies.get(partner_ID) is None:
+                self.per_partner_strategies[partner_ID] = partner_strategy
 
-                    if self.indivAvPayoff.get(partner_ID) is None:
-                        self.indivAvPayoff[partner_ID] = 0
+            if self.update_values.get(partner_ID) is None:  # add in default update value per partner
+                self.update_values[partner_ID] = self.init_uv  # this has to happen before change update value occurs!!
 
-                    if self.partner_moods.get(partner_ID) is None:
-                        self.partner_moods[partner_ID] = "NEUTRAL"
+            # if self.oppAvPayoff.get(partner_ID) is None:
+            #     self.indivAvPayoff[partner_ID] = 0
+            #
+            # if self.myAvPayoff.get(partner_ID) is None:
+            #     self.indivAvPayoff[partner_ID] = 0
+
+            """ Below is the code for adding to and/or updating self.working_memory.
+             if WM does not have a key for current partner's ID in it, we open one
+             if it does, we extract it to a local variable by popping it
+             boobly boo, mess about with it and check what it means for us here
+             after it is updated and checked, we send it back to working memory
+            """
+            current_uv = self.update_value
+
+            if self.strategy == "VPP" or "LEARN":
+                if self.strategy is not "MOODYLEARN":
+                    if self.model.learnFrom != "us":
+                        # working memories are packed window codes (see encoding.py), eldest move first
+                        if self.working_memory.get(partner_ID) is None:
+                            zeroes = encoding.blank_window(self.delta)
+                            # initialise with first value if doesn't exist
+                            self.working_memory[partner_ID] = encoding.shift(zeroes, encoding.encode_move(partner_move),
+                                                                             self.delta)
+                        else:
+                            current_state = self.working_memory.pop(partner_ID)
 
-                    if self.per_partner_strategies.get(partner_ID) is None:
-                        self.per_partner_strategies[partner_ID] = partner_strategy
+                            if self.model.learnFrom == "them":
+                                # we have the updated move list for that partner here
+                                current_state = encoding.shift(current_state, encoding.encode_move(partner_move),
+                                                               self.delta)
+                                current_uv = self.update_values[partner_ID]
 
-                    if self.update_values.get(partner_ID) is None:  # add in default update value per partner
-                        self.update_values[partner_ID] = self.init_uv  # this has to happen before change update value occurs!!
+                                self.update_value = self.update_value + self.change_update_value(current_state)
+                            elif self.model.learnFrom == "me":
+                                current_state = encoding.shift(current_state, encoding.encode_move(my_move), self.delta)
 
-                    # if self.oppAvPayoff.get(partner_ID) is None:
-                    #     self.indivAvPayoff[partner_ID] = 0
-                    #
-                    # if self.myAvPayoff.get(partner_ID) is None:
-                    #     self.indivAvPayoff[partner_ID] = 0
-
-                    """ Below is the code for adding to and/or updating self.working_memory.
-                     if WM does not have a key for current partner's ID in it, we open one
-                     if it does, we extract it to a local variable by popping it
-                     boobly boo, mess about with it and check what it means for us here
-                     after it is updated and checked, we send it back to working memory
-                    """
-                    current_uv = self.update_value
-
-                    if self.strategy == "VPP" or "LEARN":
-                        if self.strategy is not "MOODYLEARN":
-                            if self.model.learnFrom != "us":
-                                if self.working_memory.get(partner_ID) is None:
-                                    zeroes = []
-                                    for j in range(self.delta-1):
-                                        zeroes.append(0)
-                                    zeroes.append(partner_move)
-                                    self.working_memory[partner_ID] = zeroes  # initialise with first value if doesn't exist
-                                else:
-                                    current_state = self.working_memory.pop(partner_ID)
-
-                                    # first, check if it has more than three values
-                                    if len(current_state) < self.delta:  # if list hasn't hit delta, add in new move
-                                        if self.model.learnFrom == "them":
-                                            current_state.append(partner_move)
-                                        elif self.model.learnFrom == "me":
-                                            current_state.append(my_move)
-                                    elif len(current_state) == self.delta:
-                                        current_state.pop(0)
-                                        if self.model.learnFrom == "them":
-                                            current_state.append(partner_move)  # we have the updated move list for that partner here
-                                            current_uv = self.update_values[partner_ID]
-
-                                            self.update_value = self.update_value + self.change_update_value(current_state)
-                                        elif self.model.learnFrom == "me":
-                                            current_state.append(my_move)
-
-                                    # print('My current partner history is now:', current_state)
-                                    self.working_memory[partner_ID] = current_state  # re-instantiate the memory to the bank
-
-                            elif self.model.learnFrom == "us":
-                                if self.working_memory.get(partner_ID) is None:
-                                    zeroes = []
-                                    if self.delta > 1:
-                                        for j in range(self.delta-1):
-                                            zeroes.append((0,0))
-                                    # print('mm', my_move, 'pm', partner_move)
-                                    zeroes.append((my_move, partner_move))
-                                    self.working_memory[partner_ID] = zeroes
-                                else:
-                                    current_state = self.working_memory.pop(partner_ID)
-                                    # print('mmm', my_move, 'pmm', partner_move)
-                                    # print('len cs:', len(current_state), 'del', self.delta)
-                                    if len(current_state) < self.delta:
-                                        current_state.append((my_move, partner_move))
-                                    elif len(current_state) == self.delta:
-                                        current_state.pop(0)
-                                        current_state.append((my_move, partner_move))
-                                    self.working_memory[partner_ID] = current_state
-
-                                    # self.update_value = self.update_value + self.change_update_value(current_state)
-                                    # TODO: Change the above so it doesn't need to work on just 7-count opponent values
-
-                    if self.strategy == "MOODYLEARN":
-                        self.partner_moods[partner_ID] = partner_mood
-                        if self.model.moody_learnFrom != "us":
-                            if self.working_memory.get(partner_ID) is None:
-                                zeroes = []
-                                for j in range(self.moody_delta-1):
-                                    zeroes.append(0)
-                                zeroes.append(sarsa_moody.get_payoff(my_move, partner_move, self.model.CC, self.model.DD, self.model.CD, self.model.DC))
-                                self.working_memory[partner_ID] = zeroes  # initialise with first value if doesn't exist
-                            else:
-                                current_state = self.working_memory.pop(partner_ID)
-
-                                # first, check if it has more than three values
-                                if len(current_state) < self.moody_delta:  # if list hasn't hit delta, add in new move
-                                    if self.model.moody_learnFrom == "them":
-                                        current_state.append(sarsa_moody.get_payoff(my_move, partner_move, self.model.CC, self.model.DD, self.model.CD, self.model.DC))
-                                    # elif self.model.moody_learnFrom == "me":
-                                    #     current_state.append(my_move)
-                                elif len(current_state) == self.moody_delta:
-                                    current_state.pop(0)
-                                    if self.model.moody_learnFrom == "them":
-                                        current_state.append(sarsa_moody.get_payoff(my_move, partner_move, self.model.CC, self.model.DD, self.model.CD, self.model.DC))
-                                        current_uv = self.update_values[partner_ID]
-
-                                        self.update_value = self.update_value + self.change_update_value(current_state)
-                                    # elif self.model.moody_learnFrom == "me":
-                                    #     current_state.append(my_move)
-
-                                # print('My current partner history is now:', current_state)
-                                self.working_memory[partner_ID] = current_state  # re-instantiate the memory to the bank
-                                self.partner_states[partner_ID] = sarsa_moody.observe_state(partner_move,
-                                                                                                       partner_ID,
-                                                                                                       partner_mood,
-                                                                                                       self.statemode)
-                        # get the current state, action
-                        # check the payoff for this round, add it to the state-action list if it isn't over delta
-
-                        state = sarsa_moody.observe_state(partner_move, partner_ID, partner_mood, self.model.moody_statemode)
-                        action = my_move
-                        stateMem = self.state_working_memory[tuple(state)]
-                        # print('stateMem', stateMem)
-                        if action == 'C':
-                            stateActionMem = stateMem[0]
+                            # print('My current partner history is now:', current_state)
+                            self.working_memory[partner_ID] = current_state  # re-instantiate the memory to the bank
+
+                    elif self.model.learnFrom == "us":
+                        # print('mm', my_move, 'pm', partner_move)
+                        if self.delta == 1:
+                            # a memory of one is just the bare (my move, their move) pair
+                            self.working_memory[partner_ID] = encoding.window_code(
+                                [encoding.encode_move(my_move), encoding.encode_move(partner_move)])
                         else:
-                            stateActionMem = stateMem[1]
-
-                        # At this point (after initialisation) we have the list we want to edit
-                        if stateActionMem is None:
-                            zeroes = []
-                            for j in range(self.moody_delta - 1):
-                                zeroes.append(0)
-                            zeroes.append(sarsa_moody.get_payoff(my_move, partner_move, self.model.CC, self.model.DD,
-                                                                 self.model.CD, self.model.DC))
-
-                            stateActionMem = zeroes  # initialise with first value if doesn't exist
-                            if action == 'C':
-                                stateMem[0] = stateActionMem
-                            else:
-                                stateMem[1] = stateActionMem
+                            current_state = self.working_memory.get(partner_ID)
+                            if current_state is None:
+                                current_state = encoding.blank_window(self.delta, True)
+                            self.working_memory[partner_ID] = encoding.shift(
+                                current_state, encoding.pair_digit(my_move, partner_move), self.delta, 9)
+
+                            # self.update_value = self.update_value + self.change_update_value(current_state)
+                            # TODO: Change the above so it doesn't need to work on just 7-count opponent values
+
+            if self.strategy == "MOODYLEARN":
+                self.partner_moods[partner_ID] = partner_mood
+                if self.model.moody_learnFrom != "us":
+                    if self.working_memory.get(partner_ID) is None:
+                        zeroes = []
+                        for j in range(self.moody_delta-1):
+                            zeroes.append(0)
+                        zeroes.append(sarsa_moody.get_payoff(my_move, partner_move, self.model.CC, self.model.DD, self.model.CD, self.model.DC))
+                        self.working_memory[partner_ID] = zeroes  # initialise with first value if doesn't exist
+                    else:
+                        current_state = self.working_memory.pop(partner_ID)
+
+                        # first, check if it has more than three values
+                        if len(current_state) < self.moody_delta:  # if list hasn't hit delta, add in new move
+                            if self.model.moody_learnFrom == "them":
+                                current_state.append(sarsa_moody.get_payoff(my_move, partner_move, self.model.CC, self.model.DD, self.model.CD, self.model.DC))
+                            # elif self.model.moody_learnFrom == "me":
+                            #     current_state.append(my_move)
+                        elif len(current_state) == self.moody_delta:
+                            current_state.pop(0)
+                            if self.model.moody_learnFrom == "them":
+                                current_state.append(sarsa_moody.get_payoff(my_move, partner_move, self.model.CC, self.model.DD, self.model.CD, self.model.DC))
+                                current_uv = self.update_values[partner_ID]
+
+                                self.update_value = self.update_value + self.change_update_value(
+                                    encoding.payoff_window_code(current_state))
+                            # elif self.model.moody_learnFrom == "me":
+                            #     current_state.append(my_move)
+
+                        # print('My current partner history is now:', current_state)
+                        self.working_memory[partner_ID] = current_state  # re-instantiate the memory to the bank
+                        self.partner_states[partner_ID] = sarsa_moody.observe_state(partner_move,
+                                                                                               partner_ID,
+                                                                                               partner_mood,
+                                                                                               self.statemode,
+                                                                                               self.model.number_of_agents)
+                # get the current state, action
+                # check the payoff for this round, add it to the state-action list if it isn't over delta
+
+                state = sarsa_moody.observe_state(partner_move, partner_ID, partner_mood, self.model.moody_statemode,
+                                                  self.model.number_of_agents)
+                action = my_move
+                stateMem = self.state_working_memory[state]
+                # print('stateMem', stateMem)
+                if action == 'C':
+                    stateActionMem = stateMem[0]
+                else:
+                    stateActionMem = stateMem[1]
 
-                            self.state_working_memory[tuple(state)] = stateMem
+                # At this point (after initialisation) we have the list we want to edit
+                if stateActionMem is None:
+                    zeroes = []
+                    for j in range(self.moody_delta - 1):
+                        zeroes.append(0)
+                    zeroes.append(sarsa_moody.get_payoff(my_move, partner_move, self.model.CC, self.model.DD,
+                                                         self.model.CD, self.model.DC))
+
+                    stateActionMem = zeroes  # initialise with first value if doesn't exist
+                    if action == 'C':
+                        stateMem[0] = stateActionMem
+                    else:
+                        stateMem[1] = stateActionMem
 
-                        else:
-                            current_state = stateActionMem
-                            # print('stateActionMem', stateActionMem)
-                            # first, check if it has more than three values
-                            if len(current_state) < self.moody_delta:  # if list hasn't hit delta, add in new move
-                                if self.model.moody_learnFrom == "them":
-                                    current_state.append(
-                                        sarsa_moody.get_payoff(my_move, partner_move, self.model.CC, self.model.DD,
-                                                               self.model.CD, self.model.DC))
-                                # elif self.model.moody_learnFrom == "me":
-                                #     current_state.append(my_move)
-                            elif len(current_state) == self.moody_delta:
-                                current_state.pop(0)
-                                if self.model.moody_learnFrom == "them":
-                                    current_state.append(
-                                        sarsa_moody.get_payoff(my_move, partner_move, self.model.CC, self.model.DD,
-                                                               self.model.CD, self.model.DC))
-                                    current_uv = self.update_values[partner_ID]
-
-                                    self.update_value = self.update_value + self.change_update_value(current_state)
-                                # elif self.model.moody_learnFrom == "me":
-                                #     current_state.append(my_move)
+                    self.state_working_memory[state] = stateMem
 
-                            # print('My current partner history is now:', current_state)
-                            stateActionMem = current_state
-                            if action == 'C':
-                                stateMem[0] = stateActionMem
-                            else:
-                                stateMem[1] = stateActionMem
-
-                            self.state_working_memory[tuple(state)] = stateMem
-                            # print('mem for that (s,a) is:', self.state_working_memory[tuple(state)])
-
-                        # elif self.model.moody_learnFrom == "us":
-                        #     if self.working_memory.get(partner_ID) is None:
-                        #         zeroes = []
-                        #         if self.moody_delta > 1:
-                        #             for j in range(self.moody_delta-1):
-                        #                 zeroes.append((0,0))
-                        #         # print('mm', my_move, 'pm', partner_move)
-                        #         zeroes.append((my_move, partner_move))
-                        #         self.working_memory[partner_ID] = zeroes
-                        #     else:
-                        #         current_state = self.working_memory.pop(partner_ID)
-                        #         # print('mmm', my_move, 'pmm', partner_move)
-                        #         # print('len cs:', len(current_state), 'del', self.delta)
-                        #         if len(current_state) < self.moody_delta:
-                        #             current_state.append((my_move, partner_move))
-                        #         elif len(current_state) == self.moody_delta:
-                        #             current_state.pop(0)
-                        #             current_state.append((my_move, partner_move))
-                        #         self.working_memory[partner_ID] = current_state
-
-                                # self.update_value = self.update_value + self.change_update_value(current_state)
-
-                    """" ======================================================================================== """
-
-                    # First, check if we have a case file on them in each memory slot
-                    if self.partner_moves.get(partner_ID) is None:  # if we don't have one for this partner, make one
-                        self.partner_moves[partner_ID] = []
-                        self.partner_moves[partner_ID].append(partner_move)
+                else:
+                    current_state = stateActionMem
+                    # print('stateActionMem', stateActionMem)
+                    # first, check if it has more than three values
+                    if len(current_state) < self.moody_delta:  # if list hasn't hit delta, add in new move
+                        if self.model.moody_learnFrom == "them":
+                            current_state.append(
+                                sarsa_moody.get_payoff(my_move, partner_move, self.model.CC, self.model.DD,
+                                                       self.model.CD, self.model.DC))
+                        # elif self.model.moody_learnFrom == "me":
+                        #     current_state.append(my_move)
+                    elif len(current_state) == self.moody_delta:
+                        current_state.pop(0)
+                        if self.model.moody_learnFrom == "them":
+                            current_state.append(
+                                sarsa_moody.get_payoff(my_move, partner_move, self.model.CC, self.model.DD,
+                                                       self.model.CD, self.model.DC))
+                            current_uv = self.update_values[partner_ID]
+
+                            self.update_value = self.update_value + self.change_update_value(
+                                encoding.payoff_window_code(current_state))
+                        # elif self.model.moody_learnFrom == "me":
+                        #     current_state.append(my_move)
+
+                    # print('My current partner history is now:', current_state)
+                    stateActionMem = current_state
+                    if action == 'C':
+                        stateMem[0] = stateActionMem
                     else:
-                        self.partner_moves[partner_ID].append(partner_move)
-                        """ We should repeat the above process for the other memory fields too, like 
-                        partner's gathered utility """
-
-                    if partner_ID not in self.partner_IDs:
-                        self.partner_IDs.append(partner_ID)
+                        stateMem[1] = stateActionMem
+
+                    self.state_working_memory[state] = stateMem
+                    # print('mem for that (s,a) is:', self.state_working_memory[state])
+
+                # elif self.model.moody_learnFrom == "us":
+                #     if self.working_memory.get(partner_ID) is None:
+                #         zeroes = []
+                #         if self.moody_delta > 1:
+                #             for j in range(self.moody_delta-1):
+                #                 zeroes.append((0,0))
+                #         # print('mm', my_move, 'pm', partner_move)
+                #         zeroes.append((my_move, partner_move))
+                #         self.working_memory[partner_ID] = zeroes
+                #     else:
+                #         current_state = self.working_memory.pop(partner_ID)
+                #         # print('mmm', my_move, 'pmm', partner_move)
+                #         # print('len cs:', len(current_state), 'del', self.delta)
+                #         if len(current_state) < self.moody_delta:
+                #             current_state.append((my_move, partner_move))
+                #         elif len(current_state) == self.moody_delta:
+                #             current_state.pop(0)
+                #             current_state.append((my_move, partner_move))
+                #         self.working_memory[partner_ID] = current_state
+
+                        # self.update_value = self.update_value + self.change_update_value(current_state)
+
+            """" ======================================================================================== """
+
+            if partner_ID not in self.partner_IDs:
+                self.partner_IDs.append(partner_ID)
 
     def increment_score(self, payoffs):
         total_utility = 0
@@ -1211,7 +1110,7 @@ class PDAgent(Agent):
             outcome_payoff = payoffs[my_move, this_partner_move]
             # print("Outcome with partner %i was:" % i, outcome)
 
-            self.per_partner_payoffs[i].append(outcome_payoff)
+            self.per_partner_payoffs.add(i, outcome_payoff)
             if self.strategy == "LEARN":
                 self.pp_payoff[i] = outcome_payoff
             elif self.strategy == "MOODYLEARN":
@@ -1219,7 +1118,7 @@ class PDAgent(Agent):
                 self.moody_pp_oppPayoff[i] = payoffs[this_partner_move, my_move]
 
             self.pp_oppPayoff[i] = payoffs[this_partner_move, my_move]
-            self.indivAvPayoff[i] = statistics.mean(self.per_partner_payoffs[i])
+            self.indivAvPayoff[i] = self.per_partner_payoffs.mean(i)
             # print("My individual average payoff for partner", i, "is ", self.indivAvPayoff[i])
 
             # ------- Here is where we change variables based on the outcome -------
@@ -1256,11 +1155,8 @@ class PDAgent(Agent):
         self.outcome_list = outcome_listicle
 
         """ Here, we want to increment the GLOBAL, across-partner average payoff for the round """
-        round_average = []
-        for j in self.indivAvPayoff:
-            item = self.indivAvPayoff[j]
-            round_average.append(item)
-        self.globalAvPayoff = statistics.mean(round_average)
+        # at most four partners, so this is a constant-time sum rather than a mean over any history
+        self.globalAvPayoff = sum(self.indivAvPayoff.values()) / len(self.indivAvPayoff)
 
         if self.globalAvPayoff > self.globalHighPayoff:
             self.globalHighPayoff = self.globalAvPayoff
@@ -1279,17 +1175,40 @@ class PDAgent(Agent):
 
         self.model.number_of_defects += self.number_of_d
         self.model.number_of_coops += self.number_of_c
+        self.model.strategy_totals.played(self.strategy, self.number_of_c, self.number_of_d, self.mutual_c_outcome)
 
         self.model.agent_list.append('{}, {}'.format(self.ID, self.strategy))
 
         # and also time each agent's step to create a total time thingybob
 
+    def readable_working_memory(self):
+        """ Working memories are kept as packed codes - this unpacks them back to the lists of moves they used to be,
+            for output """
+        readable = {}
+        for i in self.working_memory:
+            moves = list(encoding.decode_state(self.working_memory[i]))
+            if self.model.learnFrom == "us" and self.delta == 1:
+                moves = [tuple(moves)]
+            readable[i] = moves
+        return readable
+
+    def readable_partner_states(self):
+        readable = {}
+        for i in self.partner_states:
+            readable[i] = encoding.decode_moody_state(self.partner_states[i], self.statemode,
+                                                      self.model.number_of_agents)
+        return readable
+
     def output_data_to_file(self, outcomes):
-        """ Outputs the data collected each turn on multiple agent variables to a .csv file"""
+        """ Outputs the data collected each turn on multiple agent variables to the run's agent .csv file"""
         for m in self.per_partner_strategies:
             if self.per_partner_strategies[m] == self.strategy:
                 self.similar_partners += 1
 
+        if self.model.telemetry_format == "npz":  # typed columns, a row per partner - see telemetry.EdgeTelemetry
+            self.model.telemetry.add_edges(self, outcomes)
+            return
+
         prob_list = []
         util_list = []
         move_list = []
@@ -1459,137 +1378,51 @@ class PDAgent(Agent):
             strategy_code = 8
         elif self.strategy == "MOODYLEARN":
             strategy_code = 9
+        elif self.strategy == "iWSLS":
+            strategy_code = 10
 
         """ The above will error catch for when agents don't have those values, and will still let us print 
             to csv. **** WOULD ALSO LIKE TO DO THIS FOR MOVE PER PARTNER """
 
-        #TODO: FIX DATA OUTPUTTING PLEASE?
+        # the model buffers everyone's rows and writes them out together, see telemetry.py
+        row = {'stepcount': self.stepCount,
+               'strategy': self.strategy,
+               'strat code': strategy_code,
+               'move': self.itermove_result,
+               'probabilities': self.ppD_partner,
+               'utility': self.score,
+               'common_move': self.common_move,
+               'number_coop': self.number_of_c,
+               'number_defect': self.number_of_d,
+               'outcomes': outcomes,
+               'u1': utility_partner_1,
+               'u2': utility_partner_2,
+               'u3': utility_partner_3,
+               'u4': utility_partner_4,
+               'm1': move_partner_1,
+               'm2': move_partner_2,
+               'm3': move_partner_3,
+               'm4': move_partner_4,
+               'uv': self.update_value,
+               'nc': self.number_of_c,
+               'mutC': self.mutual_c_outcome,
+               'simP': self.similar_partners,
+               'avp1': avpay_partner_1,
+               'avp2': avpay_partner_2,
+               'avp3': avpay_partner_3,
+               'avp4': avpay_partner_4,
+               'globav': self.globalAvPayoff,
+               'mood': self.mood,
+               'sensitivity': self.sensitivity_mod}
         if self.strategy == "MOODYLEARN":
-            try:
-                self.attempts_taken += 1
-                with open('{}.csv'.format(self.filename), 'a', newline='') as csvfile:
-                    fieldnames = ['stepcount_%d' % self.ID, 'strategy_%d' % self.ID, 'strat code_%d' % self.ID,
-                                  'move_%d' % self.ID,
-                                  'probabilities_%d' % self.ID, 'utility_%d' % self.ID, 'common_move_%d' % self.ID,
-                                  'number_coop_%d' % self.ID, 'number_defect_%d' % self.ID,
-                                  'outcomes_%d' % self.ID,
-                                  #'p1_%d' % self.ID, 'p2_%d' % self.ID, 'p3_%d' % self.ID, 'p4_%d' % self.ID,
-                                  'u1_%d' % self.ID,
-                                  'u2_%d' % self.ID,
-                                  'u3_%d' % self.ID,
-                                  'u4_%d' % self.ID,
-                                  'm1_%d' % self.ID, 'm2_%d' % self.ID, 'm3_%d' % self.ID, 'm4_%d' % self.ID,
-                                  'uv_%d' % self.ID,
-                                  'ps_%d' % self.ID, 'nc_%d' % self.ID, 'mutC_%d' % self.ID, 'simP_%d' % self.ID,
-                                  'avp1_%d' % self.ID, 'avp2_%d' % self.ID, 'avp3_%d' % self.ID, 'avp4_%d' % self.ID,
-                                  'globav_%d' % self.ID, 'epsilon_%d' % self.ID, 'alpha_%d' % self.ID, 'mood_%d' % self.ID,
-                                  'sensitivity_%d' % self.ID]
-
-                    writer = csv.DictWriter(csvfile, fieldnames=fieldnames)
-
-                    # moves = []
-                    # for i in self.move:
-                    #     moves.append(self.move[i])
-
-                    if self.stepCount == 1:
-                        writer.writeheader()
-
-                    writer.writerow(
-                        {'stepcount_%d' % self.ID: self.stepCount,
-                         'strategy_%d' % self.ID: self.strategy,
-                         'strat code_%d' % self.ID: strategy_code,
-                         'move_%d' % self.ID: self.itermove_result,
-                         'probabilities_%d' % self.ID: self.ppD_partner,
-                         'utility_%d' % self.ID: self.score,
-                         'common_move_%d' % self.ID: self.common_move,
-                         'number_coop_%d' % self.ID: self.number_of_c,
-                         'number_defect_%d' % self.ID: self.number_of_d,
-                         'outcomes_%d' % self.ID: outcomes,
-                         'u1_%d' % self.ID: utility_partner_1,
-                         'u2_%d' % self.ID: utility_partner_2,
-                         'u3_%d' % self.ID: utility_partner_3,
-                         'u4_%d' % self.ID: utility_partner_4,
-                         'm1_%d' % self.ID: move_partner_1,
-                         'm2_%d' % self.ID: move_partner_2,
-                         'm3_%d' % self.ID: move_partner_3,
-                         'm4_%d' % self.ID: move_partner_4,
-                         'uv_%d' % self.ID: self.update_value,
-                         'ps_%d' % self.ID: self.partner_states,
-                         'nc_%d' % self.ID: self.number_of_c,
-                         'mutC_%d' % self.ID: self.mutual_c_outcome,
-                         'simP_%d' % self.ID: self.similar_partners,
-                         'avp1_%d' % self.ID: avpay_partner_1,
-                         'avp2_%d' % self.ID: avpay_partner_2,
-                         'avp3_%d' % self.ID: avpay_partner_3,
-                         'avp4_%d' % self.ID: avpay_partner_4,
-                         'globav_%d' % self.ID: self.globalAvPayoff,
-                         'epsilon_%d' % self.ID: self.moody_epsilon,
-                         'alpha_%d' % self.ID: self.moody_alpha,
-                         'mood_%d' % self.ID: self.mood,
-                         'sensitivity_%d' % self.ID: self.sensitivity_mod})
-            except PermissionError:
-                self.output_data_to_file(self.outcome_list)
-
+            row['ps'] = self.readable_partner_states()
+            row['epsilon'] = self.moody_epsilon
+            row['alpha'] = self.moody_alpha
         else:
-            try:
-                with open('{}.csv'.format(self.filename), 'a', newline='') as csvfile:
-                    fieldnames = ['stepcount_%d' % self.ID, 'strategy_%d' % self.ID, 'strat code_%d' % self.ID,
-                                  'move_%d' % self.ID, 'probabilities_%d' % self.ID,
-                                  'utility_%d' % self.ID, 'common_move_%d' % self.ID, 'number_coop_%d' % self.ID,
-                                  'number_defect_%d' % self.ID,
-                                  'outcomes_%d' % self.ID, 'u1_%d' % self.ID, 'u2_%d' % self.ID, 'u3_%d' % self.ID,
-                                  'u4_%d' % self.ID, 'm1_%d' % self.ID, 'm2_%d' % self.ID, 'm3_%d' % self.ID,
-                                  'm4_%d' % self.ID, 'uv_%d' % self.ID,
-                                  'wm_%d' % self.ID, 'nc_%d' % self.ID, 'mutC_%d' % self.ID, 'simP_%d' % self.ID,
-                                  'avp1_%d' % self.ID, 'avp2_%d' % self.ID, 'avp3_%d' % self.ID, 'avp4_%d' % self.ID,
-                                  'globav_%d' % self.ID, 'epsilon_%d' % self.ID, 'alpha_%d' % self.ID, 'mood_%d' % self.ID,
-                                  'sensitivity_%d' % self.ID]
-
-                    writer = csv.DictWriter(csvfile, fieldnames=fieldnames)
-
-                    # moves = []
-                    # for i in self.move:
-                    #     moves.append(self.move[i])
-
-                    if self.stepCount == 1:
-                        writer.writeheader()
-
-                    writer.writerow(
-                        {'stepcount_%d' % self.ID: self.stepCount,
-                         'strategy_%d' % self.ID: self.strategy,
-                         'strat code_%d' % self.ID: strategy_code,
-                         'move_%d' % self.ID: self.itermove_result,
-                         'probabilities_%d' % self.ID: self.ppD_partner,
-                         'utility_%d' % self.ID: self.score,
-                         'common_move_%d' % self.ID: self.common_move,
-                         'number_coop_%d' % self.ID: self.number_of_c,
-                         'number_defect_%d' % self.ID: self.number_of_d,
-                         'outcomes_%d' % self.ID: outcomes,
-                         'u1_%d' % self.ID: utility_partner_1,
-                         'u2_%d' % self.ID: utility_partner_2,
-                         'u3_%d' % self.ID: utility_partner_3,
-                         'u4_%d' % self.ID: utility_partner_4,
-                         'm1_%d' % self.ID: move_partner_1,
-                         'm2_%d' % self.ID: move_partner_2,
-                         'm3_%d' % self.ID: move_partner_3,
-                         'm4_%d' % self.ID: move_partner_4,
-                         'uv_%d' % self.ID: self.update_value,
-                         'wm_%d' % self.ID: self.working_memory,
-                         'nc_%d' % self.ID: self.number_of_c,
-                         'mutC_%d' % self.ID: self.mutual_c_outcome,
-                         'simP_%d' % self.ID: self.similar_partners,
-                         'avp1_%d' % self.ID: avpay_partner_1,
-                         'avp2_%d' % self.ID: avpay_partner_2,
-                         'avp3_%d' % self.ID: avpay_partner_3,
-                         'avp4_%d' % self.ID: avpay_partner_4,
-                         'globav_%d' % self.ID: self.globalAvPayoff,
-                         'epsilon_%d' % self.ID: self.epsilon,
-                         'alpha_%d' % self.ID: self.alpha,
-                         'mood_%d' % self.ID: self.mood,
-                         'sensitivity_%d' % self.ID: self.sensitivity_mod})
-            except PermissionError:
-                self.output_data_to_file(self.outcome_list)
-
+            row['wm'] = self.readable_working_memory()
+            row['epsilon'] = self.epsilon
+            row['alpha'] = self.alpha
+        self.model.telemetry.add(self.ID, row)
 
     def reset_values(self):
         """ Resets relevant global variables to default values. """
@@ -1600,34 +1433,37 @@ class PDAgent(Agent):
 
     # TODO: Move all the kNN stuff to a separate script that we just reference
 
-    def knn_decision(self, partner_ids, partner_utils, partner_selfcoops, partner_oppcoops, partner_mutcoops, ppds):
+    def knn_samples(self, partner_ids, partner_utils, partner_selfcoops, partner_oppcoops, partner_mutcoops, ppds):
+        """ What we know about each partner, as knn.Classifier compares it to the training data """
+        return [[partner_utils[i], partner_selfcoops[i], partner_oppcoops[i], partner_mutcoops[i], ppds[i]]
+                for i in partner_ids]
+
+    def knn_decision(self, partner_ids, partner_utils, partner_selfcoops, partner_oppcoops, partner_mutcoops, ppds,
+                     classes=None):
 
-        """ ppds needs to be self.model.agent_ppds"""
+        """ ppds needs to be self.model.agent_ppds. classes are the (class list, classification) for each partner
+            if they've already been worked out, e.g. for the whole population at once by knn.Classifier """
         updated_ppds = []
         old_ppds = self.model.agent_ppds[self.ID]
         # print("The old ppds are", old_ppds)
 
         updated_ppds = old_ppds
-        training_data = copy.deepcopy(self.model.training_data)
-        # print(len(training_data))
-        decision_data = copy.deepcopy(self.model.training_data)
-
-        for i in partner_ids:
-            # training_data_list = training_data
-            partner_index = partner_ids.index(i)
-            game_utility = partner_utils[i]
-            game_selfcoops = partner_selfcoops[i]
-            game_oppcoops = partner_oppcoops[i]
-            game_mutcoops = partner_mutcoops[i]
-            game_ppd = ppds[i]
+        # the training set is shared and read-only (see knn.py), so neither search needs its own copy
+        training_data = knn.training_set(self.model.training_data_file)
+        decision_data = training_data
 
+        if classes is None:
+            # every partner in one go
+            classes = knn.classifier(training_data).classify_many(
+                self.knn_samples(partner_ids, partner_utils, partner_selfcoops, partner_oppcoops, partner_mutcoops,
+                                 ppds), self.model.k)
+
+        for partner_index, i in enumerate(partner_ids):
             """ The bit above might not work; because when we get ppds from the model it's a 4-long list,
                 and some agents only use the first 2 to 3 items, we need to update the ppds in the list by 
                 their indices to let them be used against the same agent next game"""
 
-            class_list, classification = self.knn_analysis(game_utility, game_selfcoops, game_oppcoops, game_mutcoops,
-                                                           game_ppd, training_data,
-                                                           self.model.k)
+            class_list, classification = classes[partner_index]
             priority = "U"
 
             # print("My ID:", self.ID,
@@ -1640,7 +1476,8 @@ class PDAgent(Agent):
             # so far, we should have a knn classification of what the ith partner is, which we then feed in to
             new_ppd = self.ppd_select(decision_data, classification, priority)
 
-            updated_ppds[partner_index] = new_ppd
+            if new_ppd is not None:  # no training data for this class, so we keep what we had
+                updated_ppds[partner_index] = new_ppd
 
         # print("The Old ppds were:", old_ppds)
         # print("The new ppds are", updated_ppds)
@@ -1670,170 +1507,12 @@ class PDAgent(Agent):
             self.model.kNN_accuracy += 1
             return "Right"
 
-    def BinaryPPDSearch(self, list, value, n_times, indx):
-        """ This should return a list of indexes to search the data with """
-
-        copy_list = copy.deepcopy(list)
-        # print("bsearchinput", len(list), value, n_times, indx)
-        # index_list = []
-        data_list = []
-        n_times = int(n_times)
-
-        for i in range(0, n_times):     # would alternatively prefer this to be a while loop
-            index = self.BSearch(copy_list, value, indx)  # get the index of the ppd item
-            # print("I found an index, it's", index)
-            # print(len(copy_list))
-            if index != -1:
-                # index_list.append(index)  # index list is garbage because of popping
-                # print("The item is", copy_list[index])
-                data_list.append(copy_list[index])
-                # print("I appended it and the list now has", len(data_list), "items")
-                # copy_list[index] = [0, 0, 0.0, 0]
-                copy_list.pop(index)
-                # print("I removed it")
-            else:
-                copy_list.pop(index)
-
-        """ So, could we improve this by running the Search function indefinitely until it can no longer 
-            find the value we're looking for? """
-        # print("agent", self.ID, "index:",indx,"bsearch output", data_list)
-        return data_list
-
-    def BSearch(self, lys, val, indx_value):
-        first = 0
-        last = len(lys) - 1
-        index = -1
-        while (first <= last) and (index == -1):
-            mid = (first + last) // 2
-            if lys[mid][indx_value] == val:
-                index = mid
-            else:
-                if val < lys[mid][indx_value]:
-                    last = mid - 1
-                else:
-                    first = mid + 1
-        return index
-
-    def knn_analysis(self, utility, selfcoops, oppcoops, mutcoops, ppd, training_data, k):
-        """ Takes an input, checks it against training data, and returns a partner classification """
-        classification = 1  # CLASSES START AT 1 INSTEAD OF 0 BECAUSE IM A FOOL
-        # print("Initialising knn analysis")
-        current_data = [utility, selfcoops, oppcoops, mutcoops, ppd]
-        current_data2 = [utility, selfcoops, ppd]
-        # print(current_data)
-        # print(len(training_data), type(training_data))
-
-        relevant_data = []
-        r_data_indices = []
-        r_data_distances_to_goal = []
-
-        # for i in training_data:
-        #     """ We'll just use standard linear search for now, and maybe implement something faster later"""
-        #     # get the third index of i
-        #     if i[2] == ppd:
-        #         relevant_data.append(i)
-        #         r_data_indices.append(training_data.index(i))
-
-        # For Binary Search, we need to know how many times to search the list - I think with the 113,400 data
-        # it's 12,600 data points per ppd we collected
-        # print("gonna do binary search with ppd of", ppd)
-        training_size = len(training_data)
-        relevant_data = self.BinaryPPDSearch(training_data, ppd, (training_size/3), 4)
-
-        # print("rd", relevant_data)
-        # can't get the indices from this, nor replace properly - but we don't need indices for a later search
-        # because the search for optimal values will be a separate search
-
-        for i in relevant_data:
-            """ We take each item and calculate the Euclidean distance to the data we already have"""
-            slice = i[:5]   #  =========== THIS MIGHT NEED TO BE 5 =======
-            slice2 = [i[0], i[1], i[5]]
-            distance_to_target = dst.cosine(current_data, slice)
-            # print("data:", i, "distance:", distance_to_target)
-            r_data_distances_to_goal.append(distance_to_target)
-
-        # print("rel data", relevant_data)
-        # print("distances", r_data_distances_to_goal)
-
-        """ Now we have a list of distances to our current dataset, need to select k closest in terms of utility 
-        and cooperations. Then access the relevant data and find the classification values ( i[3]) for them. """
-
-        # sorted_distances = {k: v for k, v in sorted(r_data_distances_to_goal.items(), key=lambda item: item[1])}
-        # # this may or may not work, it's a method taken from elsewhere...
-
-        #
-        ascending_data = sorted(zip(relevant_data, r_data_distances_to_goal), key=lambda t: t[1])[0:]
-        # print("ass data", ascending_data)
-        # print("ascend", ascending_data)
-        # print(len(ascending_data))
-        categories = []
-
-        for i in range(0, k):
-            # print("ass data2", ascending_data)
-            temp = ascending_data[i]
-            categories.append(temp[0][5])
-
-        """Then, we find the most common category offered and return it. """
-        # print("The k closest categories were:", categories)
-        try:
-            classification = statistics.mode(categories)
-        except statistics.StatisticsError:
-            classification = categories[0]
-            # classification = statistics.mode(categories[0])
-
-            # tryk = copy.deepcopy(k)
-            # tryk = int((tryk/2)-1)
-
-            # for i in range(0, tryk):
-            #     # print("ass data2", ascending_data)
-            #     temp = ascending_data[i]
-            #     categories.append(temp[0][3])
-
-            # classification = statistics.mode(categories)
-
-            # if k < 3:
-            #     classification = statistics.mode(categories[0])
-            # if k > 3:
-            #     classification = statistics.mode(categories[0:5])
-        # print("The most common classification from the k neighbours is:", classification)
-        # TODO - in future might want to weight each neighbour by closeness
-        return categories, classification
-
     def ppd_select(self, list, classification, optimisation_choice):
         """ Takes a class of partner, given by the kNN algorithm, and returns a starting ppD to
         use in future games for the same partner based on which variable (or combo) we want to optimise """
-        # don't need to make a deep copy of this list, because we're not altering it
-        # print("pdsel", list, classification, optimisation_choice)
-        # relevant_data = []
-
-        relevant_data = self.BinaryPPDSearch(list,
-                                             classification,
-                                             (len(list)), 5)  # need to decide how many times to run this for
-        npRev = np.array(relevant_data)
-        # if len(npRev) == 0:
-            # print("I'm agent", self.ID, "and ", len(list), classification, optimisation_choice, len(relevant_data))
-            # print("npRev empty")
-
-        col = 0
-        if optimisation_choice == 'MC':  # optimise for MY cooperation
-            col = 1
-        elif optimisation_choice == 'U':  # optimise to maximise utility
-            col = 0
-        elif optimisation_choice == 'OC':
-            col = 2
-        elif optimisation_choice == 'MutC':
-            col = 3
-
-        npRev = npRev[np.argsort(npRev[:, col])]
-        npRev = np.ndarray.tolist(npRev)
-        # so, now we have a list sorted by the column we prefer, we can select the ppD associated with the highest score
-        # print("checking npRev", npRev)
-
-        highest = npRev[len(npRev)-1]
-        new_ppd = highest[4]
-        # print("I'm agent", self.ID, "My partner's class is", classification, "and the ppd I should use for them is", new_ppd)
-
-        return new_ppd
+        # the answer only depends on the class and choice, so it's looked up in a table made when list was loaded:
+        # 'U' maximises utility, 'MC' my cooperation, 'OC' my partner's cooperation, 'MutC' mutual cooperation
+        return knn.ppd_table(list).select(classification, optimisation_choice)
 
     def find_average_move(self):
         """ Counts up how many of each behaviour type was performed that round and returns which was
@@ -1878,21 +1557,10 @@ class PDAgent(Agent):
                     qvalues.append(j)
 
             # for each numerical value in it, append it to a new list
-            # for each item in that list, open up the csv and print it to it
-        if init:
-            for i in qvalues:
-                with open('{} qinit_agent37.csv'.format(self.model.filename), 'a', newline='') as csvfile:
-                    fieldnames = ['q']
-                    writer = csv.DictWriter(csvfile, fieldnames=fieldnames)
-                    # writer.writeheader()
-                    writer.writerow({'q': i})
-        else:
-            for i in qvalues:
-                with open('{} qend_agent37.csv'.format(self.model.filename), 'a', newline='') as csvfile:
-                    fieldnames = ['q']
-                    writer = csv.DictWriter(csvfile, fieldnames=fieldnames)
-                    # writer.writeheader()
-                    writer.writerow({'q': i})
+            # and hand them all to the model's output writer at once
+            name = '{} qinit_agent37.csv' if init else '{} qend_agent37.csv'
+            self.model.output.submit(telemetry.write_rows, name.format(self.model.filename), ['q'],
+                                     [{'q': i} for i in qvalues], False)
 
     def outputData(self):
         self.output_data_to_model()
@@ -1903,38 +1571,11 @@ class PDAgent(Agent):
             self.attempts_taken = 0
 
     def set_starting_oldstates(self, strategy, learning_from, size):
-        if strategy is not 'MOODYLEARN':
-            if learning_from == "me":
-                zeroes = []
-                for j in range(size):
-                    zeroes.append(0)
-                return zeroes
-            elif learning_from == "them":
-                zeroes = []
-                for j in range(size):
-                    zeroes.append(0)
-                return zeroes
-            elif learning_from == "us":
-                zeroes = []
-                for j in range(size):
-                    zeroes.append((0, 0))
-                return zeroes
-        else:
-            if learning_from == "me":
-                zeroes = []
-                for j in range(size):
-                    zeroes.append(0)
-                return zeroes
-            elif learning_from == "them":
-                zeroes = []
-                for j in range(size):
-                    zeroes.append(0)
-                return zeroes
-            elif learning_from == "us":
-                zeroes = []
-                for j in range(size):
-                    zeroes.append((0, 0))
-                return zeroes
+        """ The empty window code we start from, before anything has been seen """
+        if learning_from in ("me", "them"):
+            return encoding.blank_window(size)
+        elif learning_from == "us":
+            return encoding.blank_window(size, True)
 
     def averageScoreComparison(self, oppID, moodyStrat):
         scores = {}
@@ -1942,32 +1583,19 @@ class PDAgent(Agent):
         recent_payoffs = {}
         averages = {}
 
-        x, y = self.pos
-        neighbouring_cells = [(x, y + 1), (x + 1, y), (x, y - 1), (x - 1, y)]  # N, E, S, W
-
-        # First, get the neighbours
-        for i in neighbouring_cells:
-            bound_checker = self.model.grid.out_of_bounds(i)
-            if not bound_checker:
-                this_cell = self.model.grid.get_cell_list_contents([i])
-                # print("This cell", this_cell)
-                if self.stepCount == 2:
-                    self.n_partners += 1
-
-                if len(this_cell) > 0:
-                    partner = [obj for obj in this_cell
-                               if isinstance(obj, PDAgent)][0]
-
-                    partner_ID = partner.ID
-                    if partner.indivAvPayoff.get(self.ID) is None:  # if you try and get their average payoff against me and it isn't there
-                        if moodyStrat:
-                            averages[partner_ID] = self.moody_pp_oppPayoff[partner_ID]  # instead use the payoff for that turn
-                        else:
-                            averages[partner_ID] = self.pp_oppPayoff[partner_ID]
-                    else:
-                        averages[partner_ID] = partner.indivAvPayoff[self.ID]
+        for partner in self.get_partners():
+            partner_ID = partner.ID
+            if partner.indivAvPayoff.get(self.ID) is None:  # if you try and get their average payoff against me and it isn't there
+                if moodyStrat:
+                    averages[partner_ID] = self.moody_pp_oppPayoff[partner_ID]  # instead use the payoff for that turn
+                else:
+                    averages[partner_ID] = self.pp_oppPayoff[partner_ID]
+            else:
+                averages[partner_ID] = partner.indivAvPayoff[self.ID]
 
-            my_average = self.indivAvPayoff[oppID]  # BEWARE, THIS IS A ===FULL AVERAGE==== NOT AN AVERAGE OVER X PERIODS, averaged over per_partner_payoffs (full history)
+            # BEWARE, this is a FULL AVERAGE over the game, unless the model's history_retention is "last" - then
+            # it's an average over the last history_length payoffs (see history.py)
+            my_average = self.per_partner_payoffs.mean(oppID)
             #TODO: does this need to give partner's score against me, or score as a whole? Because if ============================================================================================
             #TODO: it's the latter, you could use pp_utility from the opponent
         if moodyStrat:
@@ -1986,13 +1614,7 @@ class PDAgent(Agent):
             self.get_IDs()
             for i in self.partner_IDs:
                 self.oldstates[i] = self.set_starting_oldstates(self.strategy, self.model.learnFrom, self.delta)
-                if self.statemode == 'stateless':
-                    md = 1
-                elif self.statemode == 'agentstate':
-                    md = 2
-                elif self.statemode == 'moodstate':
-                    md = 3
-                self.moody_oldstates[i] = self.set_starting_oldstates(self.strategy, self.model.moody_learnFrom, md)
+                self.moody_oldstates[i] = encoding.EMPTY  # the [0], [0, 0] or [0, 0, 0] state for our statemode
 
             if self.strategy is None or 0 or []:
                 self.strategy = self.pick_strategy()
@@ -2003,14 +1625,17 @@ class PDAgent(Agent):
                 # print("my name is agent ", self.ID, "my strategy is ", self.strategy)
                 if self.strategy == 'LEARN':
                     # Initialise the q tables and states on the first turn
-                    self.qtable = sarsa.init_qtable(copy.deepcopy(self.model.memory_states), 2, True)
-                    self.states = copy.deepcopy(self.model.memory_states)
+                    self.qtable = sarsa.init_qtable(self.model.memory_state_index, 2, True, self.model.qtable_dtype,
+                                                    self.model.q_store, self.ID)
+                    self.states = self.model.memory_states  # shared, never written to
                 if self.strategy == 'MOODYLEARN':
                     # Initialise the q tables and states on the first turn
-                    self.moody_qtable = sarsa_moody.init_qtable(copy.deepcopy(self.model.moody_memory_states), 2, True)
-                    self.state_working_memory = sarsa_moody.init_statememory(copy.deepcopy(self.model.moody_memory_states), 2, self.moody_delta)
+                    self.moody_qtable = sarsa_moody.init_qtable(self.model.moody_memory_state_index, 2, True,
+                                                                   self.model.qtable_dtype)
+                    self.state_working_memory = sarsa_moody.init_statememory(self.model.moody_memory_state_codes, 2, self.moody_delta,
+                                                                             self.model.lazy_states)
                     # print('init qtable len:', len(self.moody_qtable))
-                    self.moody_states = copy.deepcopy(self.model.moody_memory_states)
+                    self.moody_states = self.model.moody_memory_states
                 self.itermove_result = self.iter_pick_move(self.strategy, self.payoffs)
 
                 self.find_average_move()
@@ -2026,13 +1651,15 @@ class PDAgent(Agent):
 
                 if self.strategy == 'LEARN':
                     # Initialise the q tables and states on the first turn
-                    self.qtable = sarsa.init_qtable(copy.deepcopy(self.model.memory_states), 2, True)
-                    self.states = copy.deepcopy(self.model.memory_states)
+                    self.qtable = sarsa.init_qtable(self.model.memory_state_index, 2, True, self.model.qtable_dtype,
+                                                    self.model.q_store, self.ID)
+                    self.states = self.model.memory_states  # shared, never written to
                 if self.strategy == 'MOODYLEARN':
                     # Initialise the q tables and states on the first turn
-                    self.qtable = sarsa_moody.init_qtable(copy.deepcopy(self.model.moody_memory_states), 2, True)
+                    self.qtable = sarsa_moody.init_qtable(self.model.moody_memory_state_index, 2, True,
+                                                             self.model.qtable_dtype)
                     # print('init qtable len:', len(self.moody_qtable))
-                    self.states = copy.deepcopy(self.model.moody_memory_states)
+                    self.states = self.model.moody_memory_states
 
 
                 self.itermove_result = self.iter_pick_move(self.strategy, self.payoffs)
@@ -2095,6 +1722,27 @@ class PDAgent(Agent):
             for n in range(1):
                 print("----------------------------------------------------------")
 
+    def finish_round(self):
+        """ The end of a LEARN agent's advance, run by sarsa.BatchUpdate once the round's Q updates have been made
+            and epsilon and alpha decayed """
+        if self.model.export_q:
+            if self.stepCount == 1:
+                self.outputQtable(True)
+            elif self.stepCount == self.model.rounds - 1:
+                self.outputQtable(False)
+
+        self.outputData()
+        self.stepCount += 1
+
+        round_payoffs = self.pending_payoffs
+        self.pending_payoffs = None
+        if round_payoffs is not None:
+            if self.printing:
+                print("I am agent", self.ID, ", and I have earned", round_payoffs, "this round")
+            self.score += round_payoffs
+            self.model.strategy_totals.scored(self.strategy, round_payoffs)
+            # print("My total overall score is:", self.score)
+
     def advance(self):
         #TODO: THE BELOW NEEDS MOVING INTO A FUNCTION SOMEWHERE NOW THAT IS HAS BEEN DUPLICATED
         if self.strategy == 'LEARN':
@@ -2113,46 +1761,25 @@ class PDAgent(Agent):
 
             # update the Q for the CURRENT sprime
 
-            for i in self.partner_IDs:
+            self.model.sarsa_updates.join(self)
+            for n, i in enumerate(self.partner_IDs):
                 s = self.oldstates[i]           # the state I used to be in
                 a = self.itermove_result[i]     # the action I took
                 sprime = self.working_memory[i] # the state I found myself in
                 reward = self.pp_payoff[i]      # the reward I observed
                 aprime = self.pp_aprime[i]      # the action I will take next
+                if self.stepCount > 1:
+                    # oldstates and working_memory used to share one list per partner, so from the second round on
+                    # the state being updated has always been the one I'm in now - kept so results don't change
+                    s = sprime
 
                 # print('ostates=', self.oldstates)
                 # print('sstates=', self.itermove_result)
                 # print('sprimes=', self.working_memory)
-                if self.delta == 1:
-                    if self.model.memoryPaired:
-                        s = s[0]
-                oldQValues = self.qtable[tuple(s)]  # THIS MIGHT BREAK BECAUSE OF TUPLES
-
-                if a == 'C':  # This still works because it's keyed off the itermove_result and not part of the state
-                    idx = 0
-                elif a == 'D':
-                    idx = 1
-
-                if self.delta == 1:
-                    if self.model.memoryPaired:
-                        sprime = sprime[0]
-                newQValues = self.qtable[tuple(sprime)]  # THIS ISN'T RIGHT IS IT?
-                if aprime == 'C':
-                    idxprime = 0
-                elif aprime == 'D':
-                    idxprime = 1
 
-                Qsa = oldQValues[idx]
-                Qsaprime = newQValues[idxprime]
-
-                # update the Q value for the old state and old action
-
-                newQsa = sarsa.update_q(reward, self.gamma, self.alpha, Qsa, Qsaprime)
-                # print('My old Q for this partner was:', Qsa, 'and my new Q is:', newQsa)
-                # then put newQ in the Qtable[s] at index idx
-                change = self.qtable[tuple(s)]
-                change[idx] = newQsa
-                self.qtable[tuple(s)] = change
+                # update the Q value for the old state and old action - this is queued, and made for every learner
+                # at once when the round is over (see sarsa.BatchUpdate)
+                self.model.sarsa_updates.add(self, n, s, a, reward, sprime, aprime)
 
                 if self.model.moody_opponents:
                     myAv, oppAv, oppScore = self.averageScoreComparison(i, False)
@@ -2186,29 +1813,13 @@ class PDAgent(Agent):
             #     oldQValue = oldQValues[idx]
             #     new_value = sarsa.update_q(reward, self.gamma, self.alpha, oldQValue)
 
-            # update epsilon
-            self.epsilon = sarsa.decay_value(self.model.epsilon, self.epsilon, self.model.rounds, True, self.model.epsilon_floor)
-            self.alpha = sarsa.decay_value(self.model.alpha, self.alpha, self.model.rounds, True, self.model.alpha_floor)
-
             # update s to be sprime
             for i in self.partner_IDs:
                 self.oldstates[i] = self.working_memory[i]
 
-            if self.model.export_q:
-                if self.stepCount == 1:
-                    self.outputQtable(True)
-                elif self.stepCount == self.model.rounds - 1:
-                    self.outputQtable(False)
-
-            self.outputData()
-            self.stepCount += 1
-
-            if round_payoffs is not None:
-                if self.printing:
-                    print("I am agent", self.ID, ", and I have earned", round_payoffs, "this round")
-                self.score += round_payoffs
-                # print("My total overall score is:", self.score)
-                return
+            # epsilon and alpha decay with the batched update, and the rest of our round waits for it - finish_round
+            self.pending_payoffs = round_payoffs
+            return
 
         elif self.strategy == 'MOODYLEARN':
             self.check_partner()  # We took action a, what s prime did we end up in?
@@ -2233,17 +1844,14 @@ class PDAgent(Agent):
                 """ This part below is different. Our sprime is now the state we observe from our opponent, not just our 
                     payoff memory. """
                 sprime = sarsa_moody.observe_state(self.partner_latest_move[i], i, self.partner_moods[i],
-                                                   self.statemode)       # the state I found myself in
+                                                   self.statemode, self.model.number_of_agents)  # the state I found myself in
                 reward = self.moody_pp_payoff[i]      # the reward I observed
                 aprime = self.moody_pp_aprime[i]      # the action I will take next
 
                 # print('ostates=', self.oldstates)
                 # print('sstates=', self.itermove_result)
                 # print('sprimes=', self.working_memory)
-                if self.moody_delta == 1:
-                    if self.model.moody_memoryPaired:
-                        s = s[0]
-                oldQValues = self.moody_qtable[tuple(s)]  # THIS MIGHT BREAK BECAUSE OF TUPLES
+                oldQValues = self.moody_qtable[s]
 
 
                 # Get the Q value we want to change, based on our state and our action
@@ -2258,7 +1866,7 @@ class PDAgent(Agent):
 
                 # get the updated Qs according to the function provided
 
-                stateMem = self.state_working_memory[tuple(sprime)]
+                stateMem = self.state_working_memory[sprime]
                 if aprime == 'C':
                     stateActionMem = stateMem[0]
                 else:
@@ -2292,8 +1900,8 @@ class PDAgent(Agent):
                 # then put newQ in the Qtable[s] at index idx
                 # change = self.moody_qtable[tuple(s)]
                 # change[idx] = newQsa
-                self.moody_qtable[tuple(s)][0] = updatedQone
-                self.moody_qtable[tuple(s)][1] = updatedQtwo
+                self.moody_qtable[s][0] = updatedQone
+                self.moody_qtable[s][1] = updatedQtwo
 
                 """Update mood here at the end of each interaction WITHIN a ROUND. This means that initial interactions
                     in each round will influence subsequent interactions"""
@@ -2339,7 +1947,7 @@ class PDAgent(Agent):
             for i in self.partner_IDs:
                 # self.moody_oldstates[i] = self.working_memory[i]
                 self.moody_oldstates[i] = sarsa_moody.observe_state(self.partner_latest_move[i], i, self.partner_moods[i],
-                                                                    self.statemode)
+                                                                    self.statemode, self.model.number_of_agents)
 
                 # Update how we feel
                 # TODO: update mood earlier, after each Q value update??
@@ -2359,6 +1967,7 @@ class PDAgent(Agent):
                 if self.printing:
                     print("I am agent", self.ID, ", and I have earned", round_payoffs, "this round")
                 self.score += round_payoffs
+                self.model.strategy_totals.scored(self.strategy, round_payoffs)
                 # print("My total overall score is:", self.score)
                 return
 
@@ -2394,6 +2003,7 @@ class PDAgent(Agent):
                 if self.printing:
                     print("I am agent", self.ID, ", and I have earned", round_payoffs, "this round")
                 self.score += round_payoffs
+                self.model.strategy_totals.scored(self.strategy, round_payoffs)
                 # print("My total overall score is:", self.score)
                 return
 
@@ -0,0 +1,700 @@
+""" Array-backed population engine for PDModel.
+
+    Instead of stepping every PDAgent object through step()/advance(), the whole population's state lives in
+    NumPy arrays - moves per edge, scores, moods, ppDs, epsilon/alpha, Q tables and the per-partner counters -
+    and one round of the Simultaneous schedule is replayed as a few batched operations. Anything that is
+    sequential in the object version (partners are visited one after the other inside an agent's advance) is
+    looped over the (at most 4) partner slots, with every agent handled at once inside each slot.
+
+    Select it with PDModel(engine="array"). The PDAgent objects are still created and kept on the schedule so the
+    DataCollector reporters and the visualiser work as before; their scalar attributes are synced every step, and
+    the per-partner dicts are only rebuilt when something actually needs them (per-agent csv output, kNN at the
+    end of the game, Q-table export). """
+
+import numpy as np
+from pdpython_model import knn
+from pdpython_model import qtable
+from pdpython_model import sarsa
+from pdpython_model import sarsa_moody
+from pdpython_model.encoding import EMPTY, C, D, MOVE_NAMES, MOOD_NAMES
+
+SUPPORTED = ("ANGEL", "DEVIL", "RANDOM", "EV", "VEV", "TFT", "WSLS", "iWSLS", "VPP", "LEARN", "MOODYLEARN")
+
+
+def mood_type(mood):
+    """ Array version of sarsa_moody.getMoodType, encoded as indices into MOOD_NAMES """
+    return np.where(mood > 70, 3, np.where(mood < 30, 1, 2))
+
+
+class ArrayEngine:
+    def __init__(self, model):
+        self.model = model
+        if model.schedule_type != "Simultaneous":
+            raise ValueError("The array engine only replays the Simultaneous schedule, not %s" % model.schedule_type)
+        if model.lazy_states:
+            raise ValueError("The array engine needs the full state space, so cannot run with lazy_states")
+        if model.history_retention != "summary":
+            raise ValueError("The array engine averages payoffs over the whole game, so cannot run with "
+                             "history_retention %r" % (model.history_retention,))
+
+        self.agents = model.schedule.agents
+        self.N = len(self.agents)
+        self.K = 4
+        seed = model.random.getrandbits(64)
+        self.rng = np.random.default_rng(seed)
+
+        # ---------------------------- STRATEGIES -------------------------------
+        for a in self.agents:
+            if a.strategy is None:
+                a.strategy = a.pick_strategy()
+        self.strategy = np.array([a.strategy for a in self.agents], dtype=object)
+        unknown = set(self.strategy) - set(SUPPORTED)
+        if unknown:
+            raise ValueError("The array engine cannot play strategies %s" % sorted(unknown))
+        self.is_ = {s: (self.strategy == s) for s in SUPPORTED}
+        self.learner = self.is_["LEARN"]
+        self.moody = self.is_["MOODYLEARN"]
+        self.ids = np.array([a.ID for a in self.agents])
+
+        # ----------------------------- ADJACENCY -------------------------------
+        # Agents never move, so their N, E, S, W partners come straight from the index built at spawn
+        index_of = {a.unique_id: i for i, a in enumerate(self.agents)}
+        self.nbr = np.full((self.N, self.K), -1, dtype=np.int64)
+        for i, a in enumerate(self.agents):
+            for slot, partner in enumerate(a.get_partners()):
+                self.nbr[i, slot] = index_of[partner.unique_id]
+        self.valid = self.nbr >= 0
+        self.nbr_safe = np.where(self.valid, self.nbr, np.arange(self.N)[:, None])
+        self.rev = np.zeros((self.N, self.K), dtype=np.int64)  # my slot in my partner's list
+        for i in range(self.N):
+            for k in range(self.K):
+                if self.valid[i, k]:
+                    self.rev[i, k] = list(self.nbr[self.nbr[i, k]]).index(i)
+        self.pid = np.where(self.valid, self.ids[self.nbr_safe], 0)
+        self.degree = self.valid.sum(axis=1)
+        # agents advance in schedule order, so a partner with a lower index has already advanced when I do
+        self.partner_first = self.nbr_safe < np.arange(self.N)[:, None]
+        last = np.maximum(self.degree - 1, 0)
+        self.last_slot = last
+
+        # ------------------------------ PAYOFFS --------------------------------
+        pay = np.zeros((3, 3))
+        for (m, t), v in model.payoffs.items():
+            pay[MOVE_NAMES.index(m), MOVE_NAMES.index(t)] = v
+        self.P = pay
+
+        # --------------------------- PER-EDGE MEMORY ---------------------------
+        self.move = np.zeros((self.N, self.K), dtype=np.int8)      # itermove_result
+        self.plm = np.zeros((self.N, self.K), dtype=np.int8)       # partner_latest_move
+        self.aprime = np.zeros((self.N, self.K), dtype=np.int8)
+        self.ppd = np.zeros((self.N, self.K))
+        for i, a in enumerate(self.agents):
+            defaults = model.agent_ppds[a.ID]
+            for k in range(self.degree[i]):
+                self.ppd[i, k] = defaults[k]
+        self.default_ppd = self.ppd.copy()
+        self.ppd_clamped = np.zeros((self.N, self.K), dtype=bool)  # set to 1 for going over it - an int to PDAgent
+        self.pay_sum = np.zeros((self.N, self.K))
+        self.pay_cnt = np.ones((self.N, self.K))  # per_partner_payoffs starts life as [0]
+        self.indiv = np.zeros((self.N, self.K))
+        self.pay = np.zeros((self.N, self.K))
+        self.opp_pay = np.zeros((self.N, self.K))
+        self.utility = np.zeros((self.N, self.K))
+        self.mcoops = np.zeros((self.N, self.K), dtype=np.int64)
+        self.tcoops = np.zeros((self.N, self.K), dtype=np.int64)
+        self.mutc = np.zeros((self.N, self.K), dtype=np.int64)
+
+        # ---------------------------- PER-AGENT --------------------------------
+        self.score = np.zeros(self.N)
+        self.score_written = self.score.copy()
+        self.mood = np.full(self.N, float(model.moody_startmood))
+        self.sensitive = np.array([a.sensitive for a in self.agents])
+        self.sensitivity = np.full(self.N, 20.0)
+        self.number_of_c = np.zeros(self.N)
+        self.number_of_d = np.zeros(self.N)
+        self.mutual_c = np.zeros(self.N, dtype=np.int64)
+        self.update_value = np.full(self.N, float(model.theta))
+        self.global_av = np.zeros(self.N)
+        self.global_high = np.zeros(self.N)
+        self.common = np.zeros(self.N, dtype=np.int8)  # 0 none, 1 ['C'], 2 ['D'], 3 'Eq'
+        self.epsilon = np.full(self.N, float(model.epsilon))
+        self.alpha = np.full(self.N, float(model.alpha))
+        self.proportional = np.zeros(self.N)
+        self.step_count = 1
+
+        # ------------------------- WORKING MEMORY / SARSA ----------------------
+        self.delta = self.agents[0].delta
+        self.moody_delta = self.agents[0].moody_delta
+        self.learn_from = model.learnFrom
+        if self.learn_from not in ("them", "me", "us"):
+            raise ValueError("Unknown learnFrom mode %s" % self.learn_from)
+        self.base = 9 if self.learn_from == "us" else 3
+        self.n_codes = self.base ** self.delta
+        self.wm = np.zeros((self.N, self.K), dtype=np.int64)       # working_memory windows, packed without the tag
+        self.oldstate = np.zeros((self.N, self.K), dtype=np.int64)
+        # LEARN agents blank their working memory on the first pick, so their first check already shifts it
+        self.wm_started = np.repeat(self.learner[:, None], self.K, axis=1)
+        self.uv_table = self.build_uv_table()
+        self.uv_fallback = self.agents[0].theta * model.update_value_table.fallback
+
+        self.learn_rows = None
+        self.q = None
+        if self.learner.any():
+            self.learn_rows = self.build_learn_rows()
+            self.lrow = np.cumsum(self.learner) - 1
+            self.q = np.zeros((int(self.learner.sum()), len(model.memory_state_index), 2), dtype=model.qtable_dtype)
+
+        self.moody_rows = None
+        self.mq = None
+        self.shm = None
+        if self.moody.any():
+            if model.moody_learnFrom != "them":
+                raise ValueError("MOODYLEARN agents only learn from 'them'")
+            self.statemode = model.moody_statemode
+            self.n_ids = model.number_of_agents + 1  # the same radix encoding.moody_state_code packs IDs with
+            self.moody_rows = self.build_moody_rows()
+            self.mrow = np.cumsum(self.moody) - 1
+            self.mq = np.zeros((int(self.moody.sum()), len(model.moody_memory_state_index), 2),
+                               dtype=model.qtable_dtype)
+            # init_statememory hands every (state, action) the same list, so it behaves as one payoff window
+            self.shm = np.zeros((self.N, self.moody_delta))
+            self.moody_started = np.zeros((self.N, self.K), dtype=bool)
+            self.moody_oldstate = np.zeros((self.N, self.K), dtype=np.int64)
+            self.partner_state = np.zeros((self.N, self.K), dtype=np.int64)
+
+    # ============================== STATE TABLES ===================================
+
+    def agent_code(self, code):
+        """ The PDAgent working memory / Q-table code (see encoding.py) for one of our untagged windows. A paired
+            memory of one is a bare pair, i.e. a move window of length two. """
+        code = int(code)
+        if self.base == 3:
+            return 3 ** self.delta + code
+        if self.delta == 1:
+            return 9 + code
+        return -(9 ** self.delta + code)
+
+    def build_uv_table(self):
+        """ change_update_value for every possible window, as an array indexed by the packed window """
+        uv = self.model.update_value_table
+        table = np.zeros(self.n_codes)
+        if self.base != 3:
+            return table
+        for code in range(self.n_codes):
+            table[code] = self.agents[0].theta * uv[self.agent_code(code)]
+        return table
+
+    def build_learn_rows(self):
+        rows = self.model.memory_state_index.rows
+        table = np.array([rows.get(self.agent_code(code), -1) for code in range(self.n_codes)])
+        if (table < 0).any():
+            raise ValueError("memory_states do not cover every %s-long window" % self.delta)
+        return table
+
+    def moody_code(self, obs, pid, mtype):
+        if self.statemode == 'stateless':
+            return obs
+        elif self.statemode == 'agentstate':
+            return obs * self.n_ids + pid
+        return (obs * self.n_ids + pid) * 4 + mtype
+
+    def build_moody_rows(self):
+        rows = self.model.moody_memory_state_index.rows
+        table = np.full(3 * self.n_ids * 4, -1)
+        for code in range(len(table)):
+            table[code] = rows.get(code, -1)
+        return table
+
+    # ============================== MOVE SELECTION =================================
+
+    def coin(self, shape):
+        """ random.choice(["C", "D"]) """
+        return self.rng.integers(1, 3, size=shape).astype(np.int8)
+
+    def egreedy(self, agents, codes, eps):
+        """ sarsa.egreedy_action for every (agent, partner) in the masked arrays at once """
+        q = self.q[self.lrow[agents][:, None], self.learn_rows[codes]]
+        return sarsa.egreedy_actions(eps[agents][:, None], q, self.rng)
+
+    def moody_action(self, agents, codes, mood):
+        """ sarsa_moody.moody_action_three for every (agent, partner) at once """
+        q = self.mq[self.mrow[agents][:, None], self.moody_rows[codes]]
+        return sarsa_moody.moody_actions_three(mood[agents][:, None], q, self.model.moody_epsilon,
+                                               self.model.moody_MA, self.rng)
+
+    def count(self, agents, moves, weight=1.0):
+        mask = self.valid[agents]
+        self.number_of_c[agents] += weight * ((moves == C) & mask).sum(axis=1)
+        self.number_of_d[agents] += weight * ((moves == D) & mask).sum(axis=1)
+
+    def pick_moves(self):
+        """ The step() half of the round: every agent picks (or recalls) a move per partner """
+        t = self.step_count
+        prev = self.move
+        new = prev.copy()
+        payoffs = self.model.payoffs
+
+        for s in ("ANGEL", "DEVIL", "EV", "VEV", "TFT", "WSLS", "iWSLS", "VPP", "RANDOM"):
+            agents = np.flatnonzero(self.is_[s])
+            if len(agents) == 0:
+                continue
+            shape = (len(agents), self.K)
+            if s == "ANGEL":
+                moves = np.full(shape, C)
+            elif s == "DEVIL":
+                moves = np.full(shape, D)
+            elif s == "EV" or s == "VEV":
+                ppD = 0.5 if s == "EV" else self.ppd[agents]
+                ppC = 1 - ppD
+                ev = np.stack(np.broadcast_arrays(payoffs["C", "C"] * ppC, payoffs["C", "D"] * ppD,
+                                                  payoffs["D", "C"] * ppC, payoffs["D", "D"] * ppD))
+                moves = np.where(ev.argmax(axis=0) < 2, C, D) * np.ones(shape, dtype=np.int64)
+            elif s == "RANDOM":
+                moves = self.coin(shape)
+            elif s == "VPP":
+                moves = np.where(self.rng.random(shape) < 1 - self.ppd[agents], C, D)
+            elif t == 1:
+                moves = np.full(shape, C)
+            elif s == "TFT":
+                moves = self.plm[agents]
+            elif s == "WSLS":
+                mine = prev[agents]
+                # WSLS counts the move it played last round rather than the one it picks
+                self.count(agents, mine)
+                failed = self.plm[agents] == D
+                new[agents] = np.where(failed, 3 - mine, mine)
+                continue
+            else:  # iWSLS
+                mine = prev[agents]
+                switch = self.P[mine, self.plm[agents]] <= 1
+                moves = np.where(switch, 3 - mine, mine)
+            moves = moves.astype(np.int8)
+            self.count(agents, moves)
+            new[agents] = moves
+
+        learners = np.flatnonzero(self.learner)
+        if len(learners):
+            if t == 1:
+                new[learners] = self.egreedy(learners, np.zeros((len(learners), self.K), dtype=np.int64),
+                                             self.epsilon)
+                self.count(learners, new[learners])
+            else:
+                new[learners] = self.aprime[learners]
+
+        moodies = np.flatnonzero(self.moody)
+        if len(moodies):
+            if t == 1:
+                start = C if self.model.startingBehav == 'C' else D
+                new[moodies] = start
+                self.count(moodies, new[moodies], 0.5)
+            else:
+                new[moodies] = self.aprime[moodies]
+
+        self.move = np.where(self.valid, new, 0).astype(np.int8)
+
+        # find_average_move
+        n_c = ((self.move == C) & self.valid).sum(axis=1)
+        n_d = ((self.move == D) & self.valid).sum(axis=1)
+        self.common = np.where((n_c > 0) & (n_d > 0) & (n_c == n_d), 3,
+                               np.where(n_c >= n_d, np.where(n_c > 0, C, 0), D)).astype(np.int8)
+
+    # ================================= ADVANCE =====================================
+
+    def push(self, window, digit, mask):
+        return np.where(mask, (window * self.base + digit) % self.n_codes, window)
+
+    def advance(self):
+        """ The advance() half of the round: check_partner, increment_score, aprime selection, SARSA updates
+            and moods, for every agent at once """
+        t = self.step_count
+        model = self.model
+        valid = self.valid
+        moodies = self.moody
+        normal = ~moodies
+        pm = np.where(valid, self.move[self.nbr_safe, self.rev], 0).astype(np.int8)
+        self.plm = pm
+        mine = self.move
+
+        # ---- check_partner: working memory and the update value ----
+        self.update_value[:] = model.theta
+        wm_mask = valid & normal[:, None]
+        if self.learn_from == "them":
+            self.wm = self.push(self.wm, pm, wm_mask)
+            inc = np.where(wm_mask & self.wm_started, self.uv_table[self.wm], 0)
+            self.update_value += inc.sum(axis=1)
+        elif self.learn_from == "me":
+            # a fresh window is seeded with the partner's move, whatever we learn from
+            self.wm = self.push(self.wm, np.where(self.wm_started, mine, pm), wm_mask)
+        else:
+            self.wm = self.push(self.wm, 3 * mine + pm, wm_mask)
+        self.wm_started |= wm_mask
+
+        pay = np.where(valid, self.P[mine, pm], 0)
+        opp_pay = np.where(valid, self.P[pm, mine], 0)
+        self.pay = pay
+        self.opp_pay = opp_pay
+
+        if moodies.any():
+            m_mask = valid & moodies[:, None]
+            # one change for the per-partner payoff window (once it exists) and one for the shared (s, a) window
+            n_changes = m_mask.astype(int) + (m_mask & self.moody_started)
+            self.update_value += (n_changes * self.uv_fallback).sum(axis=1)
+            self.moody_started |= m_mask
+            for k in range(self.K):
+                sel = m_mask[:, k]
+                self.shm[sel, :-1] = self.shm[sel, 1:]
+                self.shm[sel, -1] = pay[sel, k]
+
+        # ---- increment_score ----
+        indiv_old = self.indiv.copy()
+        self.mcoops += (mine == C) & valid
+        self.tcoops += (pm == C) & valid
+        cc = (mine == C) & (pm == C) & valid
+        self.mutc += cc
+        self.mutual_c += cc.sum(axis=1)
+        self.pay_sum += pay
+        self.pay_cnt += valid
+        self.indiv = np.where(valid, self.pay_sum / self.pay_cnt, 0)
+
+        ppd = self.ppd
+        inside = (ppd < 1) & (ppd > 0) & valid
+        change = np.abs(pay * self.update_value[:, None])
+        ppd = np.where(inside & (pm == D), ppd + change, np.where(inside & (pm == C), ppd - change, ppd))
+        self.ppd_clamped |= valid & (ppd > 1)
+        ppd = np.where(ppd > 1, 1, np.where(ppd < 0, 0.001, np.where(ppd == 6.938893903907228e-17, 0.001, ppd)))
+        self.ppd = np.where(valid, ppd, 0)
+
+        self.utility += pay
+        round_payoffs = pay.sum(axis=1)
+        self.global_av = np.where(self.degree > 0, self.indiv.sum(axis=1) / np.maximum(self.degree, 1), 0)
+        self.global_high = np.maximum(self.global_high, self.global_av)
+
+        # ---- moods ----
+        mood_start = self.mood.copy()
+        mood_steps = self.update_moods(t, indiv_old, round_payoffs)
+
+        # ---- next actions ----
+        learners = np.flatnonzero(self.learner)
+        if len(learners):
+            aprime = self.egreedy(learners, self.wm[learners], self.epsilon)
+            self.aprime[learners] = aprime
+            self.count(learners, aprime)
+            self.learn_update(learners)
+
+        moody_idx = np.flatnonzero(moodies)
+        if len(moody_idx):
+            # partners that advanced before me have already moved to their new mood
+            partner_mood = np.where(self.partner_first, self.mood[self.nbr_safe], mood_start[self.nbr_safe])
+            mtype = mood_type(partner_mood)
+            sprime = self.moody_code(pm.astype(np.int64), self.pid, mtype)
+            if t > 1:
+                self.partner_state[moody_idx] = sprime[moody_idx]
+            if t == 1:
+                start = C if model.startingBehav == 'C' else D
+                aprime = np.full((len(moody_idx), self.K), start, dtype=np.int8)
+                self.count(moody_idx, aprime, 0.5)
+            else:
+                aprime = self.moody_action(moody_idx, self.partner_state[moody_idx], mood_start)
+                self.count(moody_idx, aprime)
+            self.aprime[moody_idx] = aprime
+            self.moody_update(moody_idx, sprime, mood_steps)
+
+        self.score_written = self.score.copy()  # PDAgent writes its output before it adds the round's payoffs
+        self.score += round_payoffs
+
+    def update_moods(self, t, indiv_old, round_payoffs):
+        """ averageScoreComparison + update_mood_old, partner by partner. Returns the mood each agent held
+            going into each partner slot, which MOODYLEARN's Q update needs. """
+        model = self.model
+        nbr, rev = self.nbr_safe, self.rev
+        # partner's average against me: fresh if they've already advanced, last round's otherwise, and my
+        # own observation of their payoff if they haven't got an entry for me at all yet
+        theirs = np.where(self.partner_first, self.indiv[nbr, rev], indiv_old[nbr, rev])
+        if t == 1:
+            theirs = np.where(self.partner_first, theirs, self.opp_pay)
+        last_opp = self.opp_pay[np.arange(self.N), self.last_slot]
+        opp_score = np.where(self.moody[:, None], self.opp_pay, last_opp[:, None])
+        uses_reward = self.moody | self.learner
+        score = np.where(uses_reward[:, None], self.pay, self.score[:, None])
+        active = self.moody | (model.moody_opponents & np.ones(self.N, dtype=bool))
+
+        steps = []
+        mood = self.mood
+        for k in range(self.K):
+            steps.append(mood.copy())
+            sel = active & self.valid[:, k]
+            if not sel.any():
+                continue
+            avg = self.indiv[:, k]
+            opp_av = theirs[:, k]
+            ab = (100 - mood) / 100
+            omega = avg - ((ab * np.maximum((opp_av - avg), 0)) - (ab * np.maximum((avg - opp_av), 0)))
+            adjustment = (score[:, k] - avg) + omega
+            sens = self.sensitive & sel
+            negative = sens & (adjustment < 0)
+            adjustment = np.where(negative, adjustment * np.minimum(20.00, self.sensitivity), adjustment)
+            self.sensitivity = np.where(negative, 0, np.where(sens, self.sensitivity + 1, self.sensitivity))
+            new = np.maximum(0.0001, np.minimum(99.999, mood + adjustment))
+            mood = np.where(sel, new, mood)
+        self.mood = mood
+        return steps
+
+    def learn_update(self, learners):
+        """ The SARSA update for LEARN agents, one partner slot at a time so that two partners sharing a state
+            compound exactly as they do sequentially """
+        model = self.model
+        rows = self.learn_rows
+        # PDAgent updates the window it is in now from its second round on (see PDAgent.advance)
+        old = self.oldstate if self.step_count == 1 else self.wm
+        for k in range(self.K):
+            sel = learners[self.valid[learners, k]]
+            if len(sel) == 0:
+                continue
+            L = self.lrow[sel]
+            s = rows[old[sel, k]]
+            sp = rows[self.wm[sel, k]]
+            a = self.move[sel, k] - 1
+            ap = self.aprime[sel, k] - 1
+            oldQ = self.q[L, s, a]
+            nextQ = self.q[L, sp, ap]
+            self.q[L, s, a] = oldQ + self.alpha[sel] * (self.pay[sel, k] + ((model.gamma * nextQ) - oldQ))
+        self.oldstate[learners] = self.wm[learners]
+
+        for values, initial, floor in ((self.epsilon, model.epsilon, model.epsilon_floor),
+                                       (self.alpha, model.alpha, model.alpha_floor)):
+            new = values[learners] - initial / model.rounds
+            if floor > 0:
+                new = np.where(new < floor, floor, new)
+            values[learners] = new
+
+    def moody_update(self, moody_idx, sprime, mood_steps):
+        """ sarsa_moody.update_q / learn for MOODYLEARN agents """
+        rows = self.moody_rows
+        window = self.moody_delta
+        csum = np.concatenate([np.zeros((self.N, 1)), np.cumsum(self.shm, axis=1)], axis=1)
+        for k in range(self.K):
+            sel = moody_idx[self.valid[moody_idx, k]]
+            if len(sel) == 0:
+                continue
+            M = self.mrow[sel]
+            s = rows[self.moody_oldstate[sel, k]]
+            a = self.move[sel, k] - 1
+            mood = mood_steps[k][sel]
+            amount = np.ceil(window * ((100 - mood) / 100)).astype(np.int64)
+            future = csum[sel, np.minimum(amount + 1, window)] / amount
+            oldQ = self.mq[M, s, a]
+            self.mq[M, s, a] = oldQ + 0.1 * (self.pay[sel, k] + (0.95 * future) - oldQ)
+        self.moody_oldstate[moody_idx] = sprime[moody_idx]
+
+    # ================================== ROUND ======================================
+
+    def step(self):
+        model = self.model
+        t = self.step_count
+        if t > 1:
+            high = model.highest_score
+            self.proportional = (self.score / high) * 100 if high else np.zeros(self.N)
+        self.number_of_c[:] = 0
+        self.number_of_d[:] = 0
+        self.mutual_c[:] = 0
+        self.pick_moves()
+        self.advance()
+
+        if t == model.rounds - 1:
+            self.end_of_game()
+        if model.export_q and t in (1, model.rounds - 1):
+            self.export_q(t == 1)
+
+        # output_data_to_model
+        model.agents_cooperating += int((self.common == C).sum())
+        model.agents_defecting += int((self.common == D).sum())
+        model.number_of_defects += float(self.number_of_d.sum())
+        model.number_of_coops += float(self.number_of_c.sum())
+        model.strategy_totals.set_round(self.is_, self.score, self.number_of_c, self.number_of_d, self.mutual_c)
+
+        self.sync_agents(full=model.collect_data)
+        if model.collect_data:
+            for i, a in enumerate(self.agents):
+                a.score = float(self.score_written[i])
+                a.output_data_to_file(a.outcome_list)
+                a.score = float(self.score[i])
+        self.step_count += 1
+        for a in self.agents:
+            a.stepCount = self.step_count
+        model.schedule.steps += 1
+        model.schedule.time += 1
+
+    def end_of_game(self):
+        """ VPP agents export kNN training data or pick next game's ppDs, through the object methods """
+        model = self.model
+        vpps = np.flatnonzero(self.is_["VPP"])
+        for i in vpps:
+            a = self.agents[i]
+            self.sync_agent(i, a, full=True)
+            a.last_round = True
+        if model.kNN_training:
+            for i in vpps:
+                self.agents[i].training_data = self.agents[i].export_training_data()
+            return
+
+        # classify every partner of every VPP agent in one batch
+        samples = []
+        for i in vpps:
+            a = self.agents[i]
+            samples += a.knn_samples(a.partner_IDs, a.per_partner_utility, a.per_partner_mcoops,
+                                     a.per_partner_tcoops, a.per_partner_mutc, a.default_ppds)
+        if samples:
+            classes = knn.classifier(knn.training_set(model.training_data_file)).classify_many(samples, model.k)
+        start = 0
+        for i in vpps:
+            a = self.agents[i]
+            n = len(a.partner_IDs)
+            a.knn_decision(a.partner_IDs, a.per_partner_utility, a.per_partner_mcoops,
+                           a.per_partner_tcoops, a.per_partner_mutc, a.default_ppds, classes[start:start + n])
+            start += n
+
+    def export_q(self, init):
+        for i in np.flatnonzero(self.learner):
+            a = self.agents[i]
+            if a.ID == self.model.chosenOne:
+                a.qtable = self.agent_qtable(i)
+                a.outputQtable(init)
+
+    # =============================== SYNC TO AGENTS ================================
+
+    def agent_qtable(self, i):
+        """ Agent i's Q values as a QTable over the model's state index - a view onto our array, no copying """
+        return qtable.QTable(self.model.memory_state_index, values=self.q[self.lrow[i]])
+
+    def sync_agents(self, full=False):
+        for i, a in enumerate(self.agents):
+            self.sync_agent(i, a, full)
+
+    def sync_agent(self, i, a, full=False):
+        """ Write the engine's state back onto the PDAgent object. The scalars the reporters and visualiser
+            read are always written; the per-partner dicts only when full is set. """
+        # the round being played, as PDAgent has it until its output is written - the models start it on True
+        a.stepCount = self.step_count if self.step_count > 1 else True
+        a.score = float(self.score[i])
+        a.mood = float(self.mood[i])
+        a.number_of_c = float(self.number_of_c[i])
+        a.number_of_d = float(self.number_of_d[i])
+        a.mutual_c_outcome = int(self.mutual_c[i])
+        a.common_move = ('Eq' if self.common[i] == 3 else [MOVE_NAMES[self.common[i]]] if self.common[i] else [])
+        a.globalAvPayoff = float(self.global_av[i])
+        a.globalHighPayoff = float(self.global_high[i])
+        a.update_value = float(self.update_value[i])
+        a.sensitivity_mod = float(self.sensitivity[i])
+        a.proportional_score = float(self.proportional[i])
+        if self.learner[i]:
+            a.epsilon = float(self.epsilon[i])
+            a.alpha = float(self.alpha[i])
+        if not full:
+            return
+
+        ids = [int(p) for p in self.pid[i, :self.degree[i]]]
+        a.partner_IDs = ids
+        a.itermove_result = {p: MOVE_NAMES[self.move[i, k]] for k, p in enumerate(ids)}
+        a.partner_latest_move = {p: MOVE_NAMES[self.plm[i, k]] for k, p in enumerate(ids)}
+        a.outcome_list = {p: [MOVE_NAMES[self.move[i, k]], MOVE_NAMES[self.plm[i, k]]] for k, p in enumerate(ids)}
+        a.ppD_partner = {p: 1 if self.ppd_clamped[i, k] else float(self.ppd[i, k]) for k, p in enumerate(ids)}
+        a.default_ppds = {p: float(self.default_ppd[i, k]) for k, p in enumerate(ids)}
+        a.indivAvPayoff = {p: float(self.indiv[i, k]) for k, p in enumerate(ids)}
+        a.per_partner_utility = {p: float(self.utility[i, k]) for k, p in enumerate(ids)}
+        a.per_partner_mcoops = {p: int(self.mcoops[i, k]) for k, p in enumerate(ids)}
+        a.per_partner_tcoops = {p: int(self.tcoops[i, k]) for k, p in enumerate(ids)}
+        a.per_partner_mutc = {p: int(self.mutc[i, k]) for k, p in enumerate(ids)}
+        a.per_partner_strategies = {p: self.strategy[self.nbr[i, k]] for k, p in enumerate(ids)}
+        a.pp_oppPayoff = {p: float(self.opp_pay[i, k]) for k, p in enumerate(ids)}
+        if self.moody[i]:
+            a.moody_pp_payoff = {p: float(self.pay[i, k]) for k, p in enumerate(ids)}
+            a.moody_pp_oppPayoff = dict(a.pp_oppPayoff)
+            a.partner_states = {p: int(self.partner_state[i, k]) for k, p in enumerate(ids)}
+        else:
+            a.pp_payoff = {p: float(self.pay[i, k]) for k, p in enumerate(ids)}
+            a.working_memory = {p: self.agent_code(self.wm[i, k]) for k, p in enumerate(ids)}
+
+
+# ================================= CHECKS ======================================
+# Run with python -m pdpython_model.array_engine, from a directory holding the pickles the models load.
+
+DETERMINISTIC = ("TFT", "WSLS", "iWSLS", "ANGEL", "DEVIL")
+
+
+def play(model_cls, engine, strategies, steps, seed=0, **kwargs):
+    """ A model with strategies dealt out over its agents in turn, played for steps rounds on engine """
+    import random
+    random.seed(seed)
+    np.random.seed(seed)
+    model = model_cls(**kwargs)
+    model.random.seed(seed)
+    for a in model.schedule.agents:
+        a.strategy = None
+        a.pick_strategy = (lambda s: lambda: s)(strategies[a.ID % len(strategies)])
+    if engine == "array":
+        model.population = ArrayEngine(model)
+    for step in range(steps):
+        model.step()
+    return model
+
+
+def telemetry_matches(model_cls, strategies=DETERMINISTIC, rounds=20, telemetry_format="csv", **kwargs):
+    """ Whether a game of deterministic strategies writes the same per-agent output on both engines - i.e. whether
+        the engine keeps in step with the agents. Writes to the working directory, in telemetry_format. Counts the
+        engine keeps as floats are allowed to come out as 3.0 where an agent writes 3.
+
+        Only strategies that never draw a random number can be compared row for row, as the engine draws from a
+        generator of its own - VPP, LEARN, MOODYLEARN and the rest are left to outcomes_match. """
+    import pandas as pd
+    from pdpython_model import telemetry
+    frames = []
+    for engine in ("agents", "array"):
+        model = play(model_cls, engine, strategies, rounds, rounds=rounds, collect_data=True, export_q=False,
+                     telemetry_format=telemetry_format, **kwargs)
+        model.telemetry.flush()
+        model.output.flush()  # the telemetry is written on the output thread
+        if telemetry_format == "npz":
+            edges = telemetry.load_edges(model.telemetry.directory)
+            frames.append({0: edges.sort_values(['step', 'agent', 'partner']).reset_index(drop=True)})
+        else:
+            frames.append(telemetry.read_agents(model.telemetry.path))
+    if sorted(frames[0]) != sorted(frames[1]):
+        return False
+    for agent in frames[0]:
+        mine, theirs = frames[0][agent], frames[1][agent]
+        try:
+            pd.testing.assert_frame_equal(mine, theirs, check_dtype=False)
+        except AssertionError:
+            return False
+    return True
+
+
+def outcomes_match(model_cls, strategies=("LEARN", "VPP", "MOODYLEARN", "TFT"), rounds=40, seeds=12, **kwargs):
+    """ The mean final score of each strategy over seeds games on each engine, as {strategy: (agents' mean, engine's
+        mean, whether they're within three standard errors)}. For the strategies that draw random numbers, which
+        can only match in distribution. Games stop short of their last round, where VPPs would pick (and save) the
+        next game's ppDs. """
+    scores = {"agents": {}, "array": {}}
+    for engine in scores:
+        for seed in range(seeds):
+            model = play(model_cls, engine, strategies, rounds - 2, seed, rounds=rounds, collect_data=False,
+                         export_q=False, **kwargs)
+            for s in strategies:
+                mean = np.mean([a.score for a in model.schedule.agents if a.strategy == s])
+                scores[engine].setdefault(s, []).append(mean)
+    summary = {}
+    for s in strategies:
+        mine, theirs = np.array(scores["agents"][s]), np.array(scores["array"][s])
+        error = np.sqrt(mine.var(ddof=1) / len(mine) + theirs.var(ddof=1) / len(theirs))
+        summary[s] = (mine.mean(), theirs.mean(), abs(mine.mean() - theirs.mean()) <= 3 * error + 1e-9)
+    return summary
+
+
+if __name__ == '__main__':
+    from pdpython_model.sarsa_model import PDModel
+    for telemetry_format in ("csv", "npz"):
+        print("%s telemetry the same on both engines:" % telemetry_format,
+              telemetry_matches(PDModel, telemetry_format=telemetry_format))
+    for strategy, (mine, theirs, same) in outcomes_match(PDModel).items():
+        print("%s scores %.1f on the agents, %.1f on the engine - %s" % (strategy, mine, theirs,
+                                                                        "same" if same else "DIFFERENT"))
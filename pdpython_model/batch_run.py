@@ -14,28 +14,31 @@ import statistics
 import sys
 import os
 import pickle
+from pdpython_model import encoding
+from pdpython_model import knn
 from pdpython_model import statemaker
 from pdpython_model import statemaker_moody
+from pdpython_model import columnstore
+from pdpython_model import runstore
+from pdpython_model import strategytotals
+from pdpython_model import statespace
+from pdpython_model import telemetry
+from pdpython_model import sweep
+from pdpython_model import trainingstore
+from pdpython_model import qtable
+from pdpython_model import qsnapshot
+from pdpython_model import sarsa
+from pdpython_model.array_engine import ArrayEngine
 
 
 def get_num_coop_agents(model):
     """ return number of cooperations"""
-
-    agent_cooperations = [a.number_of_c for a in model.schedule.agents]
-    # print("hey", agent_cooperations)
-    agent_cooperations = np.sum(agent_cooperations)
-    # print("lol", agent_cooperations.item())
-    return agent_cooperations.item()
+    return sum(model.strategy_totals.cooperations.values())
 
 
 def get_num_defect_agents(model):
     """ return number of defections"""
-
-    agent_defections = [a.number_of_d for a in model.schedule.agents]
-    # print("hey", agent_defections)
-    agent_defections = np.sum(agent_defections)
-    # print("lol", agent_defections.item())
-    return agent_defections.item()
+    return sum(model.strategy_totals.defections.values())
 
 
 def get_cooperators(model):
@@ -65,282 +68,72 @@ def get_defectors(model):
 
 def get_tft_performance(model):
     """ For acquiring the sum total performance of a strategy"""
-
-    # get the list of agent
-    strategy = [a.strategy for a in model.schedule.agents]
-    # get the list of agent performances
-    scores = [a.score for a in model.schedule.agents]
-    # for each in that list, when strategy = x y z, sum their number to a value
-    agent_scores = []
-    for i in strategy:
-            if i == "TFT":
-                indices = strategy.index(i)
-                agent = scores[indices]
-                agent_scores.append(agent)
-
-    # if sum(agent_scores) != 0:
-        # print("tft scored", sum(agent_scores))
-    return sum(agent_scores)
+    return model.strategy_totals.score.get("TFT", 0)
 
 
 def get_tft_cooperations(model):
     """ For acquiring the sum total cooperations of a strategy"""
-
-    # get the list of agent
-    strategy = [a.strategy for a in model.schedule.agents]
-    # get the list of agent performances
-    coops = [a.number_of_c for a in model.schedule.agents]
-    # for each in that list, when strategy = x y z, sum their number to a value
-    agent_coops = []
-    for i in strategy:
-            if i == "TFT":
-                indices = strategy.index(i)
-                agent = coops[indices]
-                agent_coops.append(agent)
-
-    # if sum(agent_coops) != 0:
-        # print("tft cooped", sum(agent_coops))
-    return sum(agent_coops)
+    return model.strategy_totals.cooperations.get("TFT", 0)
 
 
 def get_vpp_performance(model):
     """ For acquiring the sum total performance of a strategy"""
-
-    # get the list of agent
-    strategy = [a.strategy for a in model.schedule.agents]
-    # get the list of agent performances
-    scores = [a.score for a in model.schedule.agents]
-    # for each in that list, when strategy = x y z, sum their number to a value
-    agent_scores = []
-    for i in strategy:
-            if i == "VPP":
-                indices = strategy.index(i)
-                agent = scores[indices]
-                agent_scores.append(agent)
-
-    # if sum(agent_scores) != 0:
-        # print("vpp scored", sum(agent_scores))
-    return sum(agent_scores)
+    return model.strategy_totals.score.get("VPP", 0)
 
 
 def get_vpp_cooperations(model):
     """ For acquiring the sum total cooperations of a strategy"""
-
-    # get the list of agent
-    strategy = [a.strategy for a in model.schedule.agents]
-    # get the list of agent performances
-    coops = [a.number_of_c for a in model.schedule.agents]
-    # for each in that list, when strategy = x y z, sum their number to a value
-    agent_coops = []
-    for i in strategy:
-            if i == "VPP":
-                indices = strategy.index(i)
-                agent = coops[indices]
-                agent_coops.append(agent)
-
-    # if sum(agent_coops) != 0:
-        # print("vpp cooped", sum(agent_coops))
-    return sum(agent_coops)
+    return model.strategy_totals.cooperations.get("VPP", 0)
 
 
 def get_wsls_performance(model):
     """ For acquiring the sum total performance of a strategy"""
-
-    # get the list of agent
-    strategy = [a.strategy for a in model.schedule.agents]
-    # get the list of agent performances
-    scores = [a.score for a in model.schedule.agents]
-    # for each in that list, when strategy = x y z, sum their number to a value
-    agent_scores = []
-    for i in strategy:
-            if i == "WSLS":
-                indices = strategy.index(i)
-                agent = scores[indices]
-                agent_scores.append(agent)
-
-    # if sum(agent_scores) != 0:
-    #     print("wsls scored", sum(agent_scores))
-    return sum(agent_scores)
+    return model.strategy_totals.score.get("WSLS", 0)
 
 
 def get_iwsls_performance(model):
     """ For acquiring the sum total performance of a strategy"""
-
-    # get the list of agent
-    strategy = [a.strategy for a in model.schedule.agents]
-    # get the list of agent performances
-    scores = [a.score for a in model.schedule.agents]
-    # for each in that list, when strategy = x y z, sum their number to a value
-    agent_scores = []
-    for i in strategy:
-            if i == "iWSLS":
-                indices = strategy.index(i)
-                agent = scores[indices]
-                agent_scores.append(agent)
-
-    # if sum(agent_scores) != 0:
-    #     print("iwsls scored", sum(agent_scores))
-    return sum(agent_scores)
+    return model.strategy_totals.score.get("iWSLS", 0)
 
 
 def get_wsls_cooperations(model):
     """ For acquiring the sum total cooperations of a strategy"""
-
-    # get the list of agent
-    strategy = [a.strategy for a in model.schedule.agents]
-    # get the list of agent performances
-    coops = [a.number_of_c for a in model.schedule.agents]
-    # for each in that list, when strategy = x y z, sum their number to a value
-    agent_coops = []
-    for i in strategy:
-            if i == "WSLS":
-                indices = strategy.index(i)
-                agent = coops[indices]
-                agent_coops.append(agent)
-
-    # if sum(agent_coops) != 0:
-    #     print("wsls cooped", sum(agent_coops))
-    return sum(agent_coops)
+    return model.strategy_totals.cooperations.get("WSLS", 0)
 
 
 def get_iwsls_cooperations(model):
     """ For acquiring the sum total cooperations of a strategy"""
-
-    # get the list of agent
-    strategy = [a.strategy for a in model.schedule.agents]
-    # get the list of agent performances
-    coops = [a.number_of_c for a in model.schedule.agents]
-    # for each in that list, when strategy = x y z, sum their number to a value
-    agent_coops = []
-    for i in strategy:
-            if i == "iWSLS":
-                indices = strategy.index(i)
-                agent = coops[indices]
-                agent_coops.append(agent)
-
-    # if sum(agent_coops) != 0:
-    #     print("iwsls cooped", sum(agent_coops))
-    return sum(agent_coops)
+    return model.strategy_totals.cooperations.get("iWSLS", 0)
 
 
 def get_learn_performance(model):
     """ For acquiring the sum total performance of a strategy"""
-
-    # get the list of agent
-    strategy = [a.strategy for a in model.schedule.agents]
-    # get the list of agent performances
-    scores = [a.score for a in model.schedule.agents]
-    # for each in that list, when strategy = x y z, sum their number to a value
-    agent_scores = []
-    for i in strategy:
-            if i == "LEARN":
-                indices = strategy.index(i)
-                agent = scores[indices]
-                agent_scores.append(agent)
-
-    # if sum(agent_scores) != 0:
-        # print("vpp scored", sum(agent_scores))
-    return sum(agent_scores)
+    return model.strategy_totals.score.get("LEARN", 0)
 
 
 def get_learn_mutC(model):
     """ For acquiring the sum total performance of a strategy"""
-
-    # get the list of agent
-    strategy = [a.strategy for a in model.schedule.agents]
-    # get the list of agent performances
-    mutc = [a.mutual_c_outcome for a in model.schedule.agents]
-    # for each in that list, when strategy = x y z, sum their number to a value
-    agent_mutc = []
-    for i in strategy:
-            if i == "LEARN":
-                indices = strategy.index(i)
-                agent = mutc[indices]
-                agent_mutc.append(agent)
-
-    # if sum(agent_scores) != 0:
-        # print("vpp scored", sum(agent_scores))
-    return sum(agent_mutc)
+    return model.strategy_totals.mutual_cooperations.get("LEARN", 0)
 
 
 def get_learn_cooperations(model):
     """ For acquiring the sum total cooperations of a strategy"""
-
-    # get the list of agent
-    strategy = [a.strategy for a in model.schedule.agents]
-    # get the list of agent performances
-    coops = [a.number_of_c for a in model.schedule.agents]
-    # for each in that list, when strategy = x y z, sum their number to a value
-    agent_coops = []
-    for i in strategy:
-            if i == "LEARN":
-                indices = strategy.index(i)
-                agent = coops[indices]
-                agent_coops.append(agent)
-
-    # if sum(agent_coops) != 0:
-        # print("vpp cooped", sum(agent_coops))
-    return sum(agent_coops)
+    return model.strategy_totals.cooperations.get("LEARN", 0)
 
 
 def get_moodylearn_performance(model):
     """ For acquiring the sum total performance of a strategy"""
-
-    # get the list of agent
-    strategy = [a.strategy for a in model.schedule.agents]
-    # get the list of agent performances
-    scores = [a.score for a in model.schedule.agents]
-    # for each in that list, when strategy = x y z, sum their number to a value
-    agent_scores = []
-    for i in strategy:
-            if i == "MOODYLEARN":
-                indices = strategy.index(i)
-                agent = scores[indices]
-                agent_scores.append(agent)
-
-    # if sum(agent_scores) != 0:
-        # print("vpp scored", sum(agent_scores))
-    return sum(agent_scores)
+    return model.strategy_totals.score.get("MOODYLEARN", 0)
 
 
 def get_moodylearn_mutC(model):
     """ For acquiring the sum total performance of a strategy"""
-
-    # get the list of agent
-    strategy = [a.strategy for a in model.schedule.agents]
-    # get the list of agent performances
-    mutc = [a.mutual_c_outcome for a in model.schedule.agents]
-    # for each in that list, when strategy = x y z, sum their number to a value
-    agent_mutc = []
-    for i in strategy:
-            if i == "MOODYLEARN":
-                indices = strategy.index(i)
-                agent = mutc[indices]
-                agent_mutc.append(agent)
-
-    # if sum(agent_scores) != 0:
-        # print("vpp scored", sum(agent_scores))
-    return sum(agent_mutc)
+    return model.strategy_totals.mutual_cooperations.get("MOODYLEARN", 0)
 
 
 def get_moodylearn_cooperations(model):
     """ For acquiring the sum total cooperations of a strategy"""
-
-    # get the list of agent
-    strategy = [a.strategy for a in model.schedule.agents]
-    # get the list of agent performances
-    coops = [a.number_of_c for a in model.schedule.agents]
-    # for each in that list, when strategy = x y z, sum their number to a value
-    agent_coops = []
-    for i in strategy:
-            if i == "MOODYLEARN":
-                indices = strategy.index(i)
-                agent = coops[indices]
-                agent_coops.append(agent)
-
-    # if sum(agent_coops) != 0:
-        # print("vpp cooped", sum(agent_coops))
-    return sum(agent_coops)
+    return model.strategy_totals.cooperations.get("MOODYLEARN", 0)
 
 
 def track_params(model):
@@ -442,8 +235,29 @@ class PDModel(Model):
 
 
                  sensitivity=0,
+
+                 engine="agents",  # "agents" steps each PDAgent, "array" runs the population as arrays
+                 history_retention="summary",  # average payoffs over the whole game, or the "last" history_length
+                 history_length=100,
+                 qtable_dtype="float64",  # float32 halves the memory of every agent's Q-table
+                 lazy_states=False,  # add states and Q-table rows as they're visited instead of enumerating them all
+                 state_cache_dir=None,  # a directory to keep the enumerated state spaces in between runs, as .npy
+                 telemetry_format="csv",  # agent output as one long .csv, or "npz" for typed per-partner columns
+                 telemetry_flush_every=100,  # steps of agent output to hold in memory between writes, see telemetry.py
+                 output_queue=64,  # writes that can wait for the output thread, or 0 to write them in the step loop
+                 output_policy="block",  # when output_queue is full, "block", "drop" or "spill" - see telemetry.py
+                 q_snapshot_every=0,  # steps between Q-table snapshots of every learner (see qsnapshot.py), 0 for none
+                 reporters=None,  # names of the model reporters to collect, None for all of them
+                 datacollector="columns",  # "columns" collects into numpy arrays (see columnstore.py), "mesa" in lists
+                 experiment=None,  # a name to keep this experiment's ppDs apart under, see runstore.PPDStore
+                 seed=None,  # seeds random, np.random and the array engine, so a run can be repeated exactly
+                 training_data_size=50,  # which training_data_N set VPP agents classify partners against, see knn.SIZES
                  ):
 
+        if seed is not None:  # (Model.__new__ has already seeded self.random with it)
+            random.seed(seed)
+            np.random.seed(seed)
+
         # ---------- Model Parameters --------
         self.height = height
         self.width = width
@@ -510,6 +324,11 @@ class PDModel(Model):
 
         self.sensitivity = sensitivity
         self.sensitive_agents = sensitive_agents
+        self.engine = engine
+        self.history_retention = history_retention
+        self.history_length = history_length
+        self.qtable_dtype = np.dtype(qtable_dtype)
+        self.population = None
         self.coop_index = (self.CC - self.DD) / (self.DC - self.CD)
 
         self.startingBehav = startingBehav
@@ -556,23 +375,8 @@ class PDModel(Model):
         # self.experimental_wsls = [30, 63, 96, 39, 72, 48, 81]
         # self.experimental_tft = [52, 85, 28, 61, 94, 37, 70]
 
-        with open('filename_number.csv', 'r') as f:
-            reader = csv.reader(f)  # pass the file to our csv reader
-            rows = []
-            for row in reader:
-                rows.append(row)
-
-            filenumber = rows[0]
-            filenumber = filenumber[0]
-            # filenumber = filenumber[3:]
-            filenumber = int(filenumber)
-            self.iteration_n = filenumber
-            self.new_filenumber = [filenumber + 1]
-
-        with open('filename_number.csv', 'w') as f:
-            # Overwrite the old file with the modified rows
-            writer = csv.writer(f)
-            writer.writerow(self.new_filenumber)
+        self.iteration_n = runstore.next_run_number()  # taken under a lock, so models can be made at once
+        self.new_filenumber = [self.iteration_n + 1]
 
         # self.iteration_n needs to be pulled from a csv file and then deleted from said csv file
         if self.sarsa_spawn:
@@ -588,6 +392,10 @@ class PDModel(Model):
         else:
             concatenator = ('xxx_nosarsa_no_%s' % (self.iteration_n), "a")
         self.exp_n = concatenator[0]
+        self.telemetry_format = telemetry_format
+        self.output = telemetry.BackgroundWriter(output_queue, output_policy)
+        self.q_snapshot_every = q_snapshot_every
+        self.telemetry = telemetry.writer(telemetry_format, self.exp_n, telemetry_flush_every, self.output)
 
         self.filename = ('%s model output.csv' % (self.exp_n), "a")
 
@@ -635,7 +443,8 @@ class PDModel(Model):
         self.defects_utility = 0
         self.highest_score = 0
 
-        self.datacollector = DataCollector(model_reporters={
+        self.strategy_totals = strategytotals.StrategyTotals()  # what the per-strategy reporters read
+        model_reporters = {
             "Cooperations": get_num_coop_agents,
             "Defections": get_num_defect_agents,
             "Cooperators": get_cooperators,
@@ -655,67 +464,88 @@ class PDModel(Model):
             "moodyMutualCooperations": get_moodylearn_mutC,
             "moodyLEARN Cooperations": get_moodylearn_cooperations,
             "Model Params": track_params,
-        },
-            agent_reporters={
-                "Cooperations": lambda x: x.number_of_c,
-                "Defections": lambda x: x.number_of_d
-            })
-
-        self.memory_states = statemaker.get_memory_states([0, 'C', 'D'], self.msize, self.memoryPaired)
-        self.moody_memory_states = statemaker_moody.get_memory_states([0, 'C', 'D'], self.moody_statemode, self.number_of_agents)
-        self.state_values = self.state_evaluation(self.memory_states)
-        self.moody_state_values = self.moody_state_evaluation(self.moody_memory_states)
-
+        }
+        if reporters is not None:
+            unknown = set(reporters) - set(model_reporters)
+            if unknown:
+                raise ValueError("No model reporters called %s" % ", ".join(sorted(unknown)))
+            # only what's asked for is worked out each step
+            model_reporters = dict((name, model_reporters[name]) for name in reporters)
+        agent_reporters = {
+            "Cooperations": lambda x: x.number_of_c,
+            "Defections": lambda x: x.number_of_d
+        }
+        if datacollector == "columns":
+            # room for the collect at the start and one a round, see columnstore.ColumnCollector
+            self.datacollector = columnstore.ColumnCollector(model_reporters, agent_reporters, steps=self.rounds + 1)
+        elif datacollector == "mesa":
+            self.datacollector = DataCollector(model_reporters=model_reporters, agent_reporters=agent_reporters)
+        else:
+            raise ValueError("datacollector should be 'columns' or 'mesa', not %r" % (datacollector,))
+
+        # statemaker can't enumerate long memories, so those always find their states as they go
+        self.lazy_states = lazy_states or not statemaker.enumerates(self.msize, self.memoryPaired)
+        if self.lazy_states:
+            # every model grows an index of its own
+            self.memory_states = []
+            self.moody_memory_states = []
+            self.memory_state_codes = []
+            self.moody_memory_state_codes = []
+            self.memory_state_index = qtable.StateIndex([], True)
+            self.moody_memory_state_index = qtable.StateIndex([], True)
+            self.state_values = []
+            self.moody_state_values = []
+            self.update_value_table = statespace.UpdateValues([], [], self.memoryPaired, True)
+        else:
+            # shared with every model in this process that has the same memory settings - never write to them
+            space = statespace.memory_space([0, 'C', 'D'], self.msize, self.memoryPaired, state_cache_dir)
+            moody_space = statespace.moody_space([0, 'C', 'D'], self.moody_statemode, self.number_of_agents,
+                                                 self.moody_memoryPaired, state_cache_dir)
+            self.memory_states = space.states
+            self.moody_memory_states = moody_space.states
+            self.memory_state_codes = space.codes
+            self.moody_memory_state_codes = moody_space.codes
+            self.memory_state_index = space.index
+            self.moody_memory_state_index = moody_space.index
+            self.state_values = space.values
+            self.moody_state_values = moody_space.values
+            self.update_value_table = space.update_values
+
+        self.ppd_store = runstore.PPDStore(experiment)
         self.firstgame = self.first_game_check()
         self.agent_ppds = {}
-        self.set_ppds()
-        self.agent_ppds = pickle.load(open("agent_ppds.p", "rb"))
-        self.training_data = []
-        self.training_data = pickle.load(open("training_data_50.p", "rb"))  # //////////////////////////////////////////////////////////////////////////////////////////////////////////////////////////////////////
+        self.agent_ppds = self.ppd_store.load()
+        self.training_data_file = knn.training_file(training_data_size)  # read on first use and shared, see knn.training_set
 
         if not kNN_spawn:
             self.make_agents()
         elif kNN_spawn:
             self.make_set_agents()
+        # every LEARN agent's Q-table lives in the one store, so a round's SARSA updates can be made together
+        self.q_store = qtable.QStore(self.memory_state_index, 2, self.qtable_dtype)
+        self.sarsa_updates = sarsa.BatchUpdate(self.q_store)
+        if self.engine == "array":
+            self.population = ArrayEngine(self)
         self.running = True
         self.datacollector.collect(self)
 
     def first_game_check(self):
-        try:
-            success = pickle.load(open("firstgame.p", "rb"))
-            # print("Val of Success was : ", success)
-            if success == 1:
-                return False
-        except (OSError, IOError) as e:
-            foo = 1
-            pickle.dump(foo, open("firstgame.p", "wb"))
-            return True
+        """ The first model of an experiment to get here sets everyone's starting ppDs """
+        return self.ppd_store.begin(self.set_ppds)
 
     def output_data(self, steptime):
-        with open('{}.csv'.format(self.filename), 'a', newline='') as csvfile:
-            fieldnames = ['n agents', 'stepcount', 'steptime', 'cooperating', 'defecting', 'coop total', 'defect total',]
-
-            writer = csv.DictWriter(csvfile, fieldnames=fieldnames)
-
-            if self.step_count == 1:
-                writer.writeheader()
-            writer.writerow({'n agents': self.number_of_agents, 'stepcount': self.step_count, 'steptime': steptime, 'cooperating': self.agents_cooperating, 'defecting': self.agents_defecting,
-                             'coop total': self.number_of_coops, 'defect total': self.number_of_defects,
-                             })
+        self.output.submit(telemetry.write_rows, '{}.csv'.format(self.filename),
+                           ['n agents', 'stepcount', 'steptime', 'cooperating', 'defecting', 'coop total',
+                            'defect total'],
+                           [{'n agents': self.number_of_agents, 'stepcount': self.step_count, 'steptime': steptime,
+                             'cooperating': self.agents_cooperating, 'defecting': self.agents_defecting,
+                             'coop total': self.number_of_coops, 'defect total': self.number_of_defects}])
         if self.kNN_testing:
-            with open('{}_kNN.csv'.format(self.filename), 'a', newline='') as csvfile:
-                fieldnames = ['k', 'accuracy', 'accuracy_p',]
-
-                writer = csv.DictWriter(csvfile, fieldnames=fieldnames)
-
-                kNN_accuracy_percent = ((self.kNN_accuracy / 24) * 100)
-
-                if self.step_count == 1:
-                    writer.writeheader()
-                writer.writerow({'k': self.k, 'accuracy': self.kNN_accuracy, 'accuracy_p': kNN_accuracy_percent,
-                                 })
-
-                self.kNN_accuracy = 0  # Hopefully resetting this value here is fine
+            kNN_accuracy_percent = ((self.kNN_accuracy / 24) * 100)
+            self.output.submit(telemetry.write_rows, '{}_kNN.csv'.format(self.filename),
+                               ['k', 'accuracy', 'accuracy_p'],
+                               [{'k': self.k, 'accuracy': self.kNN_accuracy, 'accuracy_p': kNN_accuracy_percent}])
+            self.kNN_accuracy = 0  # Hopefully resetting this value here is fine
 
         # with open('{} agent strategies.csv'.format(self.filename), 'a', newline='') as csvfile:
         #     fieldnames = ['stepcount', 'agent_strategy']
@@ -797,99 +627,21 @@ class PDModel(Model):
         else:
             n_of_a = self.number_of_agents
 
-        if self.firstgame:
-            for i in range(n_of_a):
-                # print("n of a", i)
-                initialised[i + 1] = [self.init_ppD, self.init_ppD, self.init_ppD, self.init_ppD]
-                with open("agent_ppds.p", "wb") as f:
-                    pickle.dump(initialised, f)
+        for i in range(n_of_a):
+            # print("n of a", i)
+            initialised[i + 1] = [self.init_ppD, self.init_ppD, self.init_ppD, self.init_ppD]
 
-                """ This is used for setting ppD to a model-specified value. For agents
-                    to alter their own ppDs for, they must use the kNN system and 
-                    extract from a pickle file [INCOMPLETE] the classification of partner
-                    etc. from the previous game."""
+        """ This is used for setting ppD to a model-specified value. For agents
+            to alter their own ppDs for, they must use the kNN system and 
+            extract from a pickle file [INCOMPLETE] the classification of partner
+            etc. from the previous game."""
+        return initialised
 
     def state_evaluation(self, state_list):
-        # if self.stepCount == 1:
-
-        state_value = []
-        if not self.memoryPaired:
-
-            for i in state_list:
-                current_value = 0
-                for j in range(len(i)):
-                    item = i[j]
-                    # print("Array", i, "Index", j, "Item", item)
-                    if item == 'C':
-                        current_value = current_value + (1 * j)  # Slight bias towards cooperation
-                    if item == 'D':
-                        current_value = current_value - (1 * j)
-                    if item == 0:
-                        current_value = current_value
-                state_value.append(current_value)
-
-        elif self.memoryPaired:
-            for i in state_list:
-                counter = 0
-                i = list(i)
-                # print(i)
-                current_value = 0
-                for j in i:
-                    # item = i[1]  # should hopefully index the opponent's move in each of the pairs
-                    # TODO: I don't think state_evaluation currently affects anything but we will see
-                    item = j
-                    # print("Array", i, "Index", j, "Item", item)
-                    if item == 'C':
-                        current_value = current_value + (1 * counter)  # Should there be a slight bias towards C?
-                    if item == 'D':
-                        current_value = current_value - (1 * counter)
-                    if item == 0:
-                        current_value = current_value
-                    counter += 1
-                state_value.append(current_value)
-
-        return state_value
+        return statemaker.evaluate_states(state_list, self.memoryPaired)
 
     def moody_state_evaluation(self, state_list):
-        # if self.stepCount == 1:
-
-        state_value = []
-        if not self.moody_memoryPaired:
-
-            for i in state_list:
-                current_value = 0
-                for j in range(len(i)):
-                    item = i[j]
-                    # print("Array", i, "Index", j, "Item", item)
-                    if item == 'C':
-                        current_value = current_value + (1 * j)  # Slight bias towards cooperation
-                    if item == 'D':
-                        current_value = current_value - (1 * j)
-                    if item == 0:
-                        current_value = current_value
-                state_value.append(current_value)
-
-        elif self.moody_memoryPaired:
-            for i in state_list:
-                counter = 0
-                i = list(i)
-                # print(i)
-                current_value = 0
-                for j in i:
-                    # item = i[1]  # should hopefully index the opponent's move in each of the pairs
-                    # TODO: I don't think state_evaluation currently affects anything but we will see
-                    item = j
-                    # print("Array", i, "Index", j, "Item", item)
-                    if item == 'C':
-                        current_value = current_value + (1 * counter)  # Should there be a slight bias towards C?
-                    if item == 'D':
-                        current_value = current_value - (1 * counter)
-                    if item == 0:
-                        current_value = current_value
-                    counter += 1
-                state_value.append(current_value)
-
-        return state_value
+        return statemaker.evaluate_states(state_list, self.moody_memoryPaired)
 
     def get_highest_score(self):
         scores = [a.score for a in self.schedule.agents]
@@ -903,39 +655,16 @@ class PDModel(Model):
 
     def training_data_collector(self):
         if self.kNN_training:
-            if not os.path.isfile('training_data.p'):
-                training_data = []
-                with open("training_data.p", "wb") as f:
-                    pickle.dump(training_data, f)
-
+            # each game adds its own chunk - merge them into training_data.p with trainingstore.compact
             agent_training_data = [a.training_data for a in self.schedule.agents]
-            training_data = []
-
-            for i in agent_training_data:
-                # print("agent has:", i)
-                if len(i) is not 0:
-                    for j in range(len(i)):
-                        jj = i[j]
-                        # print("data to append", jj)
-                        training_data.append(jj)
-
-            # print("save data", save_data)
-            with open("training_data.p", "rb") as f:
-                training_update = pickle.load(f)
-
-            print("Training Data Size Pre-Update:", len(training_update))
-            for i in training_data:
-                training_update.append(i)
-            print("Training Data Size Post-Update:", len(training_update))
-            # print(training_update)
-            with open("training_data.p", "wb") as f:
-                pickle.dump(training_update, f)
+            training_data = [row for rows in agent_training_data for row in rows]
+            chunk = trainingstore.append(training_data)
+            print("Training Data Added:", len(training_data), "rows in", chunk)
         else:
             return
 
     def make_agents(self):
-        with open("agent_ppds.p", "rb") as f:
-            self.agent_ppds = pickle.load(f)
+        self.agent_ppds = self.ppd_store.load()
 
         if not self.randspawn:
             for i in range(self.number_of_agents):
@@ -958,43 +687,15 @@ class PDModel(Model):
                 self.grid.place_agent(pdagent, (x, y))
                 self.schedule.add(pdagent)
 
-    def export_q_tables(self, init):      # TODO: Does this need a moody counterpart? =============================
-        qs = [a.qtable for a in self.schedule.agents]
-        # we need to print/save a list of the keys
-        # then print/save each
-        # print('qs', qs)
-        qvals = []
-        for i in qs:
-            if i is not []:
-                # take each agent's qtable
-                # print('i', i)
-                for j in i:
-                    # take each item in that table
-                    temp_qs = []
-                    # print('j', j)
-                    item = i[j]
-                    for k in item:
-                        temp_qs.append(k)
-                        # append all the qvalues into one big list
-                    qvals.append(temp_qs)
-
-        # print('qvals', qvals)
-        if init:
-            with open('{} qinit.csv'.format(self.filename), 'a', newline='') as csvfile:
-                fieldnames = ['q']
-                writer = csv.DictWriter(csvfile, fieldnames=fieldnames)
-                writer.writeheader()
-                writer.writerow({'q': qvals})
-        else:
-            with open('{} qend.csv'.format(self.filename), 'a', newline='') as csvfile:
-                fieldnames = ['q']
-                writer = csv.DictWriter(csvfile, fieldnames=fieldnames)
-                writer.writeheader()
-                writer.writerow({'q': qvals})
+        self.index_partners()
+
+    def export_q_tables(self, init):
+        """ Every learner's Q-table, LEARN and MOODYLEARN, as '<filename> qinit.npz' or 'qend.npz' - see qsnapshot """
+        name = '{} qinit.npz' if init else '{} qend.npz'
+        return qsnapshot.save(self, name.format(self.filename), self.output)
 
     def update_agent_ppds(self, ppds):
-        with open("agent_ppds.p", "wb") as f:
-            pickle.dump(ppds, f)
+        self.ppd_store.save(ppds)
 
     def make_set_agents(self):
         # generate current experiment ppD pickle if one does not exist?
@@ -1015,10 +716,26 @@ class PDModel(Model):
             self.grid.place_agent(pdagent, (x, y))
             self.schedule.add(pdagent)
 
+        self.index_partners()
+
+    def index_partners(self):
+        """ Agents never move, so each one's N, E, S, W partners are looked up once here rather than on the grid
+            every time an agent picks moves, checks its partners or compares scores. """
+        self.partner_index = {}
+        for agent in self.schedule.agents:
+            agent.partners = agent.find_partners()
+            agent.n_partners = len(agent.partners)
+            self.partner_index[agent.ID] = [partner.ID for partner in agent.partners]
+
     def step(self):
 
         start = time.time()
-        self.schedule.step()
+        self.strategy_totals.begin_round()
+        if self.population is not None:
+            self.population.step()
+        else:
+            self.schedule.step()
+            self.sarsa_updates.apply(self)
         if self.step_count == self.rounds - 1:
             self.update_agent_ppds(self.agent_ppds)
             self.training_data_collector()
@@ -1028,6 +745,7 @@ class PDModel(Model):
         steptime = end - start
         if self.collect_data:
             self.output_data(steptime)
+            self.telemetry.end_step(self.step_count, final=self.step_count >= self.rounds - 1)
         self.datacollector.collect(self)
         self.get_highest_score()
         self.reset_values()
@@ -1038,22 +756,25 @@ class PDModel(Model):
         #     export intitial q tables
         if self.step_count == self.rounds-1:
             if self.export_q:
-                for j in self.memory_states:
-                    for k in range(2):
-                        with open('{} states_agent37.csv'.format(self.filename), 'a', newline='') as csvfile:
-                            fieldnames = ['state']
-                            writer = csv.DictWriter(csvfile, fieldnames=fieldnames)
-                            # writer.writeheader()
-                            writer.writerow({'state': j})
+                states = self.memory_states
+                if self.lazy_states:
+                    states = [encoding.decode_state(i) for i in self.memory_state_index.states]
+                self.output.submit(telemetry.write_rows, '{} states_agent37.csv'.format(self.filename), ['state'],
+                                   [{'state': j} for j in states for k in range(2)], False)
 
             if self.moody_export_q:
-                for j in self.moody_memory_states:
-                    for k in range(2):
-                        with open('{} states_agent36.csv'.format(self.filename), 'a', newline='') as csvfile:
-                            fieldnames = ['state']
-                            writer = csv.DictWriter(csvfile, fieldnames=fieldnames)
-                            # writer.writeheader()
-                            writer.writerow({'state': j})
+                states = self.moody_memory_states
+                if self.lazy_states:
+                    states = [encoding.decode_moody_state(i, self.moody_statemode, self.number_of_agents)
+                              for i in self.moody_memory_state_index.states]
+                self.output.submit(telemetry.write_rows, '{} states_agent36.csv'.format(self.filename), ['state'],
+                                   [{'state': j} for j in states for k in range(2)], False)
+
+        if self.q_snapshot_every and (self.step_count % self.q_snapshot_every == 0
+                                      or self.step_count == self.rounds - 1):
+            qsnapshot.save(self, output=self.output)
+        if self.step_count >= self.rounds - 1:
+            self.output.flush()  # the run's output is all on disk by the time it finishes
 
 
         # if self.step_count >= self.rounds:
@@ -1130,21 +851,27 @@ br_params = {#"number_of_agents": [64],
     Otherwise, it doesn't export the ppD variable correctly to the pickle! """
 
 
+# each run's step data is written out as it finishes (see sweep.save_step_data), rather than kept in its DataCollector
 br = BatchRunner(PDModel,
                  br_params,
                  iterations=5,
                  max_steps=10000,
-                 model_reporters={"Data Collector": lambda m: m.datacollector})
+                 model_reporters={"Step Data": lambda m: sweep.save_step_data(
+                     m, os.path.join("PDModel_Runs", "run_%s.csv" % m.iteration_n))})
+
+""" Sweeps run in parallel, one job per (combination, iteration), with finished jobs kept in PDModel_Sweep - see
+    sweep.py. Run with --serial for the BatchRunner above, e.g. when collecting kNN training data. """
 
-if __name__ == '__main__':
+if __name__ == '__main__' and "--serial" in sys.argv:
+    os.makedirs("PDModel_Runs", exist_ok=True)
     br.run_all()
     br_df = br.get_model_vars_dataframe()
-    br_step_data = pd.DataFrame()
-    for i in range(len(br_df["Data Collector"])):
-        if isinstance(br_df["Data Collector"][i], DataCollector):
-            i_run_data = br_df["Data Collector"][i].get_model_vars_dataframe()
-            br_step_data = br_step_data.append(i_run_data, ignore_index=True)
-    br_step_data.to_csv("PDModel_Step_Data_%s.csv" % (str(random.randint(1,200000))))  # this might not be as useful for importing
+    sweep.combine(list(br_df["Step Data"]), "PDModel_Step_Data_%s.csv" % (str(random.randint(1,200000))), label="run")
+elif __name__ == '__main__':
+    failed = sweep.run(PDModel, br_params, iterations=5, max_steps=10000, out_dir="PDModel_Sweep")
+    finished = sweep.results("PDModel_Sweep")
+    sweep.combine([r["step_data"] for r in finished], "PDModel_Step_Data_%s.csv" % (str(random.randint(1,200000))),
+                  [r["job"] for r in finished])
 
 
 
@@ -0,0 +1,140 @@
+""" A DataCollector that keeps its series in numpy columns.
+
+    mesa's DataCollector appends each model reporter's value to a python list every step, and every agent's values
+    as a tuple, so a 10,000 step, 64 agent run leaves hundreds of thousands of small objects behind it. ColumnCollector
+    collects the same reporters into one typed array per series, allocated up front for the steps the model is due
+    to run (and the agents it has, for agent reporters) and doubled if it runs on past them, and builds its
+    DataFrames straight from the arrays.
+
+    A column takes its type from its first value - bool, int64, float64, or object for anything else, such as the
+    Model Params tuple - and is widened (to float64, or object) if a later value doesn't fit. model_vars gives each
+    series as an array of the values so far, so the server's charts can still read model_vars[name][-1]. """
+
+from operator import attrgetter
+import numpy as np
+import pandas as pd
+
+
+def kind_of(value):
+    if isinstance(value, (bool, np.bool_)):
+        return np.dtype(bool)
+    if isinstance(value, (int, np.integer)):
+        return np.dtype(np.int64)
+    if isinstance(value, (float, np.floating)):
+        return np.dtype(np.float64)
+    return np.dtype(object)
+
+
+def wider(dtype, value):
+    """ A dtype that holds everything dtype does and value too """
+    new = kind_of(value)
+    if dtype == new:
+        return dtype
+    if dtype.kind in "iuf" and new.kind in "iuf":
+        return np.promote_types(dtype, new)
+    return np.dtype(object)
+
+
+class Column:
+    def __init__(self, capacity):
+        self.capacity = max(capacity, 1)
+        self.values = None
+        self.n = 0
+
+    def extend(self, values):
+        """ Add a step's values (a list) """
+        if not values:
+            return
+        if self.values is None:
+            self.values = np.empty(max(self.capacity, len(values)), dtype=kind_of(values[0]))
+        dtype = self.values.dtype
+        for value in values:
+            if dtype.kind == "O":
+                break
+            dtype = wider(dtype, value)
+        end = self.n + len(values)
+        if end > len(self.values) or dtype != self.values.dtype:
+            self.resize(max(end, 2 * len(self.values)) if end > len(self.values) else len(self.values), dtype)
+        try:
+            self.put(values)
+        except OverflowError:  # an int too big for int64
+            self.resize(len(self.values), np.dtype(object))
+            self.put(values)
+        self.n = end
+
+    def put(self, values):
+        if self.values.dtype.kind == "O":
+            # one at a time, so a tuple goes in as a value rather than being spread over the slots
+            for i, value in enumerate(values):
+                self.values[self.n + i] = value
+        else:
+            self.values[self.n:self.n + len(values)] = values
+
+    def resize(self, size, dtype):
+        new = np.empty(size, dtype=dtype)
+        new[:self.n] = self.values[:self.n]
+        self.values = new
+
+    def view(self):
+        if self.values is None:
+            return np.empty(0)
+        return self.values[:self.n]
+
+
+class ColumnCollector:
+    def __init__(self, model_reporters=None, agent_reporters=None, tables=None, steps=1000):
+        """ Takes the same reporters as mesa's DataCollector - functions of the model (or agent), or attribute
+            names. steps is how many collects to make room for up front. """
+        self.steps = steps
+        self.model_reporters = dict((name, attrgetter(r) if isinstance(r, str) else r)
+                                    for name, r in (model_reporters or {}).items())
+        self.agent_reporters = dict((name, attrgetter(r) if isinstance(r, str) else r)
+                                    for name, r in (agent_reporters or {}).items())
+        self.model_columns = dict((name, Column(steps)) for name in self.model_reporters)
+        self.agent_columns = None  # sized by the number of agents, at the first collect
+        self.tables = dict((name, dict((column, []) for column in columns)) for name, columns in (tables or {}).items())
+
+    def collect(self, model):
+        for name, reporter in self.model_reporters.items():
+            self.model_columns[name].extend([reporter(model)])
+        if self.agent_reporters:
+            agents = model.schedule.agents
+            if self.agent_columns is None:
+                capacity = self.steps * len(agents)
+                self.agent_columns = dict((name, Column(capacity))
+                                          for name in ["Step", "AgentID"] + list(self.agent_reporters))
+            self.agent_columns["Step"].extend([model.schedule.steps] * len(agents))
+            self.agent_columns["AgentID"].extend([a.unique_id for a in agents])
+            for name, reporter in self.agent_reporters.items():
+                self.agent_columns[name].extend([reporter(a) for a in agents])
+
+    @property
+    def model_vars(self):
+        return dict((name, column.view()) for name, column in self.model_columns.items())
+
+    def get_model_vars_dataframe(self):
+        return pd.DataFrame(self.model_vars)
+
+    def get_agent_vars_dataframe(self):
+        names = ["Step", "AgentID"] + list(self.agent_reporters)
+        if self.agent_columns is None:
+            return pd.DataFrame(columns=names).set_index(["Step", "AgentID"])
+        return pd.DataFrame(dict((name, self.agent_columns[name].view()) for name in names)).set_index(
+            ["Step", "AgentID"])
+
+    def add_table_row(self, table_name, row, ignore_missing=False):
+        """ As DataCollector.add_table_row - tables are rare and small, so they stay as lists """
+        if table_name not in self.tables:
+            raise Exception("Table does not exist.")
+        for column in self.tables[table_name]:
+            if column in row:
+                self.tables[table_name][column].append(row[column])
+            elif ignore_missing:
+                self.tables[table_name][column].append(None)
+            else:
+                raise Exception("Could not insert row with missing column")
+
+    def get_table_dataframe(self, table_name):
+        if table_name not in self.tables:
+            raise Exception("No such table.")
+        return pd.DataFrame(self.tables[table_name])
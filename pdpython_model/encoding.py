@@ -0,0 +1,140 @@
+""" Integer encodings for moves and SARSA states.
+
+    Moves are small ints - 0 for 'nothing yet', 1 for C and 2 for D - and a memory window of moves is packed into
+    one int, most recent move in the lowest digit, so shifting a new move into a window is a multiply, an add and a
+    modulo rather than a list pop/append and a fresh tuple to hash.
+
+    Windows of plain moves are base 3. Windows of (my move, their move) pairs are base 9, each pair being the digit
+    3 * mine + theirs. statemaker's state lists mix windows of different lengths, and [0, 'C'] and ['C'] would pack
+    to the same digits, so every code carries a leading 1 above its digits (base ** length + digits). Pair windows
+    are stored negated so they never collide with move windows. A bare pair like ('C', 'D') - what a paired agent
+    with a memory of one uses as its state - is just a move window of length two, exactly as the old tuple keys
+    treated it.
+
+    Moody states ([move], [move, partner ID] or [move, partner ID, mood]) pack into one int with the partner ID
+    and mood type as extra digits. """
+
+EMPTY, C, D = 0, 1, 2
+MOVE_CODES = {0: EMPTY, 'C': C, 'D': D}
+MOVE_NAMES = (0, 'C', 'D')
+
+MOOD_CODES = {0: 0, 'LOW': 1, 'NEUTRAL': 2, 'HIGH': 3}
+MOOD_NAMES = (0, 'LOW', 'NEUTRAL', 'HIGH')
+
+NO_STATE = None  # for things that can't match any state, e.g. a window of payoffs
+
+
+def encode_move(move):
+    return MOVE_CODES[move]
+
+
+def decode_move(code):
+    return MOVE_NAMES[code]
+
+
+def pair_digit(my_move, partner_move):
+    return 3 * MOVE_CODES[my_move] + MOVE_CODES[partner_move]
+
+
+def window_code(digits, base=3):
+    """ Pack a window of move (base 3) or pair (base 9) digits, eldest first """
+    code = 1
+    for d in digits:
+        code = code * base + d
+    if base == 9:
+        return -code
+    return code
+
+
+def shift(code, digit, size, base=3):
+    """ Drop the eldest digit of a size-long window and add a new one on the end """
+    top = base ** size
+    if base == 9:
+        return -(top + ((-code - top) * base + digit) % top)
+    return top + ((code - top) * base + digit) % top
+
+
+def blank_window(size, paired=False):
+    """ A window that has seen nothing yet. A paired memory of one is a bare (0, 0) pair - see state_code. """
+    if paired and size > 1:
+        return window_code([0] * size, 9)
+    if paired:
+        return window_code([0, 0])
+    return window_code([0] * size)
+
+
+def state_code(state):
+    """ Encode a state the way it used to key a Q-table, i.e. as tuple(state). Anything that isn't a window of
+        moves or of pairs gets NO_STATE. """
+    state = tuple(state)
+    if all(isinstance(i, tuple) for i in state) and len(state) > 0:
+        if not all(len(i) == 2 and i[0] in MOVE_CODES and i[1] in MOVE_CODES for i in state):
+            return NO_STATE
+        return window_code([pair_digit(i[0], i[1]) for i in state], 9)
+    if not all(not isinstance(i, tuple) and i in MOVE_CODES for i in state):
+        return NO_STATE
+    return window_code([MOVE_CODES[i] for i in state])
+
+
+def decode_state(code):
+    """ The tuple key a code stands for, for output """
+    if code is NO_STATE:
+        return None
+    base = 9 if code < 0 else 3
+    code = abs(code)
+    digits = []
+    while code > 1:
+        digits.append(code % base)
+        code //= base
+    digits.reverse()
+    if base == 9:
+        return tuple((MOVE_NAMES[d // 3], MOVE_NAMES[d % 3]) for d in digits)
+    return tuple(MOVE_NAMES[d] for d in digits)
+
+
+def window_length(code):
+    base = 9 if code < 0 else 3
+    code = abs(code)
+    n = 0
+    while code > 1:
+        code //= base
+        n += 1
+    return n
+
+
+def payoff_window_code(window):
+    """ change_update_value compares a window against the move states. A window of payoffs can only ever equal one
+        when every payoff in it is zero, in which case it matches the all-empty move window of the same length. """
+    if any(window):
+        return NO_STATE
+    return window_code([0] * len(window))
+
+
+def moody_state_code(move, partner_ID, mood, statemode, n_agents):
+    """ Pack sarsa_moody's [move], [move, ID] or [move, ID, mood] state. IDs run from 1 to n_agents, with 0 for the
+        blank starting state. """
+    if statemode == 'stateless':
+        return MOVE_CODES[move]
+    code = MOVE_CODES[move] * (n_agents + 1) + partner_ID
+    if statemode == 'agentstate':
+        return code
+    return code * 4 + MOOD_CODES[mood]
+
+
+def moody_state_from_list(state, statemode, n_agents):
+    if statemode == 'stateless':
+        return moody_state_code(state[0], 0, 0, statemode, n_agents)
+    elif statemode == 'agentstate':
+        return moody_state_code(state[0], state[1], 0, statemode, n_agents)
+    return moody_state_code(state[0], state[1], state[2], statemode, n_agents)
+
+
+def decode_moody_state(code, statemode, n_agents):
+    """ Back to the list form observe_state used to return, for output """
+    if statemode == 'stateless':
+        return [MOVE_NAMES[code]]
+    if statemode == 'agentstate':
+        return [MOVE_NAMES[code // (n_agents + 1)], code % (n_agents + 1)]
+    mood = code % 4
+    code //= 4
+    return [MOVE_NAMES[code // (n_agents + 1)], code % (n_agents + 1), MOOD_NAMES[mood]]
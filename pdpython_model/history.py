@@ -0,0 +1,62 @@
+""" Per-partner payoff history for PDAgent.
+
+    Every agent used to keep an ever-growing python list per partner of all the payoffs it ever got from them, only
+    ever to average it - for its avp/globav output and for the mood update. On long runs that's a steady climb in
+    memory. PartnerHistory keeps what the average needs instead, under a retention policy picked on the model:
+        'summary' - a running total and count, so mean() is the average over the whole game (as it always was)
+        'last'    - the most recent `length` payoffs in a typed numpy ring buffer, so mean() is the average over
+                    those only, and the agent's mood follows how a partner has treated it lately """
+
+import numpy as np
+
+RETENTION_POLICIES = ('summary', 'last')
+
+
+class PartnerHistory:
+    def __init__(self, retention='summary', length=100, dtype=np.float64):
+        if retention not in RETENTION_POLICIES:
+            raise ValueError("Unknown history retention %s, pick one of %s" % (retention, RETENTION_POLICIES))
+        if retention == 'last' and length < 1:
+            raise ValueError("A 'last' history needs a length of at least 1")
+        self.retention = retention
+        self.length = length
+        self.dtype = dtype
+
+        self.total = {}  # over the whole game under 'summary', over what's in the ring under 'last'
+        self.count = {}
+        self.buffers = {}
+        self.written = {}  # how many values have gone into each ring (including ones it has overwritten)
+
+    def __contains__(self, partner_ID):
+        return partner_ID in self.count
+
+    def open(self, partner_ID, *initial):
+        """ Start a history for a new partner, optionally seeded with some starting values """
+        self.total[partner_ID] = 0
+        self.count[partner_ID] = 0
+        if self.retention == 'last':
+            self.buffers[partner_ID] = np.empty(self.length, dtype=self.dtype)
+            self.written[partner_ID] = 0
+        for value in initial:
+            self.add(partner_ID, value)
+
+    def add(self, partner_ID, value):
+        if self.retention == 'summary':
+            self.total[partner_ID] += value
+            self.count[partner_ID] += 1
+            return
+        buffer = self.buffers[partner_ID]
+        n = self.written[partner_ID]
+        if n < self.length:
+            self.count[partner_ID] += 1
+        else:
+            self.total[partner_ID] -= buffer[n % self.length].item()  # the value about to be overwritten
+        buffer[n % self.length] = value
+        self.total[partner_ID] += value
+        self.written[partner_ID] = n + 1
+
+    def mean(self, partner_ID):
+        return self.total[partner_ID] / self.count[partner_ID]
+
+    def partners(self):
+        return list(self.count)
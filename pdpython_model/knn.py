@@ -0,0 +1,196 @@
+""" The kNN training data VPP agents classify their partners against at the end of a game.
+
+    Each row is [utility, my cooperations, their cooperations, mutual cooperations, ppD, partner class], as
+    PDAgent.export_training_data writes them. A training set is loaded the first time something asks for it and then
+    kept, once per process, as a read-only float array that every model and agent reads without copying.
+
+    The sets are collected as pickles of lists of rows, which are slow to unpickle and take a python object per
+    number. convert (or python -m pdpython_model.knn training_data_*.p) writes a set out column by column as a .npy
+    beside its pickle, and from then on training_set memory-maps that instead. It takes the csv copies of the sets
+    just as well, which is handy where only the csv has been kept.
+
+    Partners are classified by their k nearest rows (cosine distance over the first five columns) among the rows
+    that share their ppD, and the Classifier for a set is likewise built once and shared, as is the PPDTable of
+    which ppD to play against each class. Both belong to the loaded array, so when a training file changes on disk
+    and is loaded again they are rebuilt with it. """
+
+import os
+import pickle
+import statistics
+import sys
+import numpy as np
+
+UTILITY, SELF_COOPS, OPP_COOPS, MUTUAL_COOPS, PPD, CLASS = range(6)
+SIZES = (5, 10, 25, 50, 75, 100, 150, 200, 250)  # the training_data_N sets that come with the model
+# which column ppd_select's optimisation choices maximise - U for utility, MC my cooperations, OC theirs, MutC mutual
+OPTIMISATION_COLUMNS = {'U': UTILITY, 'MC': SELF_COOPS, 'OC': OPP_COOPS, 'MutC': MUTUAL_COOPS}
+
+_training_sets = {}
+_classifiers = {}
+_ppd_tables = {}
+
+
+def training_file(size):
+    """ The training set collected over size games """
+    return "training_data_%d.p" % size
+
+
+def binary_file(filename):
+    return os.path.splitext(filename)[0] + ".npy"
+
+
+def source(filename):
+    """ The file training_set reads for filename - its .npy, unless the pickle has been written since """
+    path = binary_file(filename)
+    if not os.path.exists(path):
+        return filename
+    if path != filename and os.path.exists(filename) and os.stat(filename).st_mtime_ns > os.stat(path).st_mtime_ns:
+        return filename
+    return path
+
+
+def read_pickle(filename):
+    with open(filename, "rb") as f:
+        return np.array(pickle.load(f), dtype=np.float64).reshape(-1, 6)
+
+
+def read_csv(filename):
+    """ A training set saved as a csv, with a header row and the same six columns as the pickle """
+    return np.loadtxt(filename, delimiter=",", skiprows=1, dtype=np.float64, ndmin=2).reshape(-1, 6)
+
+
+def convert(filename):
+    """ Write the training set in filename, a pickle or its csv copy, to a .npy beside it, one column after
+        another so the file can be memory-mapped and each column read in one go. Returns the new file's name. """
+    path = binary_file(filename)
+    rows = read_csv(filename) if filename.endswith(".csv") else read_pickle(filename)
+    columns = np.ascontiguousarray(rows.T)
+    # write then rename, so another process never maps half a file
+    with open(path + ".part", "wb") as f:
+        np.save(f, columns)
+    os.replace(path + ".part", path)
+    return path
+
+
+def training_set(filename):
+    """ The rows in filename as an (n, 6) float array. Nothing may write to it - it is shared. If the file has been
+        written to since we loaded it, e.g. by trainingstore.compact, it is loaded again. """
+    path = source(filename)
+    stamp = os.stat(path)
+    stamp = (path, stamp.st_mtime_ns, stamp.st_size)
+    if filename not in _training_sets or _training_sets[filename][0] != stamp:
+        forget(filename)
+        if path.endswith(".npy"):
+            rows = np.load(path, mmap_mode='r').T  # stored as (6, n)
+        else:
+            rows = read_pickle(path)
+        rows.setflags(write=False)
+        _training_sets[filename] = (stamp, rows)
+    return _training_sets[filename][1]
+
+
+def built_for(cache, rows, build):
+    """ cache's build(rows), made the first time it's asked for """
+    key = id(rows)
+    if key not in cache or cache[key][0] is not rows:
+        cache[key] = (rows, build(rows))
+    return cache[key][1]
+
+
+def classifier(rows):
+    """ The Classifier for a training set """
+    return built_for(_classifiers, rows, Classifier)
+
+
+def ppd_table(rows):
+    """ The PPDTable for a training set """
+    return built_for(_ppd_tables, rows, PPDTable)
+
+
+def forget(filename=None):
+    """ Drop a loaded training set (or all of them) and everything built from it """
+    if filename is None:
+        _training_sets.clear()
+        _classifiers.clear()
+        _ppd_tables.clear()
+    elif filename in _training_sets:
+        rows = _training_sets.pop(filename)[1]
+        _classifiers.pop(id(rows), None)
+        _ppd_tables.pop(id(rows), None)
+
+
+def unit_rows(features):
+    """ Each row scaled to length one, so cosine distance is one minus a dot product. All-zero rows stay zero. """
+    norms = np.linalg.norm(features, axis=1)
+    norms[norms == 0] = 1
+    return features / norms[:, None]
+
+
+class Classifier:
+    def __init__(self, rows):
+        """ The rows are grouped by ppD and their feature vectors normalised up front, so classifying a sample is
+            one matrix-vector product against its group and an argpartition for the k nearest """
+        order = np.argsort(rows[:, PPD], kind='stable')
+        self.features = unit_rows(rows[order, :CLASS])
+        self.classes = rows[order, CLASS].astype(np.int64)
+        self.ppds, self.starts, counts = np.unique(rows[order, PPD], return_index=True, return_counts=True)
+        self.ends = self.starts + counts
+
+    def group(self, ppd):
+        """ Where the rows for ppd start and end """
+        i = np.searchsorted(self.ppds, ppd)
+        if i < len(self.ppds) and self.ppds[i] == ppd:
+            return self.starts[i], self.ends[i]
+        return 0, 0
+
+    def classify(self, sample, k):
+        """ sample is [utility, selfcoops, oppcoops, mutcoops, ppd]. Returns the classes of the k nearest rows,
+            closest first, and the most common of them (the closest, if it's a tie). """
+        return self.classify_many([sample], k)[0]
+
+    def classify_many(self, samples, k):
+        """ classify for a whole batch, e.g. every partner of every VPP agent at once - the samples that share a
+            ppD are scored against its group together """
+        samples = np.asarray(samples, dtype=np.float64).reshape(-1, CLASS)
+        unit = unit_rows(samples)
+        results = [None] * len(samples)
+        for ppd in np.unique(samples[:, PPD]):
+            which = np.flatnonzero(samples[:, PPD] == ppd)
+            start, end = self.group(ppd)
+            if start == end:
+                for i in which:
+                    results[i] = ([], 1)  # nothing to compare against, so the old default class
+                continue
+            distance = 1 - unit[which] @ self.features[start:end].T
+            n = min(k, end - start)
+            nearest = np.argpartition(distance, n - 1, axis=1)[:, :n]
+            for row, i in enumerate(which):
+                near = nearest[row]
+                near = near[np.lexsort((near, distance[row, near]))]  # closest first
+                categories = self.classes[start + near].tolist()
+                results[i] = (categories, statistics.mode(categories))
+        return results
+
+
+class PPDTable:
+    def __init__(self, rows):
+        """ For each partner class and optimisation choice, the ppD of the training row of that class that scored
+            highest in the chosen column - the last such row, where several tie """
+        self.best = {}
+        classes = rows[:, CLASS]
+        for c in np.unique(classes):
+            members = rows[classes == c]
+            for choice, col in OPTIMISATION_COLUMNS.items():
+                values = members[::-1, col]
+                self.best[int(c), choice] = float(members[len(members) - 1 - np.argmax(values), PPD])
+
+    def select(self, classification, optimisation_choice):
+        """ Unknown choices optimise utility. None if there is no training data for that class. """
+        if optimisation_choice not in OPTIMISATION_COLUMNS:
+            optimisation_choice = 'U'
+        return self.best.get((int(classification), optimisation_choice))
+
+
+if __name__ == '__main__':
+    for name in sys.argv[1:]:
+        print(name, "->", convert(name))
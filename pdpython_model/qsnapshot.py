@@ -0,0 +1,124 @@
+""" Snapshots of every learner's Q-table, one .npz per snapshot.
+
+    The Q-tables used to go out a value at a time - outputQtable opened '<exp> qinit_agent37.csv' once per Q value,
+    the model opened the states_agent files twice per state, and export_q_tables printed every table to stdout. A
+    snapshot instead holds, for each kind of learner (LEARN and MOODYLEARN), the agents' IDs, one (agents, states,
+    actions) array of their Q values and the state code of each row, as numpy arrays, so saving one is a copy of
+    the arrays and a single file write. load reads a snapshot back, with the codes decoded into the state labels the
+    old CSVs printed, and frame turns it into a long DataFrame.
+
+    Models given q_snapshot_every take one every that many steps, and at the end of the run, under
+    '<filename> qtables/'. The write itself goes through the model's output writer (see telemetry.py). """
+
+import os
+import numpy as np
+import pandas as pd
+from pdpython_model import encoding
+from pdpython_model import qtable
+
+KINDS = ("LEARN", "MOODYLEARN")
+NO_STATE_CODE = 0  # what NO_STATE is saved as - no LEARN state packs to 0, see encoding.py
+
+
+def learners(model, kind):
+    """ The IDs of the model's kind of learner, and a copy of their Q values as one (agents, states, 2) array """
+    index = model.memory_state_index if kind == "LEARN" else model.moody_memory_state_index
+    n = len(index)
+    engine = model.population
+    if engine is not None:
+        which = engine.learner if kind == "LEARN" else engine.moody
+        values = engine.q if kind == "LEARN" else engine.mq
+        ids = [engine.agents[i].ID for i in np.flatnonzero(which)]
+        if values is None:
+            return np.zeros(0, dtype=np.int32), np.zeros((0, n, 2))
+        return np.array(ids, dtype=np.int32), values[:, :n].copy()
+    ids, tables = [], []
+    for agent in model.schedule.agents:
+        table = agent.qtable if kind == "LEARN" else agent.moody_qtable
+        if agent.strategy == kind and isinstance(table, qtable.QTable):
+            ids.append(agent.ID)
+            tables.append(table.q)
+    values = np.zeros((len(tables), n, 2), dtype=tables[0].dtype if tables else np.float64)
+    for i, q in enumerate(tables):
+        # on a lazy index a table only grows when it looks a new state up, so it can be short - the rest are zeros
+        values[i, :len(q)] = q[:n]
+    return np.array(ids, dtype=np.int32), values
+
+
+def state_codes(index):
+    return np.array([NO_STATE_CODE if code is encoding.NO_STATE else code for code in index.states], dtype=np.int64)
+
+
+def take(model):
+    """ Everything a snapshot of model holds, as of now """
+    arrays = {"step": np.int64(model.step_count),
+              "moody_statemode": np.str_(model.moody_statemode),
+              "number_of_agents": np.int64(model.number_of_agents)}
+    for kind, index in zip(KINDS, (model.memory_state_index, model.moody_memory_state_index)):
+        ids, values = learners(model, kind)
+        arrays[kind + "_agents"] = ids
+        arrays[kind + "_q"] = values
+        arrays[kind + "_states"] = state_codes(index)
+    return arrays
+
+
+def write(path, arrays):
+    os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+    with open(path + ".part", "wb") as f:
+        np.savez_compressed(f, **arrays)
+    os.replace(path + ".part", path)
+    return path
+
+
+def path_for(model):
+    return os.path.join("{} qtables".format(model.filename), "step_%06d.npz" % model.step_count)
+
+
+def save(model, path=None, output=None):
+    """ Snapshot every learner's Q-table to path (by default a file per step under '<filename> qtables/'), on output
+        (a telemetry.BackgroundWriter) if given. Returns the path. """
+    path = path or path_for(model)
+    arrays = take(model)
+    if output is None:
+        return write(path, arrays)
+    output.submit(write, path, arrays)
+    return path
+
+
+def label(kind, code, statemode, n_agents):
+    """ The state a code stands for, as the old CSV exports printed it """
+    if kind == "LEARN":
+        return encoding.decode_state(encoding.NO_STATE if code == NO_STATE_CODE else code)
+    return encoding.decode_moody_state(code, statemode, n_agents)
+
+
+def load(path):
+    """ A snapshot as {'step': n, 'LEARN': {...}, 'MOODYLEARN': {...}}, each kind giving its learners' 'agents',
+        their 'q' values, (agents, states, actions), and the 'codes' and 'states' (labels) of the rows """
+    with np.load(path) as f:
+        statemode, n_agents = str(f["moody_statemode"]), int(f["number_of_agents"])
+        snapshot = {"step": int(f["step"])}
+        for kind in KINDS:
+            codes = f[kind + "_states"]
+            snapshot[kind] = {"agents": f[kind + "_agents"],
+                              "q": f[kind + "_q"],
+                              "codes": codes,
+                              "states": [label(kind, int(code), statemode, n_agents) for code in codes]}
+    return snapshot
+
+
+def snapshots(directory):
+    """ The snapshot files in directory, in step order """
+    return [os.path.join(directory, name) for name in sorted(os.listdir(directory)) if name.endswith(".npz")]
+
+
+def frame(snapshot, kind="LEARN"):
+    """ One kind of learner's tables from a loaded snapshot as a DataFrame, a row per agent and state, with a column
+        per action """
+    tables = snapshot[kind]
+    n_agents, n_states = tables["q"].shape[:2]
+    return pd.DataFrame({"step": snapshot["step"],
+                         "agent": np.repeat(tables["agents"], n_states),
+                         "state": [str(s) for s in tables["states"]] * n_agents,
+                         "C": tables["q"][:, :, 0].ravel(),
+                         "D": tables["q"][:, :, 1].ravel()})
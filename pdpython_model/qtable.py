@@ -0,0 +1,164 @@
+""" Dense Q-table storage for LEARN and MOODYLEARN agents.
+
+    A Q-table used to be a dict from state to a python list of Q values, built afresh for every agent from the full
+    state list. QTable keeps the values in one (n_states, n_actions) numpy array instead, with a StateIndex mapping
+    each packed state code (see encoding.py) to its row. The index is built once per model and shared by every
+    agent's table, so an agent's table is just its array.
+
+    qtable[state] gives that state's row as a view, so the existing code that reads current[0] / current[1] and
+    writes back into the row keeps working.
+
+    A lazy StateIndex starts empty (or with just the states it's given) and hands out a new row the first time a
+    state is looked up, with every table on it growing to match, so memory scales with the states actually visited
+    rather than with 3 ** msize. """
+
+import numpy as np
+
+
+def grown(values, n_rows, axis=0):
+    """ A copy of values with room for at least n_rows along axis, doubling so repeated growth stays cheap """
+    shape = list(values.shape)
+    shape[axis] = max(n_rows, 2 * shape[axis])
+    new = np.zeros(shape, dtype=values.dtype)
+    new[tuple(slice(0, n) for n in values.shape)] = values
+    return new
+
+
+class StateIndex:
+    def __init__(self, codes=(), lazy=False):
+        """ codes are the packed states in statemaker order, repeats and all - a repeated state shares the row of
+            its first appearance, as repeated dict keys used to. If lazy, states not in codes get a row on first
+            lookup instead of being a KeyError. """
+        self.lazy = lazy
+        self.codes = list(codes)
+        self.rows = {}
+        self.states = []  # the distinct codes, in row order
+        for code in self.codes:
+            if code not in self.rows:
+                self.add(code)
+        self.positions = np.array([self.rows[code] for code in self.codes], dtype=np.int64)
+
+    def add(self, code):
+        self.rows[code] = len(self.states)
+        self.states.append(code)
+        return self.rows[code]
+
+    def __len__(self):
+        return len(self.rows)
+
+    def __contains__(self, code):
+        return code in self.rows
+
+    def row(self, code):
+        if code in self.rows:
+            return self.rows[code]
+        if not self.lazy:
+            raise KeyError(code)
+        return self.add(code)
+
+
+class QTable:
+    def __init__(self, index, n_actions=2, dtype=np.float64, values=None):
+        self.index = index
+        if values is None:
+            values = np.zeros((len(index), n_actions), dtype=dtype)
+        self.q = values
+        self.slot = None  # our place in a QStore, if we live in one
+        self.store = None
+
+    def __getitem__(self, state):
+        try:
+            return self.q[self.index.rows[state]]
+        except (KeyError, IndexError):
+            # a state new to a lazy index, or one another table on it has already added
+            row = self.row(state)
+            return self.q[row]
+
+    def __setitem__(self, state, values):
+        row = self.row(state)
+        self.q[row] = values
+
+    def row(self, state):
+        """ state's row, making room for it first if need be """
+        row = self.index.row(state)
+        if row >= len(self.q):
+            if self.store is not None and self.store.holds(self):
+                self.store.grow(row + 1)
+            else:
+                self.q = grown(self.q, row + 1)
+        return row
+
+    def __contains__(self, state):
+        return state in self.index
+
+    def __len__(self):
+        return len(self.index)
+
+    def __iter__(self):
+        return iter(self.index.states)
+
+    def keys(self):
+        return list(self.index.states)
+
+    def items(self):
+        return zip(self.index.states, self.q)
+
+    def values(self):
+        return iter(self.q[:len(self.index)])
+
+    def __repr__(self):
+        return 'QTable(%d states x %d actions)' % (len(self.index), self.q.shape[1])
+
+
+class QStore:
+    def __init__(self, index, n_actions=2, dtype=np.float64):
+        """ One array holding the learners' Q-tables, a row per agent, so a whole population's tables can be read
+            and updated together. Agents only turn out to be learners as they pick their strategies, so a table
+            starts out on an array of its own, and pack() moves them all into the store - sized by the learners
+            there are, rather than the whole population - where each agent's QTable is a view onto its row. """
+        self.index = index
+        self.n_actions = n_actions
+        self.dtype = dtype
+        self.q = None
+        self.packed = 0  # how many of the tables live in q so far
+        self.rows = {}  # agent ID to its row
+        self.tables = []  # in row order
+
+    def new_table(self, agent_id):
+        """ A zeroed Q-table for the agent - the one it already has, if it's asked before """
+        if agent_id in self.rows:
+            table = self.tables[self.rows[agent_id]]
+            table.q[:] = 0
+            return table
+        table = QTable(self.index, self.n_actions, self.dtype)
+        table.slot = self.rows[agent_id] = len(self.tables)
+        table.store = self
+        self.tables.append(table)
+        return table
+
+    def holds(self, table):
+        return table.slot < self.packed
+
+    def pack(self):
+        """ Move any tables made since the last pack into the store """
+        if self.packed == len(self.tables):
+            return
+        n_states = max(len(table.q) for table in self.tables)
+        if self.q is None:
+            self.q = np.zeros((len(self.tables), n_states, self.n_actions), dtype=self.dtype)
+        else:
+            if n_states > self.q.shape[1]:
+                self.q = grown(self.q, n_states, axis=1)
+            if len(self.tables) > len(self.q):
+                self.q = grown(self.q, len(self.tables))
+        for table in self.tables[self.packed:]:
+            self.q[table.slot, :len(table.q)] = table.q
+        self.packed = len(self.tables)
+        for table in self.tables:
+            table.q = self.q[table.slot]
+
+    def grow(self, n_rows):
+        """ Make room for n_rows states in every table in the store, for when a lazy index outgrows us """
+        self.q = grown(self.q, n_rows, axis=1)
+        for table in self.tables[:self.packed]:
+            table.q = self.q[table.slot]
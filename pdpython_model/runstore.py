@@ -0,0 +1,89 @@
+""" The state models share through files in the working directory - run numbers and the ppDs VPP agents carry from
+    one game to the next.
+
+    Each model used to read filename_number.csv and write back the next number, and set_ppds / first_game_check /
+    update_agent_ppds read and wrote agent_ppds.p and firstgame.p, so two models running at once could take the
+    same run number or read a half-written pickle. Here every read-modify-write happens under an OS file lock (held
+    on a separate .lock file and released by the OS if the process dies), and files are written under a temporary
+    name and renamed into place, so a reader only ever sees a whole file.
+
+    Models given an experiment name keep their ppDs in experiments/<name>/ rather than the working directory, so
+    independent experiments - each a series of games that hand ppDs on to the next - can run side by side. """
+
+import contextlib
+import csv
+import os
+import pickle
+
+try:
+    import fcntl
+except ImportError:  # Windows
+    fcntl = None
+    import msvcrt
+
+RUN_NUMBERS = "filename_number.csv"
+
+
+@contextlib.contextmanager
+def locked(path):
+    """ Hold the lock for path. Every process that changes path should take it first. """
+    with open(path + ".lock", "a+") as f:
+        if fcntl is not None:
+            fcntl.flock(f, fcntl.LOCK_EX)
+        else:
+            f.seek(0)
+            msvcrt.locking(f.fileno(), msvcrt.LK_LOCK, 1)
+        try:
+            yield
+        finally:
+            if fcntl is not None:
+                fcntl.flock(f, fcntl.LOCK_UN)
+            else:
+                f.seek(0)
+                msvcrt.locking(f.fileno(), msvcrt.LK_UNLCK, 1)
+
+
+def replace(path, write, mode="wb"):
+    """ Write path with write(f), all at once as far as anyone reading it can tell """
+    with open(path + ".part", mode, newline="" if "b" not in mode else None) as f:
+        write(f)
+    os.replace(path + ".part", path)
+
+
+def next_run_number(path=RUN_NUMBERS):
+    """ Take the number in path for this run and leave the next one there. No two callers get the same number. """
+    with locked(path):
+        number = 0
+        if os.path.isfile(path):
+            with open(path, "r", newline="") as f:
+                rows = [row for row in csv.reader(f) if row]
+            if rows:
+                number = int(rows[0][0])
+        replace(path, lambda f: csv.writer(f).writerow([number + 1]), "w")
+    return number
+
+
+class PPDStore:
+    def __init__(self, experiment=None):
+        """ The ppDs of one experiment's agents, as agent_ppds.p and firstgame.p """
+        self.directory = "." if experiment is None else os.path.join("experiments", str(experiment))
+        os.makedirs(self.directory, exist_ok=True)
+        self.path = os.path.join(self.directory, "agent_ppds.p")
+        self.first_game_path = os.path.join(self.directory, "firstgame.p")
+
+    def begin(self, initial_ppds):
+        """ Whether this is the experiment's first game. The first model to ask also stores initial_ppds(), before
+            anyone else can read them. """
+        with locked(self.path):
+            if os.path.isfile(self.first_game_path):
+                return False
+            self.save(initial_ppds())
+            replace(self.first_game_path, lambda f: pickle.dump(1, f))
+            return True
+
+    def load(self):
+        with open(self.path, "rb") as f:
+            return pickle.load(f)
+
+    def save(self, ppds):
+        replace(self.path, lambda f: pickle.dump(ppds, f))
@@ -1,26 +1,27 @@
 import random
+import numpy as np
+from pdpython_model import encoding
+from pdpython_model import qtable
 
 
-def init_qtable(states, n_actions, zeroes):
-    iqtable = {}   # does this want to be a list or a dict?
-
-    for i in states:
-        indx = tuple(i)
-        vu = []
-        for j in range(n_actions):
-            if zeroes:
-                vu.append(0)
-            else:
-                vu.append(random.uniform(0.0, 1.0))
+def init_qtable(states, n_actions, zeroes, dtype=np.float64, store=None, agent_id=None):
+    """ States should be the model's qtable.StateIndex of packed state codes. Returns a dense QTable, agent_id's
+        table in store (a qtable.QStore) if one is given. """
+    if store is not None:
+        iqtable = store.new_table(agent_id)
+    else:
+        iqtable = qtable.QTable(states, n_actions, dtype)
 
-        #print('indx=', indx, 'vu=', vu)
-        iqtable[indx] = vu
+    if not zeroes:
+        for i in states.positions:
+            for j in range(n_actions):
+                iqtable.q[i, j] = random.uniform(0.0, 1.0)
 
     return iqtable
 
 
-def egreedy_action(e, qtable, current_state, paired):
-    """ Qtable should be a dict keyed by the states - tuples of 7 values. """
+def egreedy_action(e, qtable, current_state):
+    """ Qtable should be a dict keyed by the packed state codes (see encoding.py). """
 
     p = random.random()
 
@@ -28,11 +29,7 @@ def egreedy_action(e, qtable, current_state, paired):
         return random.choice(["C", "D"])
     else:
         # index qtable by current_state
-        if len(current_state) == 1:
-            if paired:
-                current_state = current_state[0]
-        # print('my state:', current_state)
-        current = qtable[tuple(current_state)]
+        current = qtable[current_state]
         # print('qvalues:', current)
         # pick the action with the highest Q value - if indx:0, C, if indx:1, D
         if current[0] > current[1]:
@@ -43,6 +40,18 @@ def egreedy_action(e, qtable, current_state, paired):
             return random.choice(["C", "D"])
 
 
+def egreedy_actions(e, qrows, rng):
+    """ egreedy_action for a whole batch at once. qrows is an (..., 2) array of Q values, one row per decision, and
+        e an epsilon (or array of them) that broadcasts against qrows[..., 0]. rng is a numpy Generator; all the
+        randomness comes from one draw of two numbers per decision - the explore test and the coin, which is used
+        either to explore or to break a tie, never both. Returns an array of move codes (see encoding.py). """
+    draws = rng.random(qrows.shape[:-1] + (2,))
+    coin = np.where(draws[..., 1] < 0.5, encoding.C, encoding.D)
+    greedy = np.where(qrows[..., 0] > qrows[..., 1], encoding.C,
+                      np.where(qrows[..., 1] > qrows[..., 0], encoding.D, coin))
+    return np.where(draws[..., 0] < e, coin, greedy).astype(np.int8)
+
+
 def sarsa_decision(alpha, epsilon, gamma):
     # initialise q table
     # choose action
@@ -51,12 +60,9 @@ def sarsa_decision(alpha, epsilon, gamma):
     # after action staged, in the
     return
 
-def output_sprime(current_state, observed_action):
-    """ Returns a tuple that adds the observed action to the stack. Current state should be a tuple of strings?"""
-    cstate = list(current_state)
-    cstate.pop(0)
-    cstate.append(observed_action)
-    return tuple(cstate)
+def output_sprime(current_state, observed_action, size):
+    """ Returns the state code with the observed action shifted onto the end of the window. """
+    return encoding.shift(current_state, encoding.encode_move(observed_action), size)
 
 def decay_value(initial, current, max_round, linear, floor):
     # Version WITHOUT simulated annealing, though that could be in V2
@@ -89,3 +95,61 @@ def update_q(reward, gamma, alpha, oldQ, nextQ):
 
 # to integrate SVO into sarsa, we could try two methods
 # a: weight the value of rewards received in each state my your orientation
+
+
+class BatchUpdate:
+    """ Collects one round's SARSA updates from every LEARN agent and applies them together once the round is over.
+
+        Nothing reads an agent's Q-table, epsilon or alpha between its own advance and its next step, so holding
+        the updates back to the end of the round changes nothing. An agent's updates are applied in partner order
+        (one NumPy pass per partner position, every agent at once), so two partners that share a state compound
+        exactly as they did when applied one by one. The agents' Q-tables have to live in the one qtable.QStore. """
+    def __init__(self, store):
+        self.store = store
+        self.agents = []
+        self.updates = []
+
+    def join(self, agent):
+        """ An agent has advanced this round and wants its decay and finish_round at the end of it """
+        self.agents.append(agent)
+
+    def add(self, agent, order, state, action, reward, sprime, aprime):
+        """ Queue Q(state, action) += alpha * (reward + gamma * Q(sprime, aprime) - Q(state, action)), where order
+            is the partner's position in the agent's partner list """
+        table = agent.qtable
+        self.updates.append((order, table.slot, table.row(state), 0 if action == 'C' else 1, reward,
+                             table.row(sprime), 0 if aprime == 'C' else 1, agent.alpha, agent.gamma))
+
+    def apply(self, model):
+        """ Apply the queued updates, decay every learner's epsilon and alpha, then let them finish their round """
+        if self.updates:
+            order, agent, s, a, reward, sprime, aprime, alpha, gamma = (np.array(i) for i in zip(*self.updates))
+            self.store.pack()  # take in any tables new this round
+            q = self.store.q
+            for k in np.unique(order):
+                n = order == k
+                L = agent[n]
+                oldQ = q[L, s[n], a[n]]
+                nextQ = q[L, sprime[n], aprime[n]]
+                q[L, s[n], a[n]] = oldQ + alpha[n] * (reward[n] + ((gamma[n] * nextQ) - oldQ))
+
+        if self.agents:
+            epsilon = decay_values(model.epsilon, np.array([i.epsilon for i in self.agents]), model.rounds,
+                                   model.epsilon_floor)
+            alpha = decay_values(model.alpha, np.array([i.alpha for i in self.agents]), model.rounds,
+                                 model.alpha_floor)
+            for n, i in enumerate(self.agents):
+                i.epsilon = float(epsilon[n])
+                i.alpha = float(alpha[n])
+                i.finish_round()
+
+        self.agents = []
+        self.updates = []
+
+
+def decay_values(initial, current, max_round, floor):
+    """ decay_value's linear schedule over an array of current values """
+    new_value = current - initial / max_round
+    if floor > 0:
+        return np.where(new_value < floor, floor, new_value)
+    return new_value
@@ -1,49 +1,39 @@
 import random
+import collections
 import math
+import numpy as np
+from pdpython_model import encoding
+from pdpython_model import qtable
 
-def observe_state(obsAction, oppID, oppMood, stateMode):
+def observe_state(obsAction, oppID, oppMood, stateMode, n_agents):
     """Keeping this as a separate method in case we want to manipulate the observation somehow,
     like with noise (x chance we make an observational mistake, etc)."""
     # print('oppmood', oppMood)
-    state = []
-    if stateMode == 'stateless':
-        state.append(obsAction)
-    elif stateMode == 'agentstate':
-        state.append(obsAction)
-        state.append(oppID)
-    elif stateMode == 'moodstate':
-        state.append(obsAction)
-        state.append(oppID)
-        state.append(oppMood)
-    # Returns a list, but this should be utilised as a tuple when used to key a Q value
-    # print('state:', state)
-    return state
-
-def init_qtable(states, n_actions, zeroes):
-    """First value is for cooperate, second value is for defect."""
-    iqtable = {}   # does this want to be a list or a dict?
-
-    for i in states:
-        indx = tuple(i)
-        vu = []
-        for j in range(n_actions):
-            if zeroes:
-                vu.append(0)
-            else:
-                vu.append(random.uniform(0.0, 1.0))
-
-        #print('indx=', indx, 'vu=', vu)
-        iqtable[indx] = vu
+    # Returns the packed state code (see encoding.py), which keys the Q values directly
+    return encoding.moody_state_code(obsAction, oppID, oppMood, stateMode, n_agents)
+
+def init_qtable(states, n_actions, zeroes, dtype=np.float64):
+    """First value is for cooperate, second value is for defect. States should be the model's qtable.StateIndex
+    of packed state codes, and a dense QTable is returned."""
+    iqtable = qtable.QTable(states, n_actions, dtype)
+
+    if not zeroes:
+        for i in states.positions:
+            for j in range(n_actions):
+                iqtable.q[i, j] = random.uniform(0.0, 1.0)
     return iqtable
 
-def init_statememory(states, n_actions, delta):
+def init_statememory(states, n_actions, delta, lazy=False):
+    """ With lazy, states we haven't been given get their entry the first time they're looked up """
     iqtable = {}   # does this want to be a list or a dict?
     vv = []
     for j in range(0, delta):
         vv.append(0)
+    if lazy:
+        iqtable = collections.defaultdict(lambda: [vv for j in range(n_actions)])
 
     for i in states:
-        indx = tuple(i)
+        indx = i
         vu = []
         for j in range(n_actions):
             vu.append(vv)
@@ -160,7 +150,7 @@ def moody_action_three(mood, state, qtable, moodAffectMode, epsilon, moodAffect)
     # print(mood, state, qtable, epsilon, moodAffect, turn, startingBehav)
     change = epsilon
     epsChange = 0  # this should stay at no change if mood isn't high or low
-    current = qtable[tuple(state)]
+    current = qtable[state]
 
     r = random.randint(1, 100) / 100  # Still not sure about this line and below, it might need to be if r > 50?
 
@@ -213,15 +203,28 @@ def moody_action_three(mood, state, qtable, moodAffectMode, epsilon, moodAffect)
 
     return todo
 
+def moody_actions_three(moods, qrows, epsilon, moodAffect, rng):
+    """ moody_action_three for a whole batch at once. qrows is an (..., 2) array of Q values, one row per decision;
+        moods, epsilon and moodAffect broadcast against qrows[..., 0]. rng is a numpy Generator, drawn from once
+        per decision for r (still in hundredths, as randint(1, 100) / 100 gave) and two independent coins - one for
+        the first pick, one for a mood-gated re-draw. Returns an array of move codes (see encoding.py). """
+    draws = rng.random(qrows.shape[:-1] + (3,))
+    r = np.floor(draws[..., 0] * 100 + 1) / 100
+    greedy = np.where(qrows[..., 0] > qrows[..., 1], encoding.C, encoding.D)
+    first = np.where(draws[..., 1] < 0.5, encoding.C, encoding.D)
+    again = np.where(draws[..., 2] < 0.5, encoding.C, encoding.D)
+
+    todo = np.where(r < (1 - epsilon), greedy, first)
+    # high mood and D-ing, or low mood and C-ing, picks again with moodAffect in place of epsilon
+    redraw = ((moods > 70) & (todo == encoding.D)) | ((moods < 30) & (todo == encoding.C))
+    todo = np.where(redraw, np.where(r < (1 - moodAffect), greedy, again), todo)
+    return todo.astype(np.int8)
+
 def moody_action_alt(mood, state, qtable, moodAffectMode, epsilon, moodAffect, turn, startingBehav):
     """ The essence of this should be that we pick an action through epsilon greedy, then
         depending on which one we picked and our mood, we change epsilon. """
     """ IF USING THIS FUNCTION, USE A LARGE EPSILON AND THEN IT DECAYS """
     r = random.randint(1, 100) / 100
-    if type(state[0]) == tuple:
-        state = state[0]
-    else:
-        state = tuple(state)
     current = qtable[state]
     todo = 'C'  # just in case the next steps mess up, let's cooperate as default
     change = 0
@@ -276,7 +279,7 @@ def moody_action(mood, state, qtable, moodAffectMode, epsilon, moodAffect):
     # Inititally starts with cooperation
 
     # index qtable by current state
-    current = qtable[tuple(state)]
+    current = qtable[state]
     if current[1] > current[0]:
 
         if mood > 70 and moodAffectMode == 'Fixed':
@@ -349,12 +352,9 @@ def sarsa_decision(alpha, epsilon, gamma):
     # after action staged, in the
     return
 
-def output_sprime(current_state, observed_action):
-    """ Returns a tuple that adds the observed action to the stack. Current state should be a tuple of strings?"""
-    cstate = list(current_state)
-    cstate.pop(0)
-    cstate.append(observed_action)
-    return tuple(cstate)
+def output_sprime(current_state, observed_action, size):
+    """ Returns the state code with the observed action shifted onto the end of the window. """
+    return encoding.shift(current_state, encoding.encode_move(observed_action), size)
 
 def decay_value(initial, current, max_round, linear, floor):
     # Version WITHOUT simulated annealing, though that could be in V2
@@ -380,7 +380,7 @@ def update_q(step_number, actionTaken, state, qtable, payoff, memory, currMood):
     # TODO: Need to manage memory outside of this function, as we do with working memory /
     # TODO: Needs to be a NEW memory of payoffs gained instead of moves observed
     """THIS RETURNS UPDATED Q VALUES FROM OLD Q VALUES"""
-    current = qtable[tuple(state)]
+    current = qtable[state]
     if step_number is not None:
         if step_number is not 0:
             if actionTaken == 'C':
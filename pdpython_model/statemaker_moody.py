@@ -1,3 +1,5 @@
+from pdpython_model import encoding
+
 def chunker(seq, size):
     # Remember to use type conversion on this function call to get the result you want, i.e. tuple(chunker(x, y))
     return (seq[pos:pos + size] for pos in range(0, len(seq), size))
@@ -5,31 +7,36 @@ def chunker(seq, size):
 def get_memory_states(behaviours, statemode, n_agents):
     """ Get a list of all possible states given n behaviour options and
         r spaces in the agent's memory - Size: Number of Objects in That Memory  """
-    permutations = []
+    return list(iter_memory_states(behaviours, statemode, n_agents))
+
+
+def iter_memory_states(behaviours, statemode, n_agents):
+    """ get_memory_states one state at a time, in the same order, without building the list """
     mood_values = ["LOW", "NEUTRAL", "HIGH"] #THIS MIGHT NEED A GENERATOR ALL ON ITS OWN
     agents = list(range(1, n_agents+1))
 
     if statemode == "stateless":
         """Where agents only know about what they observed on that previous round"""
-        # permutations.append([0, ])
         for i1 in behaviours:
-            permutations.append([i1])
+            yield [i1]
 
     elif statemode == "agentstate":
         """Where agents the observed behaviour and which agent they are interacting with"""
-        permutations.append([0, 0])
+        yield [0, 0]
         for i1 in behaviours:
             for i2 in agents:
-                permutations.append([i1, i2])
+                yield [i1, i2]
 
     elif statemode == "moodstate":
         """Where agents know the observed behaviour, which agent they are interacting with,
            and the mood level (low, neutral, high) of their opponent"""
-        permutations.append([0, 0, 0])
+        yield [0, 0, 0]
         for i1 in behaviours:
             for i2 in agents:
                 for i3 in mood_values:
-                    permutations.append([i1, i2, i3])
+                    yield [i1, i2, i3]
 
-    return permutations
 
+def encode_states(states, statemode, n_agents):
+    """ The packed code (see encoding.py) for each state from get_memory_states, in the same order """
+    return [encoding.moody_state_from_list(i, statemode, n_agents) for i in states]
@@ -0,0 +1,112 @@
+""" A process-wide registry of the state spaces the models learn over.
+
+    A model's states, their packed codes (see encoding.py), the StateIndex over them and their state values only
+    depend on the behaviours, memory size and pairing - or statemode and number of agents for moody states - so
+    within a sweep hundreds of models ask for the same few spaces. memory_space and moody_space build each one once
+    per process and hand every model the same StateSpace, which nothing may write to. Each space also carries the
+    UpdateValues table PDAgent.change_update_value reads from.
+
+    Given a cache directory, the codes and values are also kept there as .npy files, so a new process only has to
+    list the states again (which is cheap) rather than encode and value them. """
+
+import os
+import numpy as np
+from pdpython_model import encoding
+from pdpython_model import statemaker
+from pdpython_model import statemaker_moody
+from pdpython_model import qtable
+
+_spaces = {}
+
+
+class StateSpace:
+    def __init__(self, states, codes, values, paired):
+        self.states = tuple(states)
+        self.codes = tuple(codes)
+        self.values = tuple(values)
+        self.index = qtable.StateIndex(self.codes)
+        self.update_values = UpdateValues(self.codes, self.values, paired)
+
+    def __len__(self):
+        return len(self.states)
+
+
+def update_multiplier(state_value):
+    """ The bounds change_update_value puts on state values, as a multiple of theta. State values run from -21 to
+        21 for windows of up to 7, with middling states around zero - longer windows can score past 21 and get the
+        top multiple too. """
+    for upper, multiplier in ((5, 1), (9, 2), (12, 3), (15, 4), (18, 5)):
+        if abs(state_value) <= upper:
+            return multiplier
+    return 6
+
+
+class UpdateValues:
+    """ change_update_value's multiple of theta for every window code, worked out once rather than found by
+        scanning the state list on every call. As with the scan, the first appearance of a state wins and a window
+        that isn't in the list gets the value of the first state. With lazy, there is no list: each window is valued
+        the first time it is seen and remembered. """
+    def __init__(self, codes, values, paired, lazy=False):
+        self.table = {}
+        for code, value in zip(codes, values):
+            if code not in self.table:
+                self.table[code] = update_multiplier(value)
+        self.fallback = update_multiplier(values[0]) if len(values) else 1
+        self.paired = paired
+        self.lazy = lazy
+
+    def __getitem__(self, code):
+        if code in self.table:
+            return self.table[code]
+        if not self.lazy:
+            return self.fallback
+        value = 0
+        if code is not encoding.NO_STATE:
+            value = statemaker.evaluate_states([encoding.decode_state(code)], self.paired)[0]
+        self.table[code] = update_multiplier(value)
+        return self.table[code]
+
+
+def memory_space(behaviours, size, paired, cache_dir=None):
+    """ The LEARN states for a memory of size, as statemaker lists them """
+    key = ('memory', tuple(behaviours), size, paired)
+    if key not in _spaces:
+        states = statemaker.get_memory_states(behaviours, size, paired)
+        _spaces[key] = build(key, states, statemaker.encode_states, paired, cache_dir)
+    return _spaces[key]
+
+
+def moody_space(behaviours, statemode, n_agents, paired, cache_dir=None):
+    """ The MOODYLEARN states for a statemode, as statemaker_moody lists them """
+    key = ('moody', tuple(behaviours), statemode, n_agents, paired)
+    if key not in _spaces:
+        states = statemaker_moody.get_memory_states(behaviours, statemode, n_agents)
+        encode = lambda s: statemaker_moody.encode_states(s, statemode, n_agents)
+        _spaces[key] = build(key, states, encode, paired, cache_dir)
+    return _spaces[key]
+
+
+def build(key, states, encode, paired, cache_dir):
+    path = None
+    if cache_dir is not None:
+        name = '_'.join(''.join(str(j) for j in i) if isinstance(i, tuple) else str(i) for i in key)
+        path = os.path.join(cache_dir, 'states_%s.npy' % name)
+        if os.path.exists(path):
+            saved = np.load(path)
+            if saved.shape == (2, len(states)):
+                return StateSpace(states, saved[0].tolist(), saved[1].tolist(), paired)
+
+    codes = encode(states)
+    values = statemaker.evaluate_states(states, paired)
+    if path is not None:
+        os.makedirs(cache_dir, exist_ok=True)
+        # write then rename, so another process never loads half a file
+        with open(path + '.part', 'wb') as f:
+            np.save(f, np.array([codes, values], dtype=np.int64))
+        os.replace(path + '.part', path)
+    return StateSpace(states, codes, values, paired)
+
+
+def clear():
+    """ Forget every space built so far, e.g. after changing statemaker """
+    _spaces.clear()
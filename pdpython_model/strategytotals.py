@@ -0,0 +1,43 @@
+""" Running per-strategy totals for the model's reporters.
+
+    The per-strategy reporters (get_tft_performance, get_learn_mutC and the rest) each listed every agent's strategy
+    and value on every collect and, for each agent of the strategy, added the value at strategy.index(i) - the first
+    agent playing it - so they were quadratic in the number of agents and reported the first agent's value times the
+    count. Now agents add to the model's StrategyTotals as they go, their payoffs as they're scored and their
+    cooperations, defections and mutual cooperations when they report the round to the model, and a reporter just
+    looks its strategy up. The array engine, which doesn't play through the agents, sets the totals from its arrays
+    at the end of each round. """
+
+import collections
+
+
+class StrategyTotals:
+    def __init__(self):
+        self.score = collections.defaultdict(int)  # over the whole game
+        self.cooperations = collections.defaultdict(int)  # these three over the current round
+        self.defections = collections.defaultdict(int)
+        self.mutual_cooperations = collections.defaultdict(int)
+
+    def begin_round(self):
+        self.cooperations.clear()
+        self.defections.clear()
+        self.mutual_cooperations.clear()
+
+    def scored(self, strategy, payoff):
+        self.score[strategy] += payoff
+
+    def played(self, strategy, cooperations, defections, mutual_cooperations):
+        self.cooperations[strategy] += cooperations
+        self.defections[strategy] += defections
+        self.mutual_cooperations[strategy] += mutual_cooperations
+
+    def set_round(self, groups, score, cooperations, defections, mutual_cooperations):
+        """ Every total at once, from arrays with an entry per agent - groups maps each strategy to a mask of its
+            agents """
+        self.begin_round()
+        self.score.clear()
+        for strategy, members in groups.items():
+            if members.any():
+                self.score[strategy] = score[members].sum().item()
+                self.played(strategy, cooperations[members].sum().item(), defections[members].sum().item(),
+                            mutual_cooperations[members].sum().item())
@@ -0,0 +1,163 @@
+""" Parameter sweeps run across a pool of processes.
+
+    mesa's BatchRunner runs every (parameter combination, iteration) of a sweep one after another on one core. Here
+    each of those is a job, handed to a ProcessPoolExecutor, and each job's results are written to their own files
+    in the output directory as soon as it finishes, so nothing already done is lost if the sweep is stopped or a
+    worker dies - running the same sweep again only runs the jobs that have no results yet.
+
+    A job's step data (its DataCollector's model data) goes straight from the worker to job_<n>.csv, and only a
+    small summary comes back, so the sweep holds no run's data in memory. combine then copies the files into one
+    CSV a run at a time.
+
+    Every job gets its own seed, made from the sweep's seed and the job's number alone, so a job gives the same
+    results whichever worker runs it and whatever else runs alongside it. For the same reason each job keeps its
+    ppDs in an experiment of its own (see runstore.PPDStore) unless the parameters name one - so for kNN training,
+    where each game carries on from the ppDs of the last, use BatchRunner as before.
+
+    A worker that crashes outright (segfault, out of memory) takes the pool down with it, and the pool can't say
+    which job did it. The jobs that could have been running are run again with a pool each, which pins any further
+    crash on the job that caused it, and everything else unfinished goes to a new pool as before; a job whose own
+    worker crashes more than retries times is given up on. """
+
+import concurrent.futures
+import os
+import pickle
+import traceback
+import numpy as np
+import pandas as pd
+from mesa.batchrunner import ParameterProduct
+from pdpython_model import runstore
+
+
+def job_seed(seed, number):
+    return int(np.random.SeedSequence([seed, number]).generate_state(1)[0])
+
+
+def jobs(variable_parameters, fixed_parameters=None, iterations=1, seed=0, name="sweep"):
+    """ Every job of the sweep as (number, kwargs), in BatchRunner's order """
+    fixed_parameters = fixed_parameters or {}
+    combinations = list(ParameterProduct(variable_parameters)) if variable_parameters else [{}]
+    all_jobs = []
+    for params in combinations:
+        for iteration in range(iterations):
+            number = len(all_jobs)
+            kwargs = dict(fixed_parameters, **params)
+            kwargs.setdefault("seed", job_seed(seed, number))
+            kwargs.setdefault("experiment", "%s_job_%d" % (name, number))
+            all_jobs.append((number, kwargs))
+    return all_jobs
+
+
+def run_job(model_cls, number, kwargs, max_steps, out_dir):
+    """ Run one model to max_steps (or until it stops itself), save its step data and return a summary of the
+        run. Runs in a worker. """
+    model = model_cls(**kwargs)
+    while model.running and model.schedule.steps < max_steps:
+        model.step()
+    return {"job": number,
+            "params": kwargs,
+            "steps": model.schedule.steps,
+            "step_data": save_step_data(model, os.path.join(out_dir, "job_%d.csv" % number))}
+
+
+def save_step_data(model, path):
+    """ Write model's DataCollector model data to path, one row per step. Returns path. """
+    frame = model.datacollector.get_model_vars_dataframe()
+    runstore.replace(path, lambda f: frame.to_csv(f, index_label="step"), "w")
+    return path
+
+
+def result_path(out_dir, number):
+    return os.path.join(out_dir, "job_%d.p" % number)
+
+
+def run(model_cls, variable_parameters, fixed_parameters=None, iterations=1, max_steps=1000, out_dir="sweep",
+        processes=None, seed=0, retries=2):
+    """ Run the sweep's outstanding jobs on processes workers (one per core by default), saving each job's results
+        to out_dir as it finishes. Returns {job number: why it failed} for the jobs that didn't. """
+    os.makedirs(out_dir, exist_ok=True)
+    name = os.path.basename(os.path.abspath(out_dir))
+    todo = dict((number, kwargs)
+                for number, kwargs in jobs(variable_parameters, fixed_parameters, iterations, seed, name)
+                if not os.path.exists(result_path(out_dir, number)))
+    processes = processes or os.cpu_count()
+    progress = {"total": len(todo), "failed": {}}
+    crashes = dict.fromkeys(todo, 0)
+    suspects = []
+
+    while todo:
+        if suspects:
+            # each suspect gets a pool to itself, so a crash can only be its own
+            batch, suspects = suspects[:processes], suspects[processes:]
+            pools = [concurrent.futures.ProcessPoolExecutor(1) for number in batch]
+            futures = dict((pool.submit(run_job, model_cls, number, todo[number], max_steps, out_dir), number)
+                           for pool, number in zip(pools, batch))
+            for number in collect(futures, todo, out_dir, progress):
+                crashes[number] += 1
+                if crashes[number] > retries:
+                    progress["failed"][number] = "its worker crashed %d times" % crashes[number]
+                    del todo[number]
+                    print("Sweep job %d given up on: %s" % (number, progress["failed"][number]))
+                else:
+                    suspects.append(number)
+            for pool in pools:
+                pool.shutdown()
+        else:
+            with concurrent.futures.ProcessPoolExecutor(processes) as pool:
+                futures = dict((pool.submit(run_job, model_cls, number, kwargs, max_steps, out_dir), number)
+                               for number, kwargs in todo.items())
+                broken = collect(futures, todo, out_dir, progress)
+            # the pool hands jobs out in order, a worker's worth at a time, so only the first few unfinished jobs
+            # can have been running when it went down - the rest just go round again
+            suspects = sorted(broken)[:processes + 1]
+    return progress["failed"]
+
+
+def collect(futures, todo, out_dir, progress):
+    """ Save each job's summary as it finishes, and take it off todo. Returns the jobs lost to a crashed worker. """
+    broken = []
+    for future in concurrent.futures.as_completed(futures):
+        number = futures[future]
+        try:
+            result = future.result()
+        except concurrent.futures.process.BrokenProcessPool:
+            broken.append(number)
+            continue
+        except Exception:
+            progress["failed"][number] = traceback.format_exc()
+            del todo[number]
+            print("Sweep job %d failed:\n%s" % (number, progress["failed"][number]))
+            continue
+        runstore.replace(result_path(out_dir, number), lambda f: pickle.dump(result, f))
+        del todo[number]
+        print("Sweep job %d done, %d of %d left" % (number, len(todo), progress["total"]))
+    return broken
+
+
+def results(out_dir="sweep"):
+    """ The summaries of every finished job in out_dir, in job order """
+    finished = []
+    for name in os.listdir(out_dir):
+        if name.startswith("job_") and name.endswith(".p"):
+            with open(os.path.join(out_dir, name), "rb") as f:
+                finished.append(pickle.load(f))
+    return sorted(finished, key=lambda r: r["job"])
+
+
+def step_data(out_dir="sweep"):
+    """ Every finished job's step data as one DataFrame, with a column for the job number """
+    frames = [pd.read_csv(r["step_data"]).assign(job=r["job"]) for r in results(out_dir)]
+    return pd.concat(frames, ignore_index=True) if frames else pd.DataFrame()
+
+
+def combine(paths, filename, labels=None, label="job"):
+    """ Copy the step data files in paths into one CSV, filename, one file at a time, adding a label column
+        (labels, or each file's place in paths) to tell the runs apart """
+    if labels is None:
+        labels = range(len(paths))
+    header = True
+    with open(filename, "w", newline="") as out:
+        for path, value in zip(paths, labels):
+            pd.read_csv(path).assign(**{label: value}).to_csv(out, header=header, index=False)
+            header = False
+    return filename
@@ -0,0 +1,382 @@
+""" Per-agent, per-step output, written once per run rather than once per agent per step.
+
+    Agents used to open '<exp> agent <ID>.csv', append one row and close it again on every step, retrying forever
+    on a PermissionError - 640,000 opens for a 64 agent, 10,000 step run. Now each agent hands its row to the
+    model's AgentTelemetry, which keeps them in memory and every flush_every steps appends them all, long format
+    (one row per agent per step, with an agent column), to a single '<exp> agents.csv'.
+
+    Each value is written exactly as it was in the per-agent files, but pandas.read_csv on the one file picks a
+    type per column across every agent, so a column where any agent wrote 1.5 reads back 1 as 1.0, and so on.
+    read_agents splits the file back up and types each agent's rows on their own, as reading its old file did.
+
+    With telemetry_format="npz", EdgeTelemetry keeps a row per agent, partner and step instead - moves, payoff,
+    ppD, mood, epsilon and alpha as typed numpy columns rather than stringified dicts - and writes each flush as a
+    compressed .npz chunk in an '<exp> agents' directory. load_edges reads the chunks back as one DataFrame.
+
+    A failed write is retried a few times with a growing pause, and if it still fails the rows are kept for the
+    next flush rather than lost. Whatever is still buffered when the writer is garbage collected, or when python
+    exits, is written out then.
+
+    The writes themselves can be handed to a BackgroundWriter, a thread of its own fed from a bounded queue, so the
+    simulation carries on while they happen - worthwhile where a single write can take milliseconds, e.g. on
+    network-mounted scratch disks. When the queue is full, the writer's policy decides: "block" waits for room,
+    "drop" discards the write (with a warning), and "spill" pickles it to a local temporary file, which the thread
+    drains in order as the queue empties. Models flush it at the end of a run, so everything has been written by
+    the time they stop. """
+
+import collections
+import csv
+import io
+import os
+import pickle
+import tempfile
+import threading
+import time
+import traceback
+import warnings
+import weakref
+import numpy as np
+import pandas as pd
+
+AGENT_FIELDS = ['agent', 'stepcount', 'strategy', 'strat code', 'move', 'probabilities', 'utility', 'common_move',
+                'number_coop', 'number_defect', 'outcomes', 'u1', 'u2', 'u3', 'u4', 'm1', 'm2', 'm3', 'm4', 'uv',
+                'ps', 'wm', 'nc', 'mutC', 'simP', 'avp1', 'avp2', 'avp3', 'avp4', 'globav', 'epsilon', 'alpha',
+                'mood', 'sensitivity']
+
+
+# the strat code column of the CSV output, and the strategy column of the binary output - add new ones at the end,
+# so old files still read back
+STRATEGIES = ['RANDOM', 'ANGEL', 'DEVIL', 'EV', 'VEV', 'TFT', 'VPP', 'WSLS', 'LEARN', 'MOODYLEARN', 'iWSLS']
+MOVES = {'C': 1, 'D': 2}
+EDGE_COLUMNS = [('step', np.int32), ('agent', np.int32), ('partner', np.int32), ('strategy', np.int8),
+                ('move', np.int8), ('partner_move', np.int8), ('payoff', np.float64), ('ppd', np.float64),
+                ('score', np.float64), ('mood', np.float64), ('epsilon', np.float64), ('alpha', np.float64)]
+
+
+def retrying(write, path, n_rows, retries=4, backoff=0.05):
+    """ write(), trying again with a growing pause if it fails. Returns whether it worked. """
+    for attempt in range(retries + 1):
+        try:
+            write()
+            return True
+        except OSError as e:  # e.g. the file is open in Excel on Windows
+            if attempt == retries:
+                warnings.warn("Couldn't write to %s (%s), keeping %d rows for next time" % (path, e, n_rows))
+                return False
+            time.sleep(backoff * 2 ** attempt)
+
+
+def write_rows(path, fields, rows, header=True):
+    """ Append rows (dicts) to the CSV at path, starting it with a header if it's new, and empty rows. Returns
+        whether they were written. """
+    if not rows:
+        return True
+    text = io.StringIO()
+    writer = csv.DictWriter(text, fieldnames=fields, restval='')
+    if header and (not os.path.exists(path) or os.path.getsize(path) == 0):
+        writer.writeheader()
+    writer.writerows(rows)
+
+    def append():
+        with open(path, 'a', newline='') as f:
+            f.write(text.getvalue())
+    if not retrying(append, path, len(rows)):
+        return False
+    del rows[:]
+    return True
+
+
+def write_chunk(directory, columns):
+    """ Save the buffered columns (lists) as the next .npz chunk in directory, named for the steps it covers, and
+        empty them. Returns whether they were written. """
+    steps = columns['step']
+    if not steps:
+        return True
+    path = os.path.join(directory, 'steps_%06d_%06d.npz' % (steps[0], steps[-1]))
+    arrays = dict((name, np.array(columns[name], dtype=dtype)) for name, dtype in EDGE_COLUMNS)
+
+    def save():
+        os.makedirs(directory, exist_ok=True)
+        with open(path + '.part', 'wb') as f:
+            np.savez_compressed(f, **arrays)
+        os.replace(path + '.part', path)
+    if not retrying(save, path, len(steps)):
+        return False
+    for name in columns:
+        del columns[name][:]
+    return True
+
+
+def write_more(write, args, unwritten, new):
+    """ write(*args, unwritten) once new (rows, or columns) has been added to unwritten, which holds whatever
+        earlier writes couldn't manage. Runs on the BackgroundWriter's thread, the only one to touch unwritten. """
+    if isinstance(new, dict):
+        for name, values in new.items():
+            unwritten[name].extend(values)
+    else:
+        unwritten.extend(new)
+    return write(*(args + (unwritten,)))
+
+
+def take(buffer):
+    """ A copy of buffer (rows, or columns), leaving it empty """
+    if isinstance(buffer, dict):
+        taken = dict((name, values[:]) for name, values in buffer.items())
+        for values in buffer.values():
+            del values[:]
+        return taken
+    taken = buffer[:]
+    del buffer[:]
+    return taken
+
+
+def hand_over(output, write, args, buffer, unwritten):
+    """ Give what's in buffer to output to write, or write it here if there's no output writer """
+    if output is None:
+        return write(*(args + (buffer,)))
+    output.submit(write_more, write, args, unwritten, take(buffer))
+    return True
+
+
+def load_edges(directory):
+    """ Every chunk in an EdgeTelemetry directory as one DataFrame, a row per agent, partner and step, with
+        strategies and moves as categories """
+    chunks = []
+    for name in sorted(os.listdir(directory)):
+        if name.endswith('.npz'):
+            with np.load(os.path.join(directory, name)) as chunk:
+                chunks.append(dict((column, chunk[column]) for column, dtype in EDGE_COLUMNS))
+    frame = pd.DataFrame(dict((column, np.concatenate([c[column] for c in chunks]) if chunks else np.zeros(0, dtype))
+                              for column, dtype in EDGE_COLUMNS))
+    frame['strategy'] = pd.Categorical.from_codes(frame['strategy'], STRATEGIES)
+    for column in ('move', 'partner_move'):
+        frame[column] = pd.Categorical.from_codes(frame[column] - 1, list(MOVES))
+    return frame
+
+
+def writer(telemetry_format, exp_n, flush_every=100, output=None):
+    """ The model's telemetry writer for telemetry_format, "csv" or "npz". Writes go through output, a
+        BackgroundWriter, if there is one. """
+    if telemetry_format == "npz":
+        return EdgeTelemetry('%s agents' % exp_n, flush_every, output)
+    if telemetry_format == "csv":
+        return AgentTelemetry('%s agents.csv' % exp_n, flush_every, output)
+    raise ValueError("telemetry_format should be 'csv' or 'npz', not %r" % (telemetry_format,))
+
+
+class AgentTelemetry:
+    def __init__(self, path, flush_every=100, output=None):
+        self.path = path
+        self.flush_every = flush_every
+        self.output = output
+        self.rows = []
+        self.unwritten = []
+        if output is not None:
+            output.keep(self.unwritten)
+        weakref.finalize(self, hand_over, output, write_rows, (path, AGENT_FIELDS), self.rows, self.unwritten)
+
+    def add(self, agent_id, row):
+        """ Buffer an agent's row for this step. Dicts and lists are written as they are now, not as they are by the
+            time the row is flushed. """
+        row = dict((k, str(v) if isinstance(v, (dict, list)) else v) for k, v in row.items())
+        row['agent'] = agent_id
+        self.rows.append(row)
+
+    def end_step(self, step, final=False):
+        if final or step % self.flush_every == 0:
+            self.flush()
+
+    def flush(self):
+        return hand_over(self.output, write_rows, (self.path, AGENT_FIELDS), self.rows, self.unwritten)
+
+
+def read_agents(path):
+    """ The rows of an agents.csv as {agent ID: DataFrame}, each typed as if read from that agent's own file """
+    rows = pd.read_csv(path, dtype=str, keep_default_na=False)
+    agents = {}
+    for agent, mine in rows.groupby('agent', sort=True):
+        text = mine.drop(columns='agent').to_csv(index=False)
+        agents[int(agent)] = pd.read_csv(io.StringIO(text))
+    return agents
+
+
+class EdgeTelemetry:
+    def __init__(self, directory, flush_every=100, output=None):
+        self.directory = directory
+        self.flush_every = flush_every
+        self.output = output
+        self.columns = dict((name, []) for name, dtype in EDGE_COLUMNS)
+        self.unwritten = dict((name, []) for name, dtype in EDGE_COLUMNS)
+        if output is not None:
+            output.keep(self.unwritten)
+        weakref.finalize(self, hand_over, output, write_chunk, (directory,), self.columns, self.unwritten)
+
+    def add_edges(self, agent, outcomes):
+        """ Buffer a row for each of agent's partners this step. outcomes is the agent's outcome_list. """
+        columns = self.columns
+        if agent.strategy not in STRATEGIES:
+            raise ValueError("Agent %s plays %r, which has no strategy code - add it to telemetry.STRATEGIES"
+                             % (agent.ID, agent.strategy))
+        strategy = STRATEGIES.index(agent.strategy)
+        if agent.strategy == "MOODYLEARN":
+            epsilon, alpha = agent.moody_epsilon, agent.moody_alpha
+        else:
+            epsilon, alpha = agent.epsilon, agent.alpha
+        for partner, (move, partner_move) in outcomes.items():
+            columns['step'].append(agent.stepCount)
+            columns['agent'].append(agent.ID)
+            columns['partner'].append(partner)
+            columns['strategy'].append(strategy)
+            columns['move'].append(MOVES[move])
+            columns['partner_move'].append(MOVES[partner_move])
+            columns['payoff'].append(agent.payoffs[move, partner_move])
+            columns['ppd'].append(agent.ppD_partner[partner])
+            columns['score'].append(agent.score)
+            columns['mood'].append(agent.mood)
+            columns['epsilon'].append(epsilon)
+            columns['alpha'].append(alpha)
+
+    def end_step(self, step, final=False):
+        if final or step % self.flush_every == 0:
+            self.flush()
+
+    def flush(self):
+        return hand_over(self.output, write_chunk, (self.directory,), self.columns, self.unwritten)
+
+
+POLICIES = ("block", "drop", "spill")
+
+
+class Spiller(pickle.Pickler):
+    """ Pickles a job, leaving out the objects in kept, which the job has to share with whoever made it """
+    def __init__(self, f, kept):
+        super().__init__(f, pickle.HIGHEST_PROTOCOL)
+        self.kept = kept
+
+    def persistent_id(self, obj):
+        return id(obj) if id(obj) in self.kept else None
+
+
+class Unspiller(pickle.Unpickler):
+    def __init__(self, f, kept):
+        super().__init__(f)
+        self.kept = kept
+
+    def persistent_load(self, key):
+        return self.kept[key]
+
+
+def spill(state, job):
+    """ Add job to the end of the spill file. Called with the writer's lock held. """
+    if state['spill'] is None:
+        state['spill'] = tempfile.TemporaryFile(prefix='pdpython-spill-')
+    f = state['spill']
+    f.seek(0, os.SEEK_END)
+    Spiller(f, state['kept']).dump(job)
+    state['spilled'] += 1
+
+
+def unspill(jobs, state, max_pending):
+    """ Move spilled jobs, oldest first, back onto the queue while there's room. Called with the writer's lock
+        held. """
+    f = state['spill']
+    while state['spilled'] and len(jobs) < max_pending:
+        f.seek(state['read'])
+        jobs.append(Unspiller(f, state['kept']).load())
+        state['read'] = f.tell()
+        state['spilled'] -= 1
+    if f is not None and not state['spilled']:
+        f.seek(0)
+        f.truncate()
+        state['read'] = 0
+
+
+def work(jobs, ready, state, max_pending):
+    """ The BackgroundWriter's thread - runs the jobs in the order they came, until told to stop and there are
+        none left """
+    while True:
+        with ready:
+            ready.wait_for(lambda: jobs or state['stop'])
+            if not jobs:
+                return
+            write, args = jobs[0]
+        try:
+            write(*args)
+        except Exception:
+            warnings.warn("Background write failed:\n%s" % traceback.format_exc())
+        with ready:
+            jobs.popleft()  # only now, so flush waits for the write to finish
+            unspill(jobs, state, max_pending)
+            ready.notify_all()
+
+
+def stop(jobs, ready, state, thread):
+    """ Let the thread finish what's queued, then end it """
+    with ready:
+        state['stop'] = True
+        ready.notify_all()
+    thread.join()
+    if state['spill'] is not None:
+        state['spill'].close()
+
+
+class BackgroundWriter:
+    def __init__(self, max_pending=64, policy="block"):
+        """ Runs writes on a thread of its own, at most max_pending at a time queued - beyond that, policy says
+            whether to block, drop or spill (see above). With max_pending 0 every write happens in submit, as if
+            there were no thread. """
+        if policy not in POLICIES:
+            raise ValueError("policy should be one of %s, not %r" % (", ".join(POLICIES), policy))
+        self.max_pending = max_pending
+        self.policy = policy
+        self.dropped = 0
+        self.jobs = collections.deque()
+        self.ready = threading.Condition()
+        # spill is the file, opened at the first spill, read where the oldest of the spilled jobs starts
+        self.state = {'stop': False, 'spill': None, 'read': 0, 'spilled': 0, 'kept': {}}
+        self.thread = None
+        if max_pending > 0:
+            # the thread only sees the queue, not us, so we can still be collected - which stops it
+            self.thread = threading.Thread(target=work, args=(self.jobs, self.ready, self.state, max_pending),
+                                           daemon=True)
+            self.thread.start()
+            weakref.finalize(self, stop, self.jobs, self.ready, self.state, self.thread)
+
+    def keep(self, obj):
+        """ Have spilled jobs refer to obj rather than a copy of it - for a buffer that jobs share with whoever
+            submits them, like the telemetry writers' unwritten rows """
+        with self.ready:
+            self.state['kept'][id(obj)] = obj
+
+    @property
+    def spilled(self):
+        """ How many jobs are waiting in the spill file """
+        return self.state['spilled']
+
+    def submit(self, write, *args):
+        """ write(*args) on the writer's thread, after everything submitted before it """
+        if self.thread is None or not self.thread.is_alive():
+            write(*args)
+            return True
+        with self.ready:
+            if len(self.jobs) >= self.max_pending or self.state['spilled']:
+                if self.policy == "drop":
+                    self.dropped += 1
+                    if self.dropped == 1:
+                        warnings.warn("Output queue full, dropping writes (see BackgroundWriter.dropped)")
+                    return False
+                if self.policy == "block":
+                    self.ready.wait_for(lambda: len(self.jobs) < self.max_pending)
+                if self.policy == "spill":
+                    # once one job has spilled the rest follow it, so they're still written in order
+                    spill(self.state, (write, args))
+                    return True
+            self.jobs.append((write, args))
+            self.ready.notify_all()
+        return True
+
+    def flush(self):
+        """ Wait for everything submitted so far to be written """
+        if self.thread is not None:
+            with self.ready:
+                self.ready.wait_for(lambda: not (self.jobs or self.state['spilled']) or not self.thread.is_alive())
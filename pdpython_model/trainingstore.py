@@ -0,0 +1,92 @@
+""" Collecting kNN training data a game at a time.
+
+    training_data_collector used to load the whole of training_data.p, add the game's rows and write it all back
+    out, so the I/O grew with the square of the number of games. Now each game's rows go into a chunk of their own,
+    a small .npy in a directory beside the dataset, and nothing already written is ever read back or rewritten.
+
+    Chunks are written under a temporary name and renamed into place, with the time, process id and a counter in
+    the name, so any number of training processes can append to the same directory at once without locking, and a
+    reader never sees half a chunk. compact (python -m pdpython_model.trainingstore [training_data.p [dir ...]])
+    merges the chunks into the dataset pickle, oldest first, writes its .npy (see knn.convert) and deletes the
+    chunks it merged. Only one compaction may run at a time; chunks that arrive while it runs are left for the
+    next one. """
+
+import itertools
+import os
+import pickle
+import sys
+import time
+import numpy as np
+from pdpython_model import knn
+
+COLLECTED = "training_data.p"  # where kNN training games collect their data
+
+_counter = itertools.count()
+
+
+def chunk_dir(filename=COLLECTED):
+    return os.path.splitext(filename)[0] + "_chunks"
+
+
+def append(rows, filename=COLLECTED):
+    """ Add rows, as export_training_data makes them, to filename's chunks. Returns the new chunk's path, or None
+        if there were no rows. """
+    rows = np.asarray(rows, dtype=np.float64).reshape(-1, 6)
+    if not len(rows):
+        return None
+    directory = chunk_dir(filename)
+    os.makedirs(directory, exist_ok=True)
+    path = os.path.join(directory, "%020d_%d_%d.npy" % (time.time_ns(), os.getpid(), next(_counter)))
+    with open(path + ".part", "wb") as f:
+        np.save(f, rows)
+    os.replace(path + ".part", path)
+    return path
+
+
+def chunks(directory):
+    """ The finished chunks in directory, oldest first """
+    if not os.path.isdir(directory):
+        return []
+    return [os.path.join(directory, name) for name in sorted(os.listdir(directory)) if name.endswith(".npy")]
+
+
+def compact(filename=COLLECTED, directories=None):
+    """ Merge filename's chunks, and those in any other directories given (e.g. copied from other machines), into
+        filename. Returns how many rows were added. """
+    if directories is None:
+        directories = [chunk_dir(filename)]
+    lock = filename + ".lock"
+    try:
+        os.close(os.open(lock, os.O_CREAT | os.O_EXCL | os.O_WRONLY))
+    except FileExistsError:
+        raise RuntimeError("%s is already being compacted - if not, delete %s" % (filename, lock))
+    try:
+        merging = [path for directory in directories for path in chunks(directory)]
+        if not merging:
+            return 0
+        training_data = []
+        if os.path.isfile(filename):
+            with open(filename, "rb") as f:
+                training_data = pickle.load(f)
+        print("Training Data Size Pre-Update:", len(training_data))
+        added = 0
+        for path in merging:
+            rows = np.load(path).tolist()
+            training_data.extend(rows)
+            added += len(rows)
+        print("Training Data Size Post-Update:", len(training_data))
+        with open(filename + ".part", "wb") as f:
+            pickle.dump(training_data, f)
+        os.replace(filename + ".part", filename)
+        knn.convert(filename)
+        for path in merging:
+            os.remove(path)
+        return added
+    finally:
+        os.remove(lock)
+
+
+if __name__ == '__main__':
+    args = sys.argv[1:]
+    filename = args[0] if args else COLLECTED
+    print(compact(filename, args[1:] or None), "rows merged into", filename)